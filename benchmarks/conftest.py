@@ -0,0 +1,102 @@
+"""
+Fixtures of the benchmark suite, namely synthetic feeds of configurable
+size and a local mock map matching server.
+
+Run the suite with ``pytest benchmarks``, setting the feed size with
+the options ``--num-patterns``, ``--trips-per-pattern``,
+``--stops-per-trip``, and ``--shape-points``; see the pytest-benchmark
+documentation for options to save and compare runs.
+Besides the timings, each benchmark reports its throughput and peak
+memory in its ``extra_info``.
+"""
+import tracemalloc
+
+import pytest
+
+from mock_server import MockServer
+from synthetic import make_feed
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("synthetic feed")
+    group.addoption("--num-patterns", type=int, default=200)
+    group.addoption("--trips-per-pattern", type=int, default=5)
+    group.addoption("--stops-per-trip", type=int, default=30)
+    group.addoption("--shape-points", type=int, default=300)
+
+
+@pytest.fixture(scope="session")
+def feed_size(request):
+    return {
+        "num_patterns": request.config.getoption("--num-patterns"),
+        "trips_per_pattern": request.config.getoption("--trips-per-pattern"),
+        "stops_per_trip": request.config.getoption("--stops-per-trip"),
+        "shape_points": request.config.getoption("--shape-points"),
+    }
+
+
+@pytest.fixture(scope="session")
+def feed(feed_size):
+    return make_feed(**feed_size)
+
+
+def measure_peak_memory(f, *args, **kwargs) -> int:
+    """
+    Call ``f(*args, **kwargs)`` once and return the peak memory in bytes
+    allocated during the call, including its result, as traced by
+    ``tracemalloc``.
+    """
+    tracemalloc.start()
+    try:
+        result = f(*args, **kwargs)
+        __, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return peak
+
+
+@pytest.fixture
+def run(benchmark):
+    """
+    Return a function that benchmarks the call ``f(*args, **kwargs)``
+    with the given number of rounds (pytest-benchmark calibrates the
+    rounds if ``None``), records the throughput of ``num_items`` items
+    of the given unit per second and the peak memory of a separate call
+    in the benchmark's ``extra_info`` (unless benchmarking is disabled),
+    and returns the result of the call.
+    """
+
+    def run(f, *args, num_items=None, unit="items", rounds=None, **kwargs):
+        if rounds is None:
+            result = benchmark(f, *args, **kwargs)
+        else:
+            result = benchmark.pedantic(
+                f, args=args, kwargs=kwargs, rounds=rounds, iterations=1
+            )
+        if benchmark.disabled:
+            return result
+        if num_items is not None:
+            benchmark.extra_info["{!s}_per_second".format(unit)] = (
+                num_items / benchmark.stats.stats.mean
+            )
+        benchmark.extra_info["peak_memory_mib"] = (
+            measure_peak_memory(f, *args, **kwargs) / 2 ** 20
+        )
+        return result
+
+    return run
+
+
+@pytest.fixture(scope="session")
+def server():
+    """
+    A mock map matching server without latency or errors.
+    """
+    with MockServer() as server:
+        yield server
+
+
+@pytest.fixture
+def osrm_url(server):
+    return server.urls["osrm"]
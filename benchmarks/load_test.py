@@ -0,0 +1,121 @@
+"""
+Load test of :func:`gtfs_map_matcher.match_feed` against the mock map
+matching server of the module ``mock_server`` on a synthetic feed,
+reporting the request rate, tail latencies, and patterns lost.
+
+Run with e.g.
+``python benchmarks/load_test.py --service mapbox --latency 0.05 --error-rate 0.02``
+and see ``--help`` for all options.
+"""
+import argparse
+import collections
+import json
+import time
+from typing import Optional
+
+from gtfs_map_matcher import Metrics, Scheduler, get_stop_patterns, match_feed
+from mock_server import MockServer
+from synthetic import make_feed
+
+
+def run_load_test(
+    feed: "Feed",
+    service: str = "osrm",
+    server_options: Optional[dict] = None,
+    scheduler: Optional[Scheduler] = None,
+    **match_options
+) -> dict:
+    """
+    Match the given feed via the given service (``"osrm"``,
+    ``"mapbox"``, or ``"google"``) against a mock server started with
+    the keyword arguments ``server_options``, passing the given scheduler
+    (defaults to an unlimited one) and the keyword arguments
+    ``match_options`` to :func:`gtfs_map_matcher.match_feed`.
+    Return a dictionary with the wall time, the number of stop patterns,
+    the number of patterns lost with counts of the reasons, the
+    client's metrics from :meth:`gtfs_map_matcher.Metrics.to_dict`, and
+    the statistics of the server's requests from
+    :meth:`mock_server.MockServer.get_stats`.
+    """
+    if scheduler is None:
+        scheduler = Scheduler()
+    if service != "osrm":
+        match_options.setdefault("api_key", "mock")
+
+    stop_patterns = get_stop_patterns(feed, as_string=False)
+    num_patterns = stop_patterns["stop_pattern_id"].nunique()
+    metrics = Metrics()
+    with MockServer(**(server_options or {})) as server:
+        start = time.perf_counter()
+        url = server.urls[service]
+        match_feed(
+            feed,
+            service,
+            url=url,
+            scheduler=scheduler,
+            metrics=metrics,
+            **match_options
+        )
+        seconds = time.perf_counter() - start
+        stats = server.get_stats()
+
+    return {
+        "service": service,
+        "seconds": seconds,
+        "num_patterns": int(num_patterns),
+        "patterns_per_second": num_patterns / seconds,
+        "num_patterns_lost": len(metrics.dropped),
+        "lost_reasons": dict(collections.Counter(metrics.dropped.values())),
+        "client": metrics.to_dict(),
+        "server": stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--service", default="osrm", choices=["osrm", "mapbox", "google"]
+    )
+    parser.add_argument("--num-patterns", type=int, default=200)
+    parser.add_argument("--trips-per-pattern", type=int, default=1)
+    parser.add_argument("--stops-per-trip", type=int, default=30)
+    parser.add_argument("--shape-points", type=int, default=300)
+    parser.add_argument("--method", default="num_points")
+    parser.add_argument("--value", type=float, default=100)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--rate-limit", type=float, default=None)
+    parser.add_argument("--densify", type=int, default=0)
+    parser.add_argument("--client-rate", type=float, default=None)
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument("--backoff", type=float, default=0.1)
+    args = parser.parse_args()
+
+    feed = make_feed(
+        num_patterns=args.num_patterns,
+        trips_per_pattern=args.trips_per_pattern,
+        stops_per_trip=args.stops_per_trip,
+        shape_points=args.shape_points,
+    )
+    report = run_load_test(
+        feed,
+        args.service,
+        server_options={
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "error_rate": args.error_rate,
+            "rate_limit": args.rate_limit,
+            "densify": args.densify,
+        },
+        scheduler=Scheduler(
+            rate=args.client_rate, max_retries=args.max_retries, backoff=args.backoff
+        ),
+        method=args.method,
+        value=args.value,
+    )
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
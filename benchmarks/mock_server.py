@@ -0,0 +1,251 @@
+"""
+A local stand-in for the OSRM, Mapbox, and Google map matching services,
+for load and throughput testing of the matchers without the network.
+
+It speaks the request and response formats that the matchers expect,
+namely
+
+- OSRM: ``GET <prefix>/match/v1/<profile>/<coordinates>``
+- Mapbox: ``GET <prefix>/matching/v5/mapbox/<profile>/<coordinates>``
+  or ``POST <prefix>/matching/v5/mapbox/<profile>`` with the
+  coordinates in a form
+- Google: ``GET <prefix>/v1/snapToRoads?path=<points>``
+
+and matches the points of each request to themselves, optionally
+densified to make bigger responses.
+It can also delay responses, fail at random with HTTP 500, and answer
+requests beyond a rate limit with HTTP 429.
+
+For example::
+
+    with MockServer(latency=0.05, error_rate=0.01) as server:
+        match_feed(feed, "osrm", url=server.urls["osrm"])
+        print(server.get_stats())
+
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import threading
+import time
+from typing import Optional
+import urllib.parse
+
+import numpy as np
+
+from gtfs_map_matcher import decode_points_osrm, encode_polyline
+
+
+class MockServer:
+    """
+    Context manager that runs a mock map matching server on a free
+    local port in a background thread, with the following options.
+
+    - ``latency``: seconds to wait before each response
+    - ``jitter``: mean of the exponentially distributed extra seconds to
+      wait before each response, which gives a long tail of latencies
+    - ``error_rate``: probability of answering a request with HTTP 500
+    - ``rate_limit``: max number of requests per second answered;
+      further requests in the same second get HTTP 429 with
+      a Retry-After header; no limit if ``None``
+    - ``densify``: number of points to add between consecutive points
+      of each response, to make bigger responses
+    - ``seed``: seed of the random number generator for errors and jitter
+
+    Its attribute ``urls`` is a dictionary of the form service -> URL to
+    pass to the matchers of the service, and the method
+    :meth:`get_stats` summarizes the requests served so far.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0,
+        jitter: float = 0,
+        error_rate: float = 0,
+        rate_limit: Optional[float] = None,
+        densify: int = 0,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.densify = densify
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.window = (0, 0)  # Pair (second, number of requests in it)
+        self.records = []  # Triples (arrival time, seconds taken, status code)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.mock = self
+        prefix = "http://127.0.0.1:{!s}".format(self.httpd.server_port)
+        self.urls = {
+            "osrm": prefix + "/match/v1/car",
+            "mapbox": prefix + "/matching/v5/mapbox/driving",
+            "google": prefix + "/v1/snapToRoads",
+        }
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self) -> None:
+        """
+        Start serving in a background thread.
+        """
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop serving and close the socket.
+        """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset(self) -> None:
+        """
+        Forget the requests served so far.
+        """
+        with self.lock:
+            self.records = []
+
+    def _admit(self) -> Optional[int]:
+        """
+        Helper function.
+        Decide the fate of a new request, returning the HTTP status code
+        of the error to answer it with or ``None`` to match it.
+        Sleep for its latency unless it is over the rate limit.
+        """
+        with self.lock:
+            second = int(time.monotonic())
+            start, count = self.window
+            count = count + 1 if start == second else 1
+            self.window = (second, count)
+            if self.rate_limit is not None and count > self.rate_limit:
+                return 429
+            delay = self.latency
+            if self.jitter:
+                delay += self.random.expovariate(1 / self.jitter)
+            error = self.random.random() < self.error_rate
+
+        time.sleep(delay)
+        return 500 if error else None
+
+    def _densify(self, points: np.array) -> np.array:
+        """
+        Helper function.
+        Add ``self.densify`` evenly spaced points between consecutive
+        points of the given array.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        if not self.densify or len(points) < 2:
+            return points
+        t = np.arange(self.densify + 1) / (self.densify + 1)
+        segments = points[:-1, None] + t[:, None] * np.diff(points, axis=0)[:, None]
+        return np.concatenate([segments.reshape(-1, 2), points[-1:]])
+
+    def get_stats(self) -> dict:
+        """
+        Return a dictionary summarizing the requests served since the start
+        or the last reset, with the number of requests, their rate in
+        requests per second from the first arrival to the last response,
+        the quantiles of their latencies in seconds, and their numbers by
+        HTTP status code.
+        """
+        with self.lock:
+            records = list(self.records)
+        if not records:
+            return {"num_requests": 0}
+
+        arrivals, latencies, statuses = map(np.array, zip(*records))
+        span = arrivals.max() + latencies[arrivals.argmax()] - arrivals.min()
+        codes, counts = np.unique(statuses, return_counts=True)
+        return {
+            "num_requests": len(records),
+            "requests_per_second": len(records) / span if span > 0 else None,
+            "latency": {
+                q: float(np.quantile(latencies, p))
+                for q, p in [("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1)]
+            },
+            "statuses": {int(c): int(n) for c, n in zip(codes, counts)},
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    Helper class.
+    Handles the requests of a :class:`MockServer`.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.handle_match()
+
+    def do_POST(self):
+        self.handle_match()
+
+    def handle_match(self):
+        arrival = time.monotonic()
+        mock = self.server.mock
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if self.command == "POST":
+            size = int(self.headers.get("Content-Length", 0))
+            query.update(urllib.parse.parse_qsl(self.rfile.read(size).decode()))
+
+        status = mock._admit()
+        if status is not None:
+            self.send_json(status, {"code": "Error"}, arrival)
+            return
+
+        try:
+            if url.path.startswith("/v1/snapToRoads"):
+                points = [
+                    [float(x) for x in p.split(",")[::-1]]
+                    for p in query["path"].split("|")
+                ]
+                data = {
+                    "snappedPoints": [
+                        {"location": {"latitude": lat, "longitude": lon}}
+                        for lon, lat in mock._densify(points).tolist()
+                    ]
+                }
+            else:
+                if self.command == "POST":
+                    coordinates = query["coordinates"]
+                else:
+                    coordinates = urllib.parse.unquote(url.path.rsplit("/", 1)[-1])
+                points = mock._densify(decode_points_osrm(coordinates))
+                data = {
+                    "code": "Ok",
+                    "matchings": [{"geometry": encode_polyline(points, 6)}],
+                }
+        except (KeyError, ValueError):
+            self.send_json(400, {"code": "InvalidInput"}, arrival)
+            return
+
+        self.send_json(200, data, arrival)
+
+    def send_json(self, status, data, arrival):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if status == 429:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.mock.lock:
+            self.server.mock.records.append(
+                (arrival, time.monotonic() - arrival, status)
+            )
+
+    def log_message(self, *args):
+        pass
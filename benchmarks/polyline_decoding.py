@@ -0,0 +1,74 @@
+"""
+Microbenchmark of parsing OSRM/Mapbox map matching responses, comparing
+the old decoding via ``polyline.decode`` into lists of Python points to
+the vectorized :func:`gtfs_map_matcher.matchers.decode_polyline` into
+NumPy arrays.
+
+Run with ``python benchmarks/polyline_decoding.py [number of points]``.
+"""
+import sys
+import timeit
+import tracemalloc
+
+import numpy as np
+import polyline
+
+from gtfs_map_matcher.matchers import decode_polyline
+
+
+def parse_lists(geometries):
+    """
+    The old parsing of ``parse_response_osrm``.
+    """
+    pline = []
+    for g in geometries:
+        pline.extend(polyline.decode(g, 6))
+    return [[p[1], p[0]] for p in pline]
+
+
+def parse_arrays(geometries):
+    """
+    The new parsing of ``parse_response_osrm``.
+    """
+    return np.concatenate(
+        [np.empty((0, 2))] + [decode_polyline(g) for g in geometries]
+    )
+
+
+def measure(f, *args, number=5):
+    """
+    Return the best time in seconds of ``number`` calls of ``f(*args)``
+    and the peak memory in bytes of one call, including its result.
+    """
+    seconds = min(timeit.repeat(lambda: f(*args), number=1, repeat=number))
+    tracemalloc.start()
+    result = f(*args)
+    __, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return seconds, peak
+
+
+def main(num_points=1_000_000, points_per_geometry=1000):
+    rng = np.random.default_rng(0)
+    lons = 174.8 + np.cumsum(rng.normal(0, 1e-4, num_points))
+    lats = -41.2 + np.cumsum(rng.normal(0, 1e-4, num_points))
+    points = list(zip(lats.round(6), lons.round(6)))
+    geometries = [
+        polyline.encode(points[i : i + points_per_geometry], 6)
+        for i in range(0, num_points, points_per_geometry)
+    ]
+    assert np.array_equal(parse_arrays(geometries), parse_lists(geometries))
+
+    print("Parsing {:,} points in {:,} polylines".format(num_points, len(geometries)))
+    print("{:<24}{:>12}{:>16}".format("", "time (s)", "peak (MiB)"))
+    for name, f in [
+        ("polyline.decode + lists", parse_lists),
+        ("decode_polyline", parse_arrays),
+    ]:
+        seconds, peak = measure(f, geometries)
+        print("{:<24}{:>12.3f}{:>16.1f}".format(name, seconds, peak / 2 ** 20))
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
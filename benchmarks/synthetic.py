@@ -0,0 +1,125 @@
+"""
+Synthetic GTFS feeds of configurable size for benchmarking.
+"""
+import gtfs_kit as gk
+import numpy as np
+import pandas as pd
+
+
+def make_feed(
+    num_patterns: int = 200,
+    trips_per_pattern: int = 5,
+    stops_per_trip: int = 30,
+    shape_points: int = 300,
+    seed: int = 0,
+) -> gk.Feed:
+    """
+    Return a synthetic GTFS feed with the given number of bus routes,
+    each with one stop pattern, shape, and the given number of trips.
+    Shapes are random walks of ``shape_points`` points with steps of
+    about 50 meters around Wellington, and each trip has
+    ``stops_per_trip`` stops spread evenly along its shape, with
+    ``shape_dist_traveled`` values in kilometers.
+    Patterns share no stops.
+    """
+    rng = np.random.default_rng(seed)
+    n = shape_points
+    steps = rng.normal(0, 0.0004, (num_patterns, n, 2))
+    steps[:, 0] = [174.78, -41.29] + rng.normal(0, 0.05, (num_patterns, 2))
+    coords = np.cumsum(steps, axis=1)
+    lon, lat = np.radians(coords).transpose(2, 0, 1)
+    seglens = 6371 * np.hypot(np.diff(lon) * np.cos(lat[:, 1:]), np.diff(lat))
+    dists = np.concatenate([np.zeros((num_patterns, 1)), np.cumsum(seglens, 1)], 1)
+
+    pattern_ids = np.repeat(np.arange(num_patterns), n)
+    shapes = pd.DataFrame(
+        {
+            "shape_id": ["s{!s}".format(i) for i in pattern_ids],
+            "shape_pt_sequence": np.tile(np.arange(n), num_patterns),
+            "shape_pt_lon": coords[..., 0].ravel(),
+            "shape_pt_lat": coords[..., 1].ravel(),
+            "shape_dist_traveled": dists.ravel(),
+        }
+    )
+
+    k = stops_per_trip
+    rows = np.linspace(0, n - 1, k).round().astype(int)
+    stop_ids = np.array(
+        ["p{!s}_{!s}".format(i, j) for i in range(num_patterns) for j in range(k)]
+    )
+    stops = pd.DataFrame(
+        {
+            "stop_id": stop_ids,
+            "stop_name": stop_ids,
+            "stop_lon": coords[:, rows, 0].ravel(),
+            "stop_lat": coords[:, rows, 1].ravel(),
+        }
+    )
+
+    routes = pd.DataFrame(
+        {
+            "route_id": ["r{!s}".format(i) for i in range(num_patterns)],
+            "route_short_name": [str(i) for i in range(num_patterns)],
+            "route_type": 3,
+        }
+    )
+
+    m = trips_per_pattern
+    trip_patterns = np.repeat(np.arange(num_patterns), m)
+    trip_ids = np.array(["t{!s}".format(i) for i in range(num_patterns * m)])
+    trips = pd.DataFrame(
+        {
+            "route_id": routes["route_id"].to_numpy()[trip_patterns],
+            "service_id": "weekdays",
+            "trip_id": trip_ids,
+            "direction_id": 0,
+            "shape_id": ["s{!s}".format(i) for i in trip_patterns],
+        }
+    )
+
+    departures = np.repeat(6 * 3600 + 600 * np.tile(np.arange(m), num_patterns), k)
+    seconds = departures + 60 * np.tile(np.arange(k), num_patterns * m)
+    times = [
+        "{:02d}:{:02d}:{:02d}".format(s // 3600, s // 60 % 60, s % 60) for s in seconds
+    ]
+    stop_times = pd.DataFrame(
+        {
+            "trip_id": np.repeat(trip_ids, k),
+            "arrival_time": times,
+            "departure_time": times,
+            "stop_id": stop_ids.reshape(num_patterns, k)[trip_patterns].ravel(),
+            "stop_sequence": np.tile(np.arange(k), num_patterns * m),
+            "shape_dist_traveled": dists[:, rows][trip_patterns].ravel(),
+        }
+    )
+
+    days = ["monday", "tuesday", "wednesday", "thursday", "friday"]
+    calendar = pd.DataFrame(
+        {
+            "service_id": ["weekdays"],
+            **{day: [1] for day in days},
+            "saturday": [0],
+            "sunday": [0],
+            "start_date": ["20260101"],
+            "end_date": ["20261231"],
+        }
+    )
+
+    agency = pd.DataFrame(
+        {
+            "agency_name": ["Synthetic"],
+            "agency_url": ["https://example.com"],
+            "agency_timezone": ["Pacific/Auckland"],
+        }
+    )
+
+    return gk.Feed(
+        dist_units="km",
+        agency=agency,
+        stops=stops,
+        routes=routes,
+        trips=trips,
+        stop_times=stop_times,
+        calendar=calendar,
+        shapes=shapes,
+    )
@@ -0,0 +1,119 @@
+import json
+
+import numpy as np
+import pytest
+import requests
+
+from gtfs_map_matcher import *
+from load_test import run_load_test
+
+
+@pytest.fixture(scope="module")
+def osrm_response(feed):
+    """
+    A Requests response of OSRM matching all the shape points of the feed.
+    """
+    geometries = [
+        encode_polyline(group[["shape_pt_lon", "shape_pt_lat"]].to_numpy(), 6)
+        for __, group in feed.shapes.groupby("shape_id")
+    ]
+    response = requests.Response()
+    response.status_code = 200
+    response._content = json.dumps(
+        {"code": "Ok", "matchings": [{"geometry": g} for g in geometries]}
+    ).encode()
+    return response
+
+
+def test_parse_response_osrm(run, feed, osrm_response):
+    run(
+        parse_response_osrm,
+        osrm_response,
+        num_items=feed.shapes.shape[0],
+        unit="points",
+    )
+
+
+def test_encode_points_osrm(run, feed):
+    points = feed.shapes[["shape_pt_lon", "shape_pt_lat"]].to_numpy()
+    run(encode_points_osrm, points, num_items=len(points), unit="points")
+
+
+def test_encode_points_osrm_polyline(run, feed):
+    points = feed.shapes[["shape_pt_lon", "shape_pt_lat"]].to_numpy()
+    run(
+        encode_points_osrm,
+        points,
+        "polyline6",
+        num_items=len(points),
+        unit="points",
+    )
+
+
+@pytest.mark.parametrize(
+    "service, options",
+    [
+        ("osrm", {}),
+        ("osrm", {"encoding": "polyline6"}),
+        ("mapbox", {"api_key": "mock"}),
+        ("mapbox", {"api_key": "mock", "http_method": "POST"}),
+        ("google", {"api_key": "mock"}),
+    ],
+)
+def test_match_feed(run, feed, feed_size, server, service, options):
+    mm_feed = run(
+        match_feed,
+        feed,
+        service,
+        url=server.urls[service],
+        scheduler=Scheduler(),
+        rounds=3,
+        num_items=feed_size["num_patterns"],
+        unit="patterns",
+        **options
+    )
+    assert mm_feed.shapes["shape_id"].nunique() == feed_size["num_patterns"]
+
+
+def test_match_feed_faulty_server(benchmark, feed, feed_size):
+    """
+    Match against a server with latency, errors, and a rate limit,
+    retrying the failed requests.
+    """
+    report = benchmark.pedantic(
+        run_load_test,
+        args=(feed, "osrm"),
+        kwargs={
+            "server_options": {
+                "latency": 0.02,
+                "jitter": 0.02,
+                "error_rate": 0.05,
+                "rate_limit": 500,
+            },
+            "scheduler": Scheduler(backoff=0.05),
+        },
+        rounds=1,
+        iterations=1,
+    )
+    benchmark.extra_info.update(report)
+    assert report["num_patterns_lost"] == 0
+
+
+def test_match_feed_segment_store(run, feed, feed_size, osrm_url, tmp_path):
+    """
+    Match a feed whose segments are all stored, as when matching a new
+    version of a feed with the same stops and stop patterns.
+    """
+    store = SegmentStore(tmp_path / "segments.db")
+    match_feed(feed, "osrm", url=osrm_url, segment_store=store)
+    mm_feed = run(
+        match_feed,
+        feed,
+        "osrm",
+        url=osrm_url,
+        segment_store=store,
+        rounds=3,
+        num_items=feed_size["num_patterns"],
+        unit="patterns",
+    )
+    assert mm_feed.shapes["shape_id"].nunique() == feed_size["num_patterns"]
@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+
+from gtfs_map_matcher import *
+
+
+@pytest.fixture(scope="module")
+def stop_dists(feed, feed_size):
+    """
+    The shape distances of the stops of one trip per stop pattern,
+    as concatenated arrays with offsets.
+    """
+    k = feed_size["stops_per_trip"]
+    m = feed_size["trips_per_pattern"]
+    xs = feed.stop_times["shape_dist_traveled"].to_numpy(dtype=float)
+    xs = xs.reshape(-1, m, k)[:, 0].ravel()
+    return xs, np.arange(0, len(xs) + 1, k)
+
+
+def test_get_stop_patterns(run, feed):
+    run(get_stop_patterns, feed, num_items=feed.trips.shape[0], unit="trips")
+
+
+def test_get_stop_patterns_ids(run, feed):
+    run(
+        get_stop_patterns,
+        feed,
+        as_string=False,
+        num_items=feed.trips.shape[0],
+        unit="trips",
+    )
+
+
+def test_read_stop_patterns(run, feed, tmp_path):
+    """
+    Read the stop patterns from a stop times file in chunks of about
+    the number of stop times of 100 trips.
+    """
+    path = tmp_path / "stop_times.txt"
+    feed.stop_times.to_csv(path, index=False)
+    chunksize = 100 * feed.stop_times.shape[0] // feed.trips.shape[0]
+    run(
+        read_stop_patterns,
+        path,
+        feed.trips,
+        chunksize=chunksize,
+        num_items=feed.trips.shape[0],
+        unit="trips",
+    )
+
+
+def test_insert_points_by_num(run, stop_dists):
+    xs, offsets = stop_dists
+    arrays = [xs[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+
+    def f():
+        return [insert_points_by_num(x, 100) for x in arrays]
+
+    run(f, num_items=len(arrays), unit="patterns")
+
+
+def test_insert_points_by_num_batch(run, stop_dists):
+    xs, offsets = stop_dists
+    ns = np.full(len(offsets) - 1, 100)
+    run(insert_points_by_num_batch, xs, offsets, ns, num_items=len(ns), unit="patterns")
+
+
+def test_insert_points_by_dist(run, stop_dists):
+    xs, offsets = stop_dists
+    arrays = [xs[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+
+    def f():
+        return [insert_points_by_dist(x, 0.1) for x in arrays]
+
+    run(f, num_items=len(arrays), unit="patterns")
+
+
+def test_insert_points_by_dist_batch(run, stop_dists):
+    xs, offsets = stop_dists
+    ds = np.full(len(offsets) - 1, 0.1)
+    run(
+        insert_points_by_dist_batch, xs, offsets, ds, num_items=len(ds), unit="patterns"
+    )
+
+
+@pytest.mark.parametrize(
+    "method, value", [("num_points", 100), ("distance", 0.1), ("stop_multiplier", 2)]
+)
+def test_sample_trip_points(run, feed, feed_size, method, value):
+    stop_patterns = get_stop_patterns(feed)
+    run(
+        sample_trip_points,
+        feed,
+        method=method,
+        value=value,
+        stop_patterns=stop_patterns,
+        num_items=feed_size["num_patterns"],
+        unit="patterns",
+    )
+
+
+def test_dedupe_points(run, feed, feed_size):
+    points_and_patterns = sample_trip_points(feed)
+    run(
+        dedupe_points,
+        points_and_patterns,
+        num_items=feed_size["num_patterns"],
+        unit="patterns",
+    )
+
+
+def test_sample_segment_points(run, feed, feed_size):
+    stop_patterns = get_stop_patterns(feed)
+    run(
+        sample_segment_points,
+        feed,
+        stop_patterns=stop_patterns,
+        num_items=feed_size["num_patterns"],
+        unit="patterns",
+    )
@@ -1,5 +1,14 @@
+from .cache import *
+from .shapes import *
+from .scheduler import *
+from .metrics import *
+from .jobs import *
 from .matchers import *
+from .segments import *
+from .local import *
+from .parquet import *
 from .main import *
+from .stop_times import *
 
 
 __version__ = "3.0.1"
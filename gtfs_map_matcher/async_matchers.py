@@ -0,0 +1,389 @@
+"""
+Asyncio versions of the map matching functions in the ``matchers``
+module and of :func:`.main.match_feed`.
+They send requests through one shared HTTPX client with a keep-alive
+connection pool and bound the number of concurrent requests by a
+semaphore, which is cheaper than the thread pool of the synchronous
+functions when matching many patterns against a local server,
+and they can run inside other asyncio applications.
+
+Requires the optional dependency HTTPX,
+e.g. ``poetry add gtfs_map_matcher -E async``.
+"""
+import asyncio
+from functools import partial
+import time
+from typing import Callable, List, Optional
+
+import httpx
+from loguru import logger
+import numpy as np
+import pandas as pd
+
+from . import main
+from .cache import BaseCache
+from .jobs import Job
+from .local import match_with_local
+from .metrics import Metrics
+from .scheduler import Scheduler, get_scheduler, report_failures
+from .segments import SegmentStore
+from .matchers import (
+    MAX_POINTS,
+    URLS,
+    _get_request_builder_google,
+    _get_request_builder_mapbox,
+    _get_request_builder_osrm,
+    _join_chunks,
+    _plan_requests,
+    parse_response_google,
+    parse_response_mapbox,
+    parse_response_osrm,
+)
+
+
+MAX_CONCURRENCY = 50  # Max number of concurrent requests
+TIMEOUT = 60  # Request timeout in seconds
+
+
+def build_client(max_concurrency: int = MAX_CONCURRENCY, **kwargs) -> httpx.AsyncClient:
+    """
+    Return an HTTPX asynchronous client with a connection pool of
+    ``max_concurrency`` keep-alive connections, passing the keyword
+    arguments ``kwargs`` to ``httpx.AsyncClient``.
+    Share it between calls of the functions below to reuse connections,
+    and close it when done, e.g. via ``async with build_client() as client``.
+    """
+    limits = httpx.Limits(
+        max_connections=max_concurrency, max_keepalive_connections=max_concurrency
+    )
+    return httpx.AsyncClient(**dict({"limits": limits, "timeout": TIMEOUT}, **kwargs))
+
+
+async def _match_async(
+    points_and_ids: List[List],
+    service: str,
+    build_request: Callable,
+    parse_response: Callable,
+    params: dict,
+    client: Optional[httpx.AsyncClient] = None,
+    max_concurrency: int = MAX_CONCURRENCY,
+    cache: Optional[BaseCache] = None,
+    max_points: Optional[int] = None,
+    scheduler: Optional[Scheduler] = None,
+    metrics: Optional[Metrics] = None,
+) -> List[List]:
+    """
+    Helper function.
+    Asyncio version of :func:`.matchers._match`, which sends at most
+    ``max_concurrency`` requests at a time through the given HTTPX
+    client, or through a temporary one if no client is given.
+    """
+    if scheduler is None:
+        scheduler = get_scheduler(service)
+    if metrics is None:
+        metrics = Metrics()
+    failures = {}
+    mpoints_by_chunk, chunks_to_request, keys, num_chunks = _plan_requests(
+        points_and_ids, service, params, cache=cache, max_points=max_points
+    )
+    if cache is not None:
+        metrics.record_cache(len(mpoints_by_chunk), len(chunks_to_request))
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def fetch(client, k, chunk):
+        method, url, kwargs = build_request(chunk)
+        for attempt in range(scheduler.max_retries + 1):
+            await asyncio.sleep(scheduler.delay())
+            try:
+                async with semaphore:
+                    start = time.perf_counter()
+                    response = await client.request(method, url, **kwargs)
+                    latency = time.perf_counter() - start
+                error = None
+                metrics.record_response(
+                    response.status_code,
+                    latency,
+                    len(str(response.request.url)) + len(response.request.content),
+                    len(response.content),
+                )
+            except httpx.HTTPError as e:
+                response, error = None, e
+                metrics.record_error()
+
+            if attempt < scheduler.max_retries and scheduler.is_retryable(
+                response, error
+            ):
+                metrics.record_retry()
+                await asyncio.sleep(scheduler.get_backoff(attempt, response))
+                continue
+            break
+
+        mpoints = np.empty((0, 2))
+        if error is None:
+            try:
+                with metrics.time("parsing"):
+                    mpoints = parse_response(response)
+            except ValueError as e:
+                logger.warning(e)
+        if not len(mpoints):
+            id_ = points_and_ids[k[0]][1]
+            failures[id_] = scheduler.get_failure_reason(response, error)
+            metrics.record_dropped(id_, failures[id_])
+        return mpoints
+
+    if client is None:
+        async with build_client(max_concurrency) as client:
+            results = await asyncio.gather(
+                *(fetch(client, k, chunk) for k, chunk in chunks_to_request.items())
+            )
+    else:
+        results = await asyncio.gather(
+            *(fetch(client, k, chunk) for k, chunk in chunks_to_request.items())
+        )
+
+    to_cache = {}
+    for k, mpoints in zip(chunks_to_request, results):
+        if len(mpoints):
+            mpoints_by_chunk[k] = mpoints
+            if cache is not None:
+                to_cache[keys[k]] = mpoints
+
+    if cache is not None:
+        cache.set_many(to_cache)
+        cache.evict()
+    report_failures(failures)
+
+    return _join_chunks(points_and_ids, mpoints_by_chunk, num_chunks)
+
+
+async def match_with_osrm_async(
+    points_and_ids: List[List],
+    url: str = URLS["osrm"],
+    client: Optional[httpx.AsyncClient] = None,
+    max_concurrency: int = MAX_CONCURRENCY,
+    cache: Optional[BaseCache] = None,
+    max_points: Optional[int] = MAX_POINTS["osrm"],
+    scheduler: Optional[Scheduler] = None,
+    metrics: Optional[Metrics] = None,
+    encoding: str = "text",
+    precision: Optional[int] = None,
+    **kwargs
+) -> List[List]:
+    """
+    Asyncio version of :func:`.matchers.match_with_osrm`, which sends
+    at most ``max_concurrency`` requests at a time through the given HTTPX
+    client (e.g. from :func:`build_client`), or through a temporary one
+    if no client is given.
+    """
+    build_request, params = _get_request_builder_osrm(
+        url, encoding=encoding, precision=precision, **kwargs
+    )
+    return await _match_async(
+        points_and_ids,
+        "osrm",
+        build_request,
+        parse_response_osrm,
+        params,
+        client=client,
+        max_concurrency=max_concurrency,
+        cache=cache,
+        max_points=max_points,
+        scheduler=scheduler,
+        metrics=metrics,
+    )
+
+
+async def match_with_mapbox_async(
+    points_and_ids: List[List],
+    api_key: str,
+    client: Optional[httpx.AsyncClient] = None,
+    max_concurrency: int = MAX_CONCURRENCY,
+    cache: Optional[BaseCache] = None,
+    max_points: Optional[int] = MAX_POINTS["mapbox"],
+    scheduler: Optional[Scheduler] = None,
+    metrics: Optional[Metrics] = None,
+    http_method: str = "GET",
+    precision: Optional[int] = None,
+    url: str = URLS["mapbox"],
+    **kwargs
+) -> List[List]:
+    """
+    Asyncio version of :func:`.matchers.match_with_mapbox`, which sends
+    at most ``max_concurrency`` requests at a time through the given HTTPX
+    client (e.g. from :func:`build_client`), or through a temporary one
+    if no client is given.
+    """
+    build_request, params = _get_request_builder_mapbox(
+        api_key, http_method=http_method, precision=precision, url=url, **kwargs
+    )
+    return await _match_async(
+        points_and_ids,
+        "mapbox",
+        build_request,
+        parse_response_mapbox,
+        params,
+        client=client,
+        max_concurrency=max_concurrency,
+        cache=cache,
+        max_points=max_points,
+        scheduler=scheduler,
+        metrics=metrics,
+    )
+
+
+async def match_with_google_async(
+    points_and_ids: List[List],
+    api_key: str,
+    client: Optional[httpx.AsyncClient] = None,
+    max_concurrency: int = MAX_CONCURRENCY,
+    cache: Optional[BaseCache] = None,
+    max_points: Optional[int] = MAX_POINTS["google"],
+    scheduler: Optional[Scheduler] = None,
+    metrics: Optional[Metrics] = None,
+    url: str = URLS["google"],
+) -> List[List]:
+    """
+    Asyncio version of :func:`.matchers.match_with_google`, which sends
+    at most ``max_concurrency`` requests at a time through the given HTTPX
+    client (e.g. from :func:`build_client`), or through a temporary one
+    if no client is given.
+    """
+    build_request, params = _get_request_builder_google(api_key, url)
+    return await _match_async(
+        points_and_ids,
+        "google",
+        build_request,
+        parse_response_google,
+        params,
+        client=client,
+        max_concurrency=max_concurrency,
+        cache=cache,
+        max_points=max_points,
+        scheduler=scheduler,
+        metrics=metrics,
+    )
+
+
+async def match_feed_async(
+    feed: "Feed",
+    service: str,
+    api_key: Optional[str] = None,
+    route_types: List[int] = main.ROAD_ROUTE_TYPES,
+    trip_ids: Optional[List[str]] = None,
+    method: str = "num_points",
+    value: float = 100,
+    prev_feed: Optional["Feed"] = None,
+    prev_mm_feed: Optional["Feed"] = None,
+    workers: Optional[int] = None,
+    shape_dist_traveled: bool = False,
+    dedupe: bool = True,
+    segments: bool = False,
+    segment_store: Optional[SegmentStore] = None,
+    stop_patterns: Optional[pd.DataFrame] = None,
+    metrics: Optional[Metrics] = None,
+    job: Optional[Job] = None,
+    **service_opts
+) -> "Feed":
+    """
+    Asyncio version of :func:`.main.match_feed`, with the same arguments,
+    which matches via the asyncio functions above, passing them the extra
+    keyword arguments ``service_opts``, e.g. ``client`` and
+    ``max_concurrency``.
+    Runs the CPU-bound sampling, local matching, and shapes rebuilding
+    in the default executor so as not to block the event loop.
+    The job (if given) counts and stops the stages as in
+    :func:`.main.match_feed`, except the requests to the web services,
+    which are all sent unless the job is cancelled before matching;
+    cancel the task running this function to stop them.
+    """
+    if service not in main.SERVICES:
+        raise ValueError("Service must be one of {!s}".format(main.SERVICES))
+    if metrics is None:
+        metrics = Metrics()
+    if job is None:
+        job = Job()
+    profile = service_opts.get("url", URLS.get(service, ""))
+
+    # Keep the given stop patterns, which can include trips with stop
+    # times that are not selected
+    all_patterns = stop_patterns
+    loop = asyncio.get_running_loop()
+    (
+        stop_patterns,
+        points_and_ids,
+        mpoints_by_pattern,
+        pieces_by_pattern,
+    ) = await loop.run_in_executor(
+        None,
+        partial(
+            main._prepare_match,
+            feed,
+            route_types,
+            trip_ids,
+            method,
+            value,
+            prev_feed,
+            prev_mm_feed,
+            workers,
+            metrics,
+            job,
+            segments,
+            segment_store,
+            service,
+            profile,
+            all_patterns,
+        ),
+    )
+    if dedupe:
+        points_and_ids, duplicates = main._dedupe_points(points_and_ids)
+    else:
+        duplicates = {}
+
+    # Map match sample points
+    with metrics.time("matching"):
+        if service == "local":
+            mpoints_and_ids = await loop.run_in_executor(
+                None,
+                partial(
+                    match_with_local,
+                    points_and_ids,
+                    workers=workers,
+                    job=job,
+                    **service_opts
+                ),
+            )
+        elif job.is_cancelled():
+            mpoints_and_ids = []
+        elif service == "osrm":
+            mpoints_and_ids = await match_with_osrm_async(
+                points_and_ids, metrics=metrics, **service_opts
+            )
+        elif service == "mapbox":
+            mpoints_and_ids = await match_with_mapbox_async(
+                points_and_ids, api_key, metrics=metrics, **service_opts
+            )
+        else:
+            mpoints_and_ids = await match_with_google_async(
+                points_and_ids, api_key, metrics=metrics, **service_opts
+            )
+
+    return await loop.run_in_executor(
+        None,
+        partial(
+            main._finish_match,
+            feed,
+            stop_patterns,
+            all_patterns,
+            points_and_ids,
+            duplicates,
+            pieces_by_pattern,
+            mpoints_by_pattern,
+            mpoints_and_ids,
+            shape_dist_traveled,
+            segment_store,
+            service,
+            profile,
+            metrics,
+            job,
+        ),
+    )
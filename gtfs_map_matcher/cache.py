@@ -0,0 +1,279 @@
+"""
+Persistent caches of map matching results, so that re-matching an
+updated feed only queries the map matching services for new or changed
+sample points.
+
+A cache is any object with the methods ``get_many(keys)``,
+``set_many(points_by_key)``, and ``evict()`` of :class:`BaseCache`,
+where keys are strings built by :func:`make_cache_key` and points are
+NumPy arrays of shape (n, 2) of longitude-latitude points.
+Subclasses of :class:`BaseCache` need only implement ``get(key)`` and
+``set(key, points)``, but can look up and store many results at once
+more cheaply, as :class:`SQLiteCache` does in one transaction.
+"""
+import hashlib
+import json
+import os
+import pathlib as pl
+import sqlite3
+import time
+from typing import List, Optional
+
+import numpy as np
+
+
+#: Request parameters that hold credentials and so are left out of cache keys
+SECRET_PARAMS = ["access_token", "key"]
+
+#: Max number of parameters per SQLite query
+MAX_QUERY_PARAMS = 500
+
+
+def make_cache_key(
+    service: str, params: dict, points: List[List[float]], precision: int = 6
+) -> str:
+    """
+    Return a hash (hexadecimal string) of the given map matching service
+    name, its request parameters (excluding the ones listed in
+    ``SECRET_PARAMS``), and the given list of longitude-latitude points
+    rounded to ``precision`` decimal places.
+    """
+    params = {k: v for k, v in params.items() if k not in SECRET_PARAMS}
+    header = json.dumps([service, params], sort_keys=True, default=str)
+    points = np.round(np.asarray(points, dtype=float) * 10 ** precision)
+
+    h = hashlib.sha256(header.encode())
+    h.update(points.astype(np.int64).tobytes())
+    return h.hexdigest()
+
+
+def encode_points(points: np.array) -> bytes:
+    """
+    Encode the given NumPy array (or list) of longitude-latitude points
+    as bytes.
+    """
+    return np.asarray(points, dtype="<f8").tobytes()
+
+
+def decode_points(data: bytes) -> np.array:
+    """
+    Inverse of function :func:`encode_points`, which returns a float
+    NumPy array of shape (n, 2).
+    """
+    return np.frombuffer(data, dtype="<f8").reshape(-1, 2).astype(float)
+
+
+class BaseCache:
+    """
+    Base class of map matching caches.
+    Holds at most ``max_size`` results (unlimited if ``None``),
+    discarding the least recently used ones first,
+    and discards results older than ``max_age`` seconds
+    (never if ``None``).
+    """
+
+    def __init__(
+        self, max_size: Optional[int] = None, max_age: Optional[float] = None
+    ):
+        self.max_size = max_size
+        self.max_age = max_age
+
+    def get(self, key: str) -> Optional[np.array]:
+        """
+        Return the points stored under the given key or ``None`` if there are
+        none or they have expired.
+        """
+        raise NotImplementedError
+
+    def set(self, key: str, points: np.array) -> None:
+        """
+        Store the given points under the given key.
+        """
+        raise NotImplementedError
+
+    def get_many(self, keys: List[str]) -> dict:
+        """
+        Return a dictionary of the form key -> points for the given keys
+        that have points stored that have not expired.
+        """
+        found = {}
+        for key in keys:
+            points = self.get(key)
+            if points is not None:
+                found[key] = points
+        return found
+
+    def set_many(self, points_by_key: dict) -> None:
+        """
+        Store the given dictionary of the form key -> points.
+        """
+        for key, points in points_by_key.items():
+            self.set(key, points)
+
+    def evict(self) -> None:
+        """
+        Discard expired results and least recently used results
+        in excess of ``max_size``.
+        """
+        pass
+
+
+class SQLiteCache(BaseCache):
+    """
+    Map matching cache stored in an SQLite database at the given path.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_size: Optional[int] = None,
+        max_age: Optional[float] = None,
+    ):
+        super().__init__(max_size=max_size, max_age=max_age)
+        self.path = pl.Path(path)
+        self.conn = sqlite3.connect(str(self.path))
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, points BLOB, created REAL, accessed REAL)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)"
+            )
+        self.evict()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def set(self, key, points):
+        self.set_many({key: points})
+
+    def get_many(self, keys):
+        keys = list(set(keys))
+        rows = []
+        for i in range(0, len(keys), MAX_QUERY_PARAMS):
+            batch = keys[i : i + MAX_QUERY_PARAMS]
+            rows.extend(
+                self.conn.execute(
+                    "SELECT key, points, created FROM results "
+                    "WHERE key IN ({!s})".format(",".join("?" * len(batch))),
+                    batch,
+                ).fetchall()
+            )
+
+        now = time.time()
+        if self.max_age is not None:
+            rows = [row for row in rows if row[2] >= now - self.max_age]
+
+        # Mark the results found as used in one transaction
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE results SET accessed = ? WHERE key = ?",
+                [(now, key) for key, __, __ in rows],
+            )
+        return {key: decode_points(points) for key, points, __ in rows}
+
+    def set_many(self, points_by_key):
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                [
+                    (key, encode_points(points), now, now)
+                    for key, points in points_by_key.items()
+                ],
+            )
+
+    def evict(self):
+        with self.conn:
+            if self.max_age is not None:
+                self.conn.execute(
+                    "DELETE FROM results WHERE created < ?",
+                    (time.time() - self.max_age,),
+                )
+            if self.max_size is not None:
+                self.conn.execute(
+                    "DELETE FROM results WHERE key NOT IN ("
+                    "SELECT key FROM results ORDER BY accessed DESC LIMIT ?)",
+                    (self.max_size,),
+                )
+
+    def clear(self) -> None:
+        """
+        Discard all results.
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM results")
+
+
+class DirectoryCache(BaseCache):
+    """
+    Map matching cache stored as one file per result in the given
+    directory, which will be created if it does not exist.
+    Each file starts with the time the result was stored, and file
+    modification times track recent use.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_size: Optional[int] = None,
+        max_age: Optional[float] = None,
+    ):
+        super().__init__(max_size=max_size, max_age=max_age)
+        self.path = pl.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.evict()
+
+    def __len__(self):
+        return len(list(self.path.glob("*.bin")))
+
+    def _get_path(self, key: str) -> pl.Path:
+        return self.path / "{!s}.bin".format(key)
+
+    def _is_expired(self, data: bytes) -> bool:
+        created = np.frombuffer(data[:8], dtype="<f8")[0]
+        return self.max_age is not None and created < time.time() - self.max_age
+
+    def get(self, key):
+        path = self._get_path(key)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+
+        if self._is_expired(data):
+            return None
+
+        os.utime(path)
+        return decode_points(data[8:])
+
+    def set(self, key, points):
+        # Write to a temporary file first so that readers never see
+        # partial results
+        path = self._get_path(key)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_bytes(
+            np.array([time.time()], dtype="<f8").tobytes() + encode_points(points)
+        )
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        paths = sorted(
+            self.path.glob("*.bin"), key=lambda p: p.stat().st_mtime, reverse=True
+        )
+        for i, path in enumerate(paths):
+            if (self.max_size is not None and i >= self.max_size) or (
+                self.max_age is not None and self._is_expired(path.read_bytes()[:8])
+            ):
+                path.unlink(missing_ok=True)
+
+    def clear(self) -> None:
+        """
+        Discard all results.
+        """
+        for path in self.path.glob("*.bin"):
+            path.unlink(missing_ok=True)
@@ -0,0 +1,119 @@
+"""
+Progress reporting and cancellation of map matching runs.
+
+:func:`.main.match_feed` and the matchers take a :class:`Job`, which
+counts the stop patterns and requests of the run as it goes, passes
+the counts to a callback on every change, and lets another thread
+cancel the run or bound its duration.
+A cancelled run stops sending requests, shuts down its executor
+without waiting for the requests in flight, and returns the matches
+it got so far.
+
+For example::
+
+    job = Job(callback=print, timeout=600)
+    threading.Timer(60, job.cancel).start()
+    mm_feed = match_feed(feed, "osrm", job=job)
+    if job.reason is not None:
+        print("Stopped early:", job.reason, job.progress)
+
+"""
+import threading
+import time
+from typing import Callable, Optional
+
+
+#: Seconds between checks for cancellation while waiting for responses
+POLL_INTERVAL = 0.1
+
+
+class Job:
+    """
+    Thread-safe handle to a map matching run, with the attribute
+    ``progress``, a dictionary of counts with the keys
+
+    - ``"num_patterns"``: number of stop patterns to match;
+      set by :func:`.main.match_feed`
+    - ``"num_reused"``: number of stop patterns with reused previous
+      matches or stored segments; set by :func:`.main.match_feed`
+    - ``"num_sampled"``: number of stop patterns sampled for matching;
+      set by :func:`.main.match_feed`
+    - ``"num_requests"``: number of requests to send, excluding retries
+      and lists of points (or chunks) found in the cache
+    - ``"num_in_flight"``: number of requests awaiting responses
+    - ``"num_completed"``: number of requests answered with a match
+    - ``"num_failed"``: number of requests that failed after retries
+    - ``"num_matched"``: number of lists of points matched
+
+    If a callback is given, then call it with a copy of ``progress``
+    after every change.
+    If ``timeout`` is given, then cancel the run that many seconds after
+    it starts.
+    The attribute ``reason`` is ``None`` while the run is not cancelled,
+    and ``"cancelled"`` or ``"timeout"`` after.
+    """
+
+    def __init__(
+        self, callback: Optional[Callable] = None, timeout: Optional[float] = None
+    ):
+        self.callback = callback
+        self.timeout = timeout
+        self.deadline = None
+        self.reason = None
+        self.lock = threading.Lock()
+        self.progress = {
+            "num_patterns": 0,
+            "num_reused": 0,
+            "num_sampled": 0,
+            "num_requests": 0,
+            "num_in_flight": 0,
+            "num_completed": 0,
+            "num_failed": 0,
+            "num_matched": 0,
+        }
+
+    def start(self) -> None:
+        """
+        Start the clock of the timeout, if any, unless already started.
+        """
+        with self.lock:
+            if self.timeout is not None and self.deadline is None:
+                self.deadline = time.monotonic() + self.timeout
+
+    def cancel(self, reason: str = "cancelled") -> None:
+        """
+        Cancel the run for the given reason, unless already cancelled.
+        """
+        with self.lock:
+            if self.reason is None:
+                self.reason = reason
+
+    def is_cancelled(self) -> bool:
+        """
+        Return ``True`` if the run is cancelled or past its deadline,
+        and ``False`` otherwise.
+        """
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel("timeout")
+        return self.reason is not None
+
+    def get_time_left(self) -> Optional[float]:
+        """
+        Return the number of seconds left until the deadline,
+        or ``None`` if there is no deadline.
+        """
+        if self.deadline is None:
+            return None
+        return max(0, self.deadline - time.monotonic())
+
+    def update(self, **counts) -> None:
+        """
+        Add the given numbers to the counts of the same names in
+        ``progress``, and call the callback, if any.
+        """
+        with self.lock:
+            for key, n in counts.items():
+                self.progress[key] += n
+            progress = dict(self.progress)
+        if self.callback is not None:
+            self.callback(progress)
@@ -0,0 +1,677 @@
+"""
+An in-process map matcher, which matches points to a road network held
+in memory with a hidden Markov model as in [NK09]_, and so needs no map
+matching service.
+
+The road network is a :class:`RoadGraph`, built from an OpenStreetMap
+XML file, from a list of road polylines, or from its own NumPy arrays
+saved by :meth:`RoadGraph.to_npz`.
+
+.. [NK09] P. Newson and J. Krumm, "Hidden Markov map matching through
+   noise and sparseness", ACM SIGSPATIAL GIS 2009.
+"""
+import heapq
+import xml.etree.ElementTree as ET
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from . import parallel
+from .jobs import Job
+
+
+#: Mean radius of the Earth in meters
+EARTH_RADIUS = 6371000
+
+#: OSM highway types of the roads that buses and cars travel on
+DRIVABLE_HIGHWAYS = [
+    "motorway",
+    "motorway_link",
+    "trunk",
+    "trunk_link",
+    "primary",
+    "primary_link",
+    "secondary",
+    "secondary_link",
+    "tertiary",
+    "tertiary_link",
+    "unclassified",
+    "residential",
+    "living_street",
+    "service",
+    "busway",
+    "road",
+]
+
+CELL_SIZE = 100  # Side length in meters of the cells of the spatial index
+RADIUS = 50  # Max distance in meters from a point to its candidate road positions
+MAX_CANDIDATES = 8  # Max number of candidate road positions per point
+SIGMA = 20  # Standard deviation in meters of the distance from a point to its road
+BETA = 20  # Scale in meters of route length minus straight-line distance
+ROUTE_FACTOR = 4  # Max ratio of route length to straight-line distance
+
+
+def _ragged_arange(counts: np.array) -> np.array:
+    """
+    Helper function.
+    Given a NumPy array of nonnegative integers c_1, c_2, ..., c_r,
+    return the concatenation of the ranges 0, 1, ..., c_i - 1
+    for i = 1, 2, ..., r as a NumPy array.
+    Also used by the ``main`` module, which imports this one.
+    """
+    counts = np.asarray(counts, dtype=int)
+    starts = np.cumsum(counts) - counts
+    return np.arange(counts.sum()) - np.repeat(starts, counts)
+
+
+class RoadGraph:
+    """
+    Directed road network held in NumPy arrays, namely
+
+    - ``node_coords``: float array of shape (n, 2) of the longitude-latitude
+      coordinates of the nodes
+    - ``edges``: integer array of shape (k, 2) of the (start node index,
+      end node index) pairs of the straight road segments,
+      with two edges for each segment of a two-way road
+
+    along with the edge lengths in meters ``edge_lengths``, the outgoing
+    edges of each node in compressed sparse row form, and a grid index of
+    the edges with square cells of side ``cell_size`` meters.
+
+    Distances are computed after projecting coordinates to meters
+    with an equirectangular projection centered at the mean node latitude,
+    which is accurate enough at city scale.
+    """
+
+    def __init__(
+        self, node_coords: np.array, edges: np.array, cell_size: float = CELL_SIZE
+    ):
+        self.node_coords = np.asarray(node_coords, dtype=float).reshape(-1, 2)
+        self.edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        self.cell_size = cell_size
+
+        # Project to meters
+        n = self.node_coords.shape[0]
+        lat = np.radians(self.node_coords[:, 1].mean()) if n else 0
+        self.scale = np.array([np.cos(lat), 1]) * np.pi / 180 * EARTH_RADIUS
+        self.node_xy = self.node_coords * self.scale
+        a = self.node_xy[self.edges[:, 0]]
+        b = self.node_xy[self.edges[:, 1]]
+        self.edge_lengths = np.hypot(*(b - a).T)
+
+        # Index outgoing edges by node
+        self.out_edges = np.argsort(self.edges[:, 0], kind="stable")
+        self.out_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(self.edges[:, 0], minlength=n))]
+        )
+
+        # Index edges by the grid cells their bounding boxes meet
+        lo = np.floor(np.minimum(a, b) / cell_size).astype(np.int64)
+        hi = np.floor(np.maximum(a, b) / cell_size).astype(np.int64)
+        widths = hi[:, 0] - lo[:, 0] + 1
+        counts = widths * (hi[:, 1] - lo[:, 1] + 1)
+        edge_ids = np.repeat(np.arange(self.edges.shape[0]), counts)
+        k = _ragged_arange(counts)
+        keys = self._get_cell_keys(
+            lo[edge_ids, 0] + k % widths[edge_ids],
+            lo[edge_ids, 1] + k // widths[edge_ids],
+        )
+        order = np.argsort(keys, kind="stable")
+        self.cell_keys, starts = np.unique(keys[order], return_index=True)
+        self.cell_offsets = np.append(starts, keys.size)
+        self.cell_edges = edge_ids[order]
+
+        self._lists = None
+
+    def __repr__(self):
+        return "RoadGraph({!s} nodes, {!s} edges)".format(
+            self.node_coords.shape[0], self.edges.shape[0]
+        )
+
+    @staticmethod
+    def _get_cell_keys(ix: np.array, iy: np.array) -> np.array:
+        return (ix << 32) + iy
+
+    @classmethod
+    def from_lines(
+        cls,
+        lines: List[List[List[float]]],
+        oneway: bool = False,
+        precision: int = 7,
+        cell_size: float = CELL_SIZE,
+    ) -> "RoadGraph":
+        """
+        Build a road graph from the given list of roads, each a list of
+        longitude-latitude points, where roads meet at points whose
+        coordinates agree to ``precision`` decimal places.
+        The roads are one-way, in the direction of their points, if
+        ``oneway``, which can also be a list of Booleans, one per road.
+        """
+        lines = [np.asarray(line, dtype=float).reshape(-1, 2) for line in lines]
+        counts = np.array([line.shape[0] for line in lines], dtype=np.int64)
+        coords = np.concatenate(lines) if lines else np.empty((0, 2))
+        keys = np.round(coords * 10 ** precision).astype(np.int64)
+        __, first, nodes = np.unique(
+            keys, axis=0, return_index=True, return_inverse=True
+        )
+        directions = np.broadcast_to(np.asarray(oneway, dtype=int), counts.shape)
+        return cls(
+            coords[first],
+            cls._get_edges(nodes.ravel(), counts, directions),
+            cell_size=cell_size,
+        )
+
+    @classmethod
+    def from_osm(
+        cls,
+        path: str,
+        highway_types: List[str] = DRIVABLE_HIGHWAYS,
+        cell_size: float = CELL_SIZE,
+    ) -> "RoadGraph":
+        """
+        Build a road graph from the OSM ways with the given highway types
+        in the OpenStreetMap XML file at the given path, respecting their
+        one-way tags.
+        """
+        coords_by_id = {}
+        ways = []
+        directions = []
+        for __, elem in ET.iterparse(str(path)):
+            if elem.tag == "node":
+                coords_by_id[elem.get("id")] = (
+                    float(elem.get("lon")),
+                    float(elem.get("lat")),
+                )
+            elif elem.tag == "way":
+                tags = {t.get("k"): t.get("v") for t in elem.iter("tag")}
+                highway = tags.get("highway")
+                if highway in highway_types:
+                    oneway = tags.get("oneway")
+                    if oneway is None and (
+                        highway == "motorway"
+                        or tags.get("junction") in ["roundabout", "circular"]
+                    ):
+                        oneway = "yes"
+                    ways.append([nd.get("ref") for nd in elem.iter("nd")])
+                    directions.append(
+                        1
+                        if oneway in ["yes", "true", "1"]
+                        else -1
+                        if oneway in ["-1", "reverse"]
+                        else 0
+                    )
+            else:
+                continue
+            elem.clear()
+
+        ways = [[ref for ref in way if ref in coords_by_id] for way in ways]
+        refs = [ref for way in ways for ref in way]
+        ids, nodes = np.unique(np.array(refs, dtype=str), return_inverse=True)
+        return cls(
+            np.array([coords_by_id[i] for i in ids], dtype=float),
+            cls._get_edges(
+                nodes.ravel(),
+                np.array([len(way) for way in ways], dtype=np.int64),
+                np.array(directions, dtype=int),
+            ),
+            cell_size=cell_size,
+        )
+
+    @staticmethod
+    def _get_edges(nodes: np.array, counts: np.array, directions: np.array) -> np.array:
+        """
+        Helper function.
+        Given a flat NumPy array of node indices that concatenates
+        roads of the given lengths, and an array of road directions
+        (1 for one-way, -1 for reverse one-way, 0 for two-way),
+        return the array of distinct edges of the roads, skipping self-loops.
+        """
+        u = nodes[:-1]
+        v = nodes[1:]
+        line_ids = np.repeat(np.arange(counts.size), counts)[:-1]
+        # Drop pairs that span two roads
+        keep = np.ones(u.size, dtype=bool)
+        keep[np.cumsum(counts)[:-1] - 1] = False
+        keep &= u != v
+        u, v, d = u[keep], v[keep], directions[line_ids[keep]]
+        forward = np.column_stack([u, v])[d >= 0]
+        backward = np.column_stack([v, u])[d <= 0]
+        return np.unique(np.concatenate([forward, backward]).astype(np.int64), axis=0)
+
+    def to_npz(self, path: str) -> None:
+        """
+        Save the node coordinates and edges of this graph to a NumPy
+        ``.npz`` file at the given path.
+        """
+        np.savez_compressed(
+            path,
+            node_coords=self.node_coords,
+            edges=self.edges,
+            cell_size=self.cell_size,
+        )
+
+    @classmethod
+    def from_npz(cls, path: str) -> "RoadGraph":
+        """
+        Inverse of method :meth:`to_npz`.
+        """
+        with np.load(path) as data:
+            return cls(
+                data["node_coords"], data["edges"], cell_size=float(data["cell_size"])
+            )
+
+    def _get_arrays(self) -> dict:
+        """
+        Helper function.
+        Return a dictionary of all the arrays of this graph,
+        from which :meth:`_from_arrays` rebuilds it without recomputing
+        anything, e.g. in another process.
+        """
+        return {
+            name: np.asarray(getattr(self, name))
+            for name in [
+                "node_coords",
+                "edges",
+                "cell_size",
+                "scale",
+                "node_xy",
+                "edge_lengths",
+                "out_edges",
+                "out_offsets",
+                "cell_keys",
+                "cell_offsets",
+                "cell_edges",
+            ]
+        }
+
+    @classmethod
+    def _from_arrays(cls, arrays: dict) -> "RoadGraph":
+        """
+        Helper function.
+        Inverse of method :meth:`_get_arrays`.
+        """
+        graph = cls.__new__(cls)
+        for name, array in arrays.items():
+            setattr(graph, name, array)
+        graph.cell_size = float(arrays["cell_size"])
+        graph._lists = None
+        return graph
+
+    def get_candidates(
+        self,
+        points: List[List[float]],
+        radius: float = RADIUS,
+        max_candidates: int = MAX_CANDIDATES,
+    ) -> Tuple[np.array, np.array, np.array, np.array]:
+        """
+        Given a list of longitude-latitude points, find the nearest
+        position on each edge within ``radius`` meters of each point,
+        and keep at most the ``max_candidates`` nearest ones per point.
+        Return the NumPy arrays
+
+        - point indices
+        - edge indices
+        - fractions of the way along the edges
+        - distances in meters from the points
+
+        sorted by point index and then by distance.
+        """
+        xy = np.asarray(points, dtype=float).reshape(-1, 2) * self.scale
+        empty = np.array([], dtype=np.int64)
+        if not self.cell_keys.size or not xy.size:
+            return empty, empty, np.array([]), np.array([])
+
+        # Look up the edges in the cells within radius of each point
+        r = int(np.ceil(radius / self.cell_size))
+        cells = np.floor(xy / self.cell_size).astype(np.int64)
+        offsets = np.arange(-r, r + 1)
+        dx, dy = [c.ravel() for c in np.meshgrid(offsets, offsets)]
+        keys = self._get_cell_keys(cells[:, [0]] + dx, cells[:, [1]] + dy).ravel()
+        i = np.searchsorted(self.cell_keys, keys)
+        i = np.minimum(i, self.cell_keys.size - 1)
+        found = self.cell_keys[i] == keys
+        starts = self.cell_offsets[i]
+        counts = np.where(found, self.cell_offsets[i + 1] - starts, 0)
+        point_ids = np.repeat(np.repeat(np.arange(xy.shape[0]), dx.size), counts)
+        edge_ids = self.cell_edges[np.repeat(starts, counts) + _ragged_arange(counts)]
+        pairs = np.unique(np.column_stack([point_ids, edge_ids]), axis=0)
+        point_ids, edge_ids = pairs[:, 0], pairs[:, 1]
+
+        # Project the points onto the edges
+        p = xy[point_ids]
+        a = self.node_xy[self.edges[edge_ids, 0]]
+        ab = self.node_xy[self.edges[edge_ids, 1]] - a
+        denom = np.einsum("ij,ij->i", ab, ab)
+        fracs = np.divide(
+            np.einsum("ij,ij->i", p - a, ab),
+            denom,
+            out=np.zeros_like(denom),
+            where=denom > 0,
+        ).clip(0, 1)
+        dists = np.hypot(*(a + fracs[:, None] * ab - p).T)
+
+        # Keep the nearest candidates within radius
+        cond = dists <= radius
+        point_ids, edge_ids, fracs, dists = (
+            point_ids[cond],
+            edge_ids[cond],
+            fracs[cond],
+            dists[cond],
+        )
+        order = np.lexsort([dists, point_ids])
+        point_ids, edge_ids, fracs, dists = (
+            point_ids[order],
+            edge_ids[order],
+            fracs[order],
+            dists[order],
+        )
+        __, starts, counts = np.unique(point_ids, return_index=True, return_counts=True)
+        cond = _ragged_arange(counts) < max_candidates
+        return point_ids[cond], edge_ids[cond], fracs[cond], dists[cond]
+
+    def _get_lists(self) -> Tuple[list, list, list, list]:
+        """
+        Helper function.
+        Return the arrays used by :meth:`_get_shortest_paths` as lists,
+        which are faster to index one item at a time.
+        """
+        if self._lists is None:
+            self._lists = (
+                self.out_offsets.tolist(),
+                self.out_edges.tolist(),
+                self.edges[:, 1].tolist(),
+                self.edge_lengths.tolist(),
+            )
+        return self._lists
+
+    def _get_shortest_paths(
+        self, source: int, cutoff: float, targets: Optional[set] = None
+    ) -> Tuple[dict, dict]:
+        """
+        Helper function.
+        Run Dijkstra's algorithm from the given node, stopping at distance
+        ``cutoff`` meters or once the shortest paths to all the given
+        target nodes (if any) are found.
+        Return a dictionary of the form node -> distance in meters
+        and a dictionary of the form node -> previous node of its shortest
+        path.
+        """
+        offsets, out_edges, heads, lengths = self._get_lists()
+        dists = {source: 0.0}
+        preds = {}
+        heap = [(0.0, source)]
+        targets = set(targets) if targets is not None else None
+        while heap:
+            d, u = heapq.heappop(heap)
+            if d > dists[u]:
+                continue
+            if targets is not None:
+                targets.discard(u)
+                if not targets:
+                    break
+            for e in out_edges[offsets[u] : offsets[u + 1]]:
+                v = heads[e]
+                dv = d + lengths[e]
+                if dv <= cutoff and dv < dists.get(v, np.inf):
+                    dists[v] = dv
+                    preds[v] = u
+                    heapq.heappush(heap, (dv, v))
+
+        return dists, preds
+
+    def _get_point(self, edge: int, frac: float) -> np.array:
+        """
+        Helper function.
+        Return the longitude-latitude point the given fraction of the way
+        along the given edge.
+        """
+        u, v = self.edges[edge]
+        return (1 - frac) * self.node_coords[u] + frac * self.node_coords[v]
+
+
+def _match_points(
+    graph: RoadGraph,
+    points: List[List[float]],
+    radius: float = RADIUS,
+    max_candidates: int = MAX_CANDIDATES,
+    sigma: float = SIGMA,
+    beta: float = BETA,
+) -> np.array:
+    """
+    Helper function.
+    Match the given list of longitude-latitude points to the given road
+    graph, and return the resulting road path as a NumPy array of shape
+    (n, 2) of longitude-latitude points, which is empty if no point is
+    within ``radius`` meters of a road.
+
+    Model the road positions of the points as the hidden states of
+    a hidden Markov model whose states at each point are the candidate
+    road positions output by :meth:`RoadGraph.get_candidates`,
+    with Gaussian emission probabilities of standard deviation ``sigma``
+    in the distance from the point, and with transition probabilities
+    decaying exponentially at scale ``beta`` in the difference between
+    the route length and the straight-line distance between consecutive
+    points, as in [NK09]_.
+    Find the most likely road positions with the Viterbi algorithm.
+    Skip points without candidates, and where no route joins consecutive
+    points, start a new path and concatenate the paths.
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    point_ids, edge_ids, fracs, dists = graph.get_candidates(
+        points, radius=radius, max_candidates=max_candidates
+    )
+    if not point_ids.size:
+        return np.empty((0, 2))
+
+    # Group candidates by point
+    point_ids, starts = np.unique(point_ids, return_index=True)
+    bounds = np.append(starts, edge_ids.size)
+    layers = [
+        (edge_ids[i:j].tolist(), fracs[i:j].tolist(), -0.5 * (dists[i:j] / sigma) ** 2)
+        for i, j in zip(bounds[:-1], bounds[1:])
+    ]
+    xy = points[point_ids] * graph.scale
+    lengths = graph.edge_lengths.tolist()
+    heads = graph.edges[:, 1].tolist()
+    tails = graph.edges[:, 0].tolist()
+
+    def get_cutoff(k):
+        d = np.hypot(*(xy[k] - xy[k - 1]))
+        return d, ROUTE_FACTOR * d + 2 * radius
+
+    # Run the Viterbi algorithm, splitting the points into runs joined by routes
+    runs = []
+    run_start = 0
+    scores = layers[0][2]
+    backpointers = []
+    for k in range(1, len(layers) + 1):
+        if k < len(layers):
+            edges0, fracs0, __ = layers[k - 1]
+            edges1, fracs1, emissions = layers[k]
+            d, cutoff = get_cutoff(k)
+            routes = np.full((len(edges0), len(edges1)), np.inf)
+            targets = {tails[e1] for e1 in edges1}
+            paths = {}
+            for a, (e0, f0) in enumerate(zip(edges0, fracs0)):
+                if heads[e0] not in paths:
+                    paths[heads[e0]] = graph._get_shortest_paths(
+                        heads[e0], cutoff, targets
+                    )
+                node_dists, __ = paths[heads[e0]]
+                head = (1 - f0) * lengths[e0]
+                for b, (e1, f1) in enumerate(zip(edges1, fracs1)):
+                    if e0 == e1 and f1 >= f0:
+                        routes[a, b] = (f1 - f0) * lengths[e0]
+                    else:
+                        routes[a, b] = (
+                            head
+                            + node_dists.get(tails[e1], np.inf)
+                            + f1 * lengths[e1]
+                        )
+            routes[routes > cutoff] = np.inf
+            totals = scores[:, None] - np.abs(routes - d) / beta
+            best = totals.argmax(axis=0)
+            new_scores = totals[best, np.arange(len(edges1))] + emissions
+            if np.isfinite(new_scores).any():
+                backpointers.append(best)
+                scores = new_scores
+                continue
+
+        # Backtrack through the run ending at point k - 1
+        i = int(scores.argmax())
+        states = [i]
+        for best in reversed(backpointers):
+            i = int(best[i])
+            states.append(i)
+        states.reverse()
+        if len(states) > 1:
+            runs.append((run_start, states))
+        if k < len(layers):
+            run_start = k
+            scores = layers[k][2]
+            backpointers = []
+
+    # Build the road path of each run
+    path = []
+    for run_start, states in runs:
+        candidates = [
+            (layers[run_start + k][0][i], layers[run_start + k][1][i])
+            for k, i in enumerate(states)
+        ]
+        e0, f0 = candidates[0]
+        path.append(graph._get_point(e0, f0))
+        for k, (e1, f1) in enumerate(candidates[1:], run_start + 1):
+            if not (e0 == e1 and f1 >= f0):
+                __, cutoff = get_cutoff(k)
+                __, preds = graph._get_shortest_paths(heads[e0], cutoff, [tails[e1]])
+                nodes = [tails[e1]]
+                while nodes[-1] != heads[e0]:
+                    nodes.append(preds[nodes[-1]])
+                path.extend(graph.node_coords[nodes[::-1]])
+            path.append(graph._get_point(e1, f1))
+            e0, f0 = e1, f1
+
+    # Drop repeated points
+    path = np.array(path, dtype=float).reshape(-1, 2)
+    keep = np.ones(len(path), dtype=bool)
+    keep[1:] = (np.diff(path, axis=0) != 0).any(axis=1)
+    return path[keep]
+
+
+#: Road graphs attached to by this process, by shared memory description
+_graphs = {}
+
+
+def _match_shard(spec: dict, points_and_ids: List[List], options: dict) -> List[List]:
+    """
+    Helper function.
+    Process pool version of :func:`match_with_local`, which takes the
+    road graph as the attribute ``spec`` of a
+    :class:`.parallel.SharedArrays` instance of its arrays,
+    and the keyword arguments ``options``.
+    """
+    key = repr(sorted(spec.items()))
+    if key not in _graphs:
+        _graphs[key] = RoadGraph._from_arrays(parallel.attach_arrays(spec))
+    return match_with_local(points_and_ids, _graphs[key], **options)
+
+
+def iter_match_local(
+    points_and_ids: List[List],
+    graph: RoadGraph,
+    radius: float = RADIUS,
+    max_candidates: int = MAX_CANDIDATES,
+    sigma: float = SIGMA,
+    beta: float = BETA,
+    workers: Optional[int] = None,
+    job: Optional[Job] = None,
+) -> Iterator[Tuple[np.array, str]]:
+    """
+    Generator version of :func:`match_with_local`.
+    With workers, yield the results of each shard of ``points_and_ids``
+    once the shard is done, in order.
+    """
+    options = {
+        "radius": radius,
+        "max_candidates": max_candidates,
+        "sigma": sigma,
+        "beta": beta,
+    }
+    if job is None:
+        job = Job()
+    job.start()
+    executor = parallel.get_executor(workers)
+    if executor is None:
+        for points, id_ in points_and_ids:
+            if job.is_cancelled():
+                return
+            mpoints = _match_points(graph, points, **options)
+            if len(mpoints):
+                job.update(num_matched=1)
+                yield mpoints, id_
+        return
+
+    shards = parallel.split_balanced(
+        [len(points) for points, __ in points_and_ids], 4 * workers
+    )
+    with parallel.SharedArrays(graph._get_arrays()) as shared, executor:
+        futures = [
+            executor.submit(_match_shard, shared.spec, points_and_ids[a:b], options)
+            for a, b in shards
+        ]
+        for future in futures:
+            result = future.result()
+            job.update(num_matched=len(result))
+            yield from result
+            if job.is_cancelled():
+                # Drop the shards not started
+                for future in futures:
+                    future.cancel()
+                executor.shutdown(wait=False)
+                return
+
+
+def match_with_local(
+    points_and_ids: List[List],
+    graph: RoadGraph,
+    radius: float = RADIUS,
+    max_candidates: int = MAX_CANDIDATES,
+    sigma: float = SIGMA,
+    beta: float = BETA,
+    workers: Optional[int] = None,
+    job: Optional[Job] = None,
+) -> List[List]:
+    """
+    Given a list of pairs of the form (list of longitude-latitude points,
+    ID) and a road graph (:class:`RoadGraph` instance), match each list
+    of points to the graph in-process with a hidden Markov model,
+    considering the at most ``max_candidates`` road positions within
+    ``radius`` meters of each point.
+    See the helper function :func:`_match_points` for the model
+    parameters ``sigma`` and ``beta``.
+
+    If ``workers`` is greater than 1, then match in a pool of that many
+    processes, splitting ``points_and_ids`` into shards of about the same
+    number of points and sharing the graph with the processes via
+    shared memory.
+
+    If a :class:`.jobs.Job` instance is given, then count the matches
+    there, and stop matching once the job is cancelled, between lists of
+    points or, with workers, between shards.
+
+    Return a list of pairs of the form (matched points, ID),
+    in the order of ``points_and_ids`` and skipping empty results,
+    like the functions in the ``matchers`` module.
+    """
+    return list(
+        iter_match_local(
+            points_and_ids,
+            graph,
+            radius=radius,
+            max_candidates=max_candidates,
+            sigma=sigma,
+            beta=beta,
+            workers=workers,
+            job=job,
+        )
+    )
@@ -1,11 +1,20 @@
+import collections
+import contextlib
 import os
 import pathlib as pl
-from typing import List, Optional
+from typing import Iterator, List, Optional, Tuple
 
 import pandas as pd
 import numpy as np
+from loguru import logger
+from pandas.api.types import union_categoricals
 
-from . import matchers
+from . import local, matchers, parallel, parquet
+from .jobs import Job
+from .local import _ragged_arange
+from .metrics import Metrics
+from .segments import SegmentStore
+from .shapes import ShapeStore
 
 
 ROOT = pl.Path(os.path.abspath(os.path.dirname(__file__)))
@@ -14,14 +23,22 @@ DATA_DIR = ROOT / "data"
 # GTFS route types of vehicles that travel on the road
 ROAD_ROUTE_TYPES = [0, 3, 5]
 
+# Map matching services supported by :func:`match_feed`
+SERVICES = ["osrm", "mapbox", "google", "local"]
 
-def insert_points_by_num(xs: np.array, n: int) -> np.array:
+# Meters per GTFS distance unit
+METERS_PER_DIST_UNIT = {"ft": 0.3048, "m": 1, "mi": 1609.344, "km": 1000}
+
+# Decimal places of the coordinates compared when deduplicating sample points,
+# about 1 meter
+DEDUPE_PRECISION = 5
+
+
+def _insert_points_by_num_iterative(xs: np.array, n: int) -> np.array:
     """
-    Given a strictly increasing NumPy array ``xs`` of at least two
-    numbers x_1 < x_2 < ... < x_r and a nonnegative integer ``n``,
-    insert into the list ``n`` more numbers between x_1 and x_r
-    in a spread-out way.
-    Return the resulting list as a NumPy array.
+    Helper function.
+    Reference implementation of :func:`insert_points_by_num`, which
+    repeatedly inserts points into the biggest gap of ``xs``.
     """
     while n > 0:
         diffs = np.diff(xs)
@@ -63,6 +80,185 @@ def insert_points_by_num(xs: np.array, n: int) -> np.array:
     return xs
 
 
+def insert_points_by_num_batch(
+    xs: np.array, offsets: np.array, ns: np.array
+) -> Tuple[np.array, np.array]:
+    """
+    Batched version of :func:`insert_points_by_num`.
+    Given a NumPy array ``xs`` that concatenates several arrays as
+    in :func:`insert_points_by_num`, where array i has values
+    ``xs[offsets[i]:offsets[i + 1]]``, and a NumPy array ``ns``
+    of nonnegative integers, one per array, insert ``ns[i]`` more
+    numbers into array i as in :func:`insert_points_by_num`.
+    Return the resulting concatenated arrays as a NumPy array along
+    with their offsets as a NumPy array.
+    """
+    xs = np.asarray(xs, dtype=float)
+    offsets = np.asarray(offsets, dtype=int)
+    ns = np.asarray(ns, dtype=int)
+    num_gaps = max(xs.size - 1, 0)
+
+    # Get the gaps within each array, skipping the gaps between arrays
+    m = np.maximum(np.diff(offsets) - 1, 0)  # Number of gaps per array
+    gaps = np.flatnonzero(np.repeat(m > 0, np.diff(offsets)))
+    gaps = gaps[np.isin(gaps, offsets[1:] - 1, invert=True)]
+    gap_codes = np.repeat(np.arange(ns.size), m)
+    d = xs[gaps + 1] - xs[gaps]
+    n = ns[gap_codes]
+    has_gaps = m > 0
+    D = np.zeros(ns.size)
+    D[has_gaps] = xs[offsets[1:][has_gaps] - 1] - xs[offsets[:-1][has_gaps]]
+    D = D[gap_codes]
+
+    # Allocate points to gaps by the divisor (D'Hondt) method:
+    # the jth point inserted into a gap of size d has priority d/j,
+    # and each array gets its ns[i] points of highest priority,
+    # preferring on ties the gap with fewer points.
+    # That is the same as repeatedly inserting a point into the gap
+    # whose subintervals are biggest.
+    # The nth highest priority of an array lies in [D/(n + m), D/n],
+    # so each gap certainly gets ``base`` points and possibly some of the
+    # ``lo``th to ``hi``th points, which gives about 3m candidates per array.
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lo = np.maximum(1, np.floor(d * n / D)).astype(int)
+        hi = np.floor(d * (n + m[gap_codes]) / D).astype(int) + 1
+    base = lo - 1
+    remaining = ns - np.bincount(gap_codes, weights=base, minlength=ns.size).astype(int)
+    num_cands = hi - lo + 1
+    cand_gaps = np.repeat(np.arange(gaps.size), num_cands)
+    cand_js = lo[cand_gaps] + _ragged_arange(num_cands)
+    cand_codes = gap_codes[cand_gaps]
+    order = np.lexsort((cand_js, -d[cand_gaps] / cand_js, cand_codes))
+    ranks = _ragged_arange(np.bincount(cand_codes, minlength=ns.size))
+    chosen = cand_gaps[order][ranks < remaining[cand_codes[order]]]
+    counts = np.zeros(num_gaps, dtype=int)
+    counts[gaps] = base + np.bincount(chosen, minlength=gaps.size)
+
+    # Fill the output array, placing k evenly spaced points
+    # between x_i and x_{i+1} for a gap i getting k points
+    before = np.concatenate([[0], np.cumsum(counts)])  # Insertions before x_i
+    new_offsets = offsets + before[np.minimum(offsets, num_gaps)]
+    new_offsets[-1] = offsets[-1] + before[-1]
+    new_xs = np.empty(xs.size + before[-1])
+    new_xs[np.arange(xs.size) + before[: xs.size]] = xs
+    i = np.repeat(np.arange(num_gaps), counts)
+    s = _ragged_arange(counts) + 1
+    new_xs[i + before[i] + s] = xs[i] + s * (xs[i + 1] - xs[i]) / (counts[i] + 1)
+
+    return new_xs, new_offsets
+
+
+def insert_points_by_num(
+    xs: np.array, n: int, method: str = "closed_form"
+) -> np.array:
+    """
+    Given a strictly increasing NumPy array ``xs`` of at least two
+    numbers x_1 < x_2 < ... < x_r and a nonnegative integer ``n``,
+    insert into the list ``n`` more numbers between x_1 and x_r
+    in a spread-out way.
+    Return the resulting list as a NumPy array.
+
+    If ``method == 'closed_form'``, then compute the number of points
+    to insert into each gap up front, so that the biggest distance
+    between consecutive numbers is as small as possible, and fill a
+    preallocated array.
+    If ``method == 'iterative'``, then repeatedly insert points into
+    the biggest gap, which is slower and spreads the points out
+    slightly less evenly, but serves as a reference.
+    """
+    if method == "closed_form":
+        return insert_points_by_num_batch(xs, [0, len(xs)], [n])[0]
+    elif method == "iterative":
+        return _insert_points_by_num_iterative(xs, n)
+    else:
+        raise ValueError("Method must be one of ['closed_form', 'iterative']")
+
+
+def insert_points_by_dist_batch(
+    xs: np.array, offsets: np.array, ds: np.array
+) -> Tuple[np.array, np.array]:
+    """
+    Batched version of :func:`insert_points_by_dist`.
+    Given a NumPy array ``xs`` that concatenates several arrays as
+    in :func:`insert_points_by_dist`, where array i has values
+    ``xs[offsets[i]:offsets[i + 1]]``, and a nonnegative float or
+    NumPy array of nonnegative floats ``ds``, one per array,
+    insert points into array i as in :func:`insert_points_by_dist`
+    with distance ``ds[i]``.
+    Return the resulting concatenated arrays as a NumPy array along
+    with their offsets as a NumPy array.
+    Takes time linear in the size of the output.
+    """
+    xs = np.asarray(xs, dtype=float)
+    offsets = np.asarray(offsets, dtype=int)
+    sizes = np.diff(offsets)
+    ds = np.broadcast_to(np.asarray(ds, dtype=float), sizes.shape)
+
+    # Only fill arrays with at least two points and 0 < d < x_r - x_1
+    codes = np.repeat(np.arange(sizes.size), sizes)
+    nonempty = sizes > 0
+    first = np.zeros(sizes.size)
+    last = np.zeros(sizes.size)
+    first[nonempty] = xs[offsets[:-1][nonempty]]
+    last[nonempty] = xs[offsets[1:][nonempty] - 1]
+    valid = (sizes >= 2) & (ds > 0) & (ds < last - first)
+    num_bins = np.zeros(sizes.size, dtype=int)
+    num_bins[valid] = ((last - first)[valid] / ds[valid]).astype(int)
+    bin_offsets = np.concatenate([[0], np.cumsum(num_bins)])
+
+    # Locate each x in the bins [0, d), [d, 2d), ..., [(b - 1)d, x_r) of its
+    # array, where b is the number of bins, as np.digitize would.
+    # Index -1 means before the first bin and index b means at x_r.
+    d = np.where(valid, ds, 1)[codes]
+    b = num_bins[codes]
+    i = np.floor(xs / d)
+    i -= i * d > xs
+    i += (i + 1) * d <= xs
+    i = np.clip(i, -1, b - 1).astype(int)
+    i[xs >= last[codes]] = b[xs >= last[codes]]
+    i[~valid[codes]] = -1
+
+    # Collect the left endpoints of the empty bins
+    in_bins = (i >= 0) & (i < b)
+    x_counts = np.bincount(
+        bin_offsets[codes[in_bins]] + i[in_bins], minlength=bin_offsets[-1]
+    )
+    is_empty = x_counts == 0
+    empty = np.flatnonzero(is_empty)
+    y_codes = np.repeat(np.arange(sizes.size), num_bins)[empty]
+    y_bins = empty - bin_offsets[y_codes]
+    ys = y_bins * ds[y_codes]
+
+    # Merge the xs and ys of each array by computing their output positions
+    y_counts = np.bincount(y_codes, minlength=sizes.size)
+    ys_before = np.concatenate([[0], np.cumsum(y_counts)])
+    new_offsets = offsets + ys_before
+    new_xs = np.empty(xs.size + ys.size)
+
+    # Each x comes after the ys of the empty bins to its left
+    empty_below = np.concatenate([[0], np.cumsum(is_empty)])
+    j = bin_offsets[codes] + np.clip(i, 0, b)
+    new_xs[
+        np.arange(xs.size)
+        + ys_before[codes]
+        + empty_below[j]
+        - empty_below[bin_offsets[codes]]
+    ] = xs
+
+    # Each y comes after the xs to its left, namely those in lower bins
+    x_below = np.concatenate([[0], np.cumsum(x_counts)])
+    num_neg = np.bincount(codes[(i < 0) & valid[codes]], minlength=sizes.size)
+    new_xs[
+        new_offsets[y_codes]
+        + _ragged_arange(y_counts)
+        + num_neg[y_codes]
+        + x_below[empty]
+        - x_below[bin_offsets[y_codes]]
+    ] = ys
+
+    return new_xs, new_offsets
+
+
 def insert_points_by_dist(xs: np.array, d: float) -> np.array:
     """
     Given a strictly increasing NumPy array ``xs`` of at least two
@@ -77,44 +273,181 @@ def insert_points_by_dist(xs: np.array, d: float) -> np.array:
     Return the resulting array, which will have a maximum distance of
     ``d`` between consecutive points.
     """
-    if xs.size < 2 or d >= xs[-1] - xs[0] or d <= 0:
-        return xs
+    return insert_points_by_dist_batch(xs, [0, len(xs)], d)[0]
+
+
+def _hash_sequences(hashes: np.array, counts: np.array) -> np.array:
+    """
+    Helper function.
+    Given a NumPy array of 64-bit unsigned integer hashes that
+    concatenates sequences of hashes of the given positive lengths
+    ``counts``, return a NumPy array of 64-bit unsigned integer hashes
+    of the sequences, one per sequence.
+    Do this by hashing each hash along with its position in its sequence
+    and adding up the results (modulo 2^64) by sequence.
+    """
+    counts = np.asarray(counts, dtype=int)
+    positions = _ragged_arange(counts).astype(np.uint64)
+    hashes = pd.util.hash_array(
+        hashes ^ (positions * np.uint64(0x9E3779B97F4A7C15))
+    )
+    if counts.size:
+        hashes = np.add.reduceat(hashes, np.cumsum(counts) - counts)
+    return pd.util.hash_array(hashes ^ counts.astype(np.uint64))
+
 
-    D = xs[-1] - xs[0]
-    bins = [i * d for i in range(int(D / d))] + [xs[-1]]
-    filled_bins = np.digitize(xs, bins) - 1
-    ys = np.array([i * d for i in range(len(bins)) if i not in filled_bins])
-    return np.sort(np.concatenate([xs, ys]))
+def _is_categorical(column: pd.Series) -> bool:
+    """
+    Helper function.
+    Return True if the given column is categorical, e.g. a
+    dictionary-encoded Arrow column converted to Pandas.
+    """
+    return isinstance(column.dtype, pd.CategoricalDtype)
+
+
+def _hash_ids(ids: pd.Series) -> np.array:
+    """
+    Helper function.
+    Return a NumPy array of 64-bit unsigned integer hashes of the given
+    IDs, hashing only the categories of categorical IDs, such as those
+    read from dictionary-encoded Arrow columns, and taking the hashes
+    by code, so that the hashes do not depend on the encoding.
+    """
+    if _is_categorical(ids):
+        # Append a missing value for the code -1 of missing IDs
+        categories = ids.cat.categories.to_numpy(dtype=object)
+        categories = np.append(categories, np.array([None], dtype=object))
+        return pd.util.hash_array(categories)[ids.cat.codes.to_numpy()]
+    return pd.util.hash_array(ids.to_numpy(dtype=object))
+
+
+def _get_shape_hashes(
+    feed: "Feed", shape_ids: Optional[List[str]] = None
+) -> pd.Series:
+    """
+    Helper function.
+    Given a GTFS feed (GTFSTK Feed instance), return a Series indexed by
+    shape ID with values 64-bit integer hashes of the shapes' coordinates
+    rounded to 6 decimal places, so that two shapes with the same
+    geometry have the same hash, even across feeds.
+    Restrict to the given shape IDs (defaults to all shape IDs).
+    """
+    if feed.shapes is None:
+        return pd.Series(dtype=np.int64)
+
+    s = feed.shapes
+    if shape_ids is not None:
+        s = s[s["shape_id"].isin(shape_ids)]
+
+    codes, index = pd.factorize(s["shape_id"])
+    order = np.lexsort((np.asarray(s["shape_pt_sequence"], dtype=float), codes))
+    coords = np.round(
+        s[["shape_pt_lon", "shape_pt_lat"]].to_numpy(dtype=float)[order] * 10 ** 6
+    ).astype(np.int64)
+    point_hashes = pd.util.hash_array(
+        pd.util.hash_array(coords[:, 0]) ^ coords[:, 1].view(np.uint64)
+    )
+    hashes = _hash_sequences(point_hashes, np.bincount(codes, minlength=len(index)))
+    return pd.Series(hashes.view(np.int64), index=index)
+
+
+def _get_representative_trips(stop_patterns: pd.DataFrame) -> pd.DataFrame:
+    """
+    Helper function.
+    Given the output of :func:`get_stop_patterns`, return the subset
+    of it that has one trip per stop pattern, namely the first trip
+    in the given order with the least shape ID, preferring trips with
+    shapes, so that every subset of the output of
+    :func:`get_stop_patterns` that keeps its order and contains the
+    chosen trips yields the same choice.
+    Insert NaN shape IDs if there is no ``'shape_id'`` column.
+    """
+    t = stop_patterns.copy()
+    if "shape_id" not in t.columns:
+        # Insert NaN shape IDs for convenient processing later
+        t["shape_id"] = np.nan
+    # Sort stably, so that ties keep their order
+    return t.sort_values(
+        ["stop_pattern_id", "shape_id"], kind="stable"
+    ).drop_duplicates("stop_pattern_id")
 
 
 def get_stop_patterns(
-    feed: "Feed", trip_ids: Optional[List[str]] = None, sep: str = "->"
+    feed: "Feed",
+    trip_ids: Optional[List[str]] = None,
+    sep: str = "->",
+    *,
+    as_string: bool = True,
 ) -> pd.DataFrame:
     """
-    Append to the DataFrame``feed.trips`` the additional column
+    Append to the DataFrame``feed.trips`` the additional columns
 
+    - ``'stop_pattern_id'``: integer; a 64-bit hash of the sequence of
+      stop IDs along the trip, which (barring astronomically unlikely
+      hash collisions) is the same for two trips if and only if they
+      have the same stop pattern, even across feeds
     - ``'stop_pattern'``: string; the stop IDs along the
-      trip joined by the separator ``sep``
+      trip joined by the separator ``sep``; only present if
+      ``as_string``
 
     and return the resulting DataFrame.
     Restrict to the given trip IDs (defaults to all trip IDs).
-    """
-    st = feed.stop_times.sort_values(["trip_id", "stop_sequence"])
 
+    The pattern IDs are computed without Python-level loops by
+    factorizing the stop IDs to integers, hashing each distinct stop ID
+    once, and combining the hashes of each trip's stops along with
+    their positions.
+    Building the strings is slower, so on big feeds set
+    ``as_string=False`` if the pattern IDs suffice.
+    Even then, the strings are only built for one trip per stop
+    pattern and copied to the other trips.
+    """
+    st = feed.stop_times
     if trip_ids is not None:
-        st = st[st.trip_id.isin(trip_ids)].copy()
+        st = st[st["trip_id"].isin(trip_ids)]
+
+    return feed.trips.merge(_get_stop_pattern_ids(st, sep if as_string else None))
 
-    def get_pattern(group):
-        return group.stop_id.str.cat(sep=sep)
 
-    f = (
-        st.groupby("trip_id")
-        .apply(get_pattern)
-        .reset_index()
-        .rename(columns={0: "stop_pattern"})
+def _get_stop_pattern_ids(
+    stop_times: pd.DataFrame, sep: Optional[str] = "->"
+) -> pd.DataFrame:
+    """
+    Helper function for :func:`get_stop_patterns`.
+    Given a GTFS stop times table, return a DataFrame with the columns
+    ``'trip_id'``, ``'stop_pattern_id'``, and, unless ``sep`` is ``None``,
+    ``'stop_pattern'``, with one row per trip.
+    """
+    st = stop_times
+
+    # Sort stop times by trip and stop sequence
+    trip_codes, trip_index = pd.factorize(st["trip_id"])
+    stop_codes, stop_index = pd.factorize(st["stop_id"])
+    order = np.lexsort((np.asarray(st["stop_sequence"], dtype=float), trip_codes))
+    trip_codes = trip_codes[order]
+    stop_codes = stop_codes[order]
+
+    # Hash the stop IDs and then the sequences of hashes by trip
+    counts = np.bincount(trip_codes, minlength=len(trip_index))
+    stop_hashes = pd.util.hash_array(stop_index.to_numpy(dtype=object))
+    trip_hashes = _hash_sequences(stop_hashes[stop_codes], counts)
+    f = pd.DataFrame(
+        {"trip_id": trip_index, "stop_pattern_id": trip_hashes.view(np.int64)}
     )
 
-    return feed.trips.merge(f)
+    if sep is not None:
+        # Join the stop IDs of one trip per stop pattern
+        __, reps = np.unique(trip_hashes, return_index=True)
+        rows = np.isin(trip_codes, reps)
+        patterns = (
+            pd.Series(stop_index.to_numpy(dtype=object)[stop_codes[rows]])
+            .groupby(trip_codes[rows])
+            .agg(sep.join)
+        )
+        patterns.index = f["stop_pattern_id"].to_numpy()[patterns.index]
+        f["stop_pattern"] = patterns.reindex(f["stop_pattern_id"]).values
+
+    return f
 
 
 def sample_trip_points(
@@ -122,6 +455,8 @@ def sample_trip_points(
     trip_ids: Optional[List[str]] = None,
     method: str = "num_points",
     value: float = 100,
+    stop_patterns: Optional[pd.DataFrame] = None,
+    workers: Optional[int] = None,
 ) -> List[List]:
     """
     Given a GTFS feed (GTFSTK Feed instance),
@@ -168,6 +503,16 @@ def sample_trip_points(
     of those trips.
     Otherwise, build sample points for every stop pattern.
 
+    If the output of :func:`get_stop_patterns` for the feed is already
+    at hand, then pass it in as ``stop_patterns`` to avoid recomputing
+    it; it may lack the ``'stop_pattern'`` column.
+
+    If ``workers`` is greater than 1, then sample in a pool of that many
+    processes, splitting the stop patterns into shards of about
+    the same number of points and sharing the stop and shape coordinates
+    with the processes via shared memory.
+    The result is the same as without workers.
+
     NOTES:
 
     - In the case of choosing random stops, the choices will be the same
@@ -177,26 +522,55 @@ def sample_trip_points(
       pattern, then they also have the same shape.
 
     """
-    # Seed random number generator for reproducible results
-    np.random.seed(42)
+    if method not in ["distance", "num_points", "stop_multiplier"] or not value > 0:
+        raise ValueError("Invalid method-value combination")
 
-    if trip_ids is None:
-        # Use all trip IDs
-        trip_ids = feed.trips.trip_id
+    patterns, arrays = _get_sampling_arrays(feed, trip_ids, stop_patterns)
+    if not len(patterns):
+        return []
+
+    points, counts = _sample_arrays(arrays, method, value, workers)
+    out_offsets = np.concatenate([[0], np.cumsum(counts)])
+    return [
+        [points[out_offsets[i] : out_offsets[i + 1]].tolist(), pattern]
+        for i, pattern in enumerate(patterns)
+    ]
+
+
+def _get_sampling_arrays(
+    feed: "Feed",
+    trip_ids: Optional[List[str]] = None,
+    stop_patterns: Optional[pd.DataFrame] = None,
+) -> Tuple[pd.Index, dict]:
+    """
+    Helper function for :func:`sample_trip_points`, whose arguments
+    ``feed``, ``trip_ids``, and ``stop_patterns`` it takes.
+    Choose a representative trip for each stop pattern and return a pair
+    of the form
+
+    - Pandas Index of the stop patterns
+    - dictionary of NumPy arrays describing the stop patterns and their
+      stops and shapes, as taken by :func:`_sample_points`, with the stops
+      grouped contiguously by stop pattern in the order of the index
+      and the extra array ``"stop_hashes"`` of 64-bit hashes of their
+      stop IDs
+
+    """
+    # Random number generator with a fixed seed for reproducible results
+    rng = np.random.default_rng(42)
 
     # Get stop patterns and choose a representative trip for each one
-    t = get_stop_patterns(feed)
-    t = t[t["trip_id"].isin(trip_ids)].copy()
-    if "shape_id" not in t.columns:
-        # Insert NaN shape IDs for convenient processing later
-        t["shape_id"] = np.nan
-    t = (
-        t.sort_values(["stop_pattern", "shape_id"])
-        .groupby("stop_pattern")
-        .agg("first")
-        .reset_index()
-    )
+    if stop_patterns is None:
+        t = get_stop_patterns(feed, trip_ids, as_string=False)
+    elif trip_ids is not None:
+        t = stop_patterns[stop_patterns["trip_id"].isin(trip_ids)]
+    else:
+        t = stop_patterns
+
+    t = _get_representative_trips(t)
     trip_ids = t.trip_id
+    if "stop_pattern" not in t.columns:
+        t = t.merge(get_stop_patterns(feed, trip_ids)[["trip_id", "stop_pattern"]])
 
     # Get stops times for the representative trips
     st = feed.stop_times
@@ -214,136 +588,368 @@ def sample_trip_points(
     if "shape_dist_traveled" not in st:
         st["shape_dist_traveled"] = np.nan
 
-    # Get shape geometries
-    geom_by_shape = feed.build_geometry_by_shape(shape_ids=t.shape_id) or {}
+    # Flatten the stop times into arrays grouped contiguously by stop pattern.
+    # Since the patterns are unique, no computations will be repeated.
+    pattern_codes, patterns = pd.factorize(st["stop_pattern"])
+    if not len(patterns):
+        return patterns, {}
+
+    k = np.bincount(pattern_codes)  # Number of stops per pattern
+    starts = np.concatenate([[0], np.cumsum(k)])[:-1]
+    dists = st["shape_dist_traveled"].to_numpy(dtype=float, na_value=np.nan)
+
+    # Get shape coordinates
+    shape_ids = st["shape_id"].to_numpy(dtype=object)[starts]
+    shapes = ShapeStore.from_feed(feed, shape_ids)
+    shape_codes = shapes.get_codes(shape_ids)
+
+    # A pattern can use its shape if the shape exists and all the
+    # pattern's stop distances are present.
+    # Scale distances to interval [0, 1] to avoid changing coordinate systems.
+    D = np.fmax.reduceat(dists, starts)
+    usable = (
+        (shape_codes >= 0)
+        & np.logical_and.reduceat(~np.isnan(dists), starts)
+        & (D > 0)
+    )
+    arrays = {
+        "k": k,
+        "stop_coords": st[["stop_lon", "stop_lat"]].to_numpy(dtype=float),
+        "stop_hashes": _hash_ids(st["stop_id"]),
+        "dists": dists,
+        "keys": rng.random(len(dists)),
+        "D": D,
+        "usable": usable,
+        "shape_codes": shape_codes,
+        "shape_coords": shapes.coords,
+        "shape_offsets": shapes.offsets,
+        "shape_lengths": shapes.lengths,
+    }
+    return patterns, arrays
+
+
+def _sample_arrays(
+    arrays: dict, method: str, value: float, workers: Optional[int] = None
+) -> Tuple[np.array, np.array]:
+    """
+    Helper function for :func:`sample_trip_points`.
+    Given the output arrays of :func:`_get_sampling_arrays`, return the
+    output of :func:`_sample_points` for all the stop patterns,
+    sampled in this process or in balanced shards of stop patterns in
+    a pool of ``workers`` processes, with the arrays in shared memory.
+    """
+    executor = parallel.get_executor(workers)
+    if executor is None:
+        return _sample_points(arrays, method, value)
+
+    k = arrays["k"]
+    if method == "distance":
+        weights = k + np.where(arrays["usable"], arrays["D"] / value, 0)
+    elif method == "num_points":
+        weights = np.maximum(k, value)
+    else:
+        weights = (1 + value) * k
+    shards = parallel.split_balanced(weights, 4 * workers)
+    with parallel.SharedArrays(arrays) as shared, executor:
+        results = list(
+            executor.map(
+                _sample_shard,
+                *zip(*[(shared.spec, method, value, a, b) for a, b in shards]),
+            )
+        )
+    return (
+        np.concatenate([r[0] for r in results]),
+        np.concatenate([r[1] for r in results]),
+    )
+
 
-    # Build dict stop pattern -> list of (lon, lat) sample points.
-    # Since it contains unique stop patterns, no computations will be repeated.
-    points_and_patterns = []
-    if method == "distance" and value > 0:
+def _sample_points(
+    arrays: dict,
+    method: str,
+    value: float,
+    start: int = 0,
+    stop: Optional[int] = None,
+) -> Tuple[np.array, np.array]:
+    """
+    Helper function for :func:`sample_trip_points`, whose arguments
+    ``method`` and ``value`` it takes.
+    Given the dictionary ``arrays`` of NumPy arrays built there,
+    describing stop patterns and their stops and shapes,
+    sample the points of the stop patterns with indices in the range
+    from ``start`` to ``stop`` (defaults to the last pattern).
+    The value can also be a NumPy array of one value per stop pattern.
+    With method ``'distance'``, insert points at multiples of the value
+    from the optional array ``arrays["origins"]`` of normalized
+    distances, one per stop pattern, instead of from 0.
+    Return a NumPy array of the sample points of those patterns
+    concatenated, and a NumPy array of the numbers of points per pattern.
+    """
+    k_all = arrays["k"]
+    if stop is None:
+        stop = len(k_all)
+    row_start, row_stop = k_all[:start].sum(), k_all[:stop].sum()
+    k = k_all[start:stop]
+    num_patterns = len(k)
+    pattern_codes = np.repeat(np.arange(num_patterns), k)
+    offsets = np.concatenate([[0], np.cumsum(k)])
+    starts = offsets[:-1]
+    stop_coords = arrays["stop_coords"][row_start:row_stop]
+    dists = arrays["dists"][row_start:row_stop]
+    D = arrays["D"][start:stop]
+    usable = arrays["usable"][start:stop]
+    shape_codes = arrays["shape_codes"][start:stop]
+    if np.ndim(value):
+        value = np.asarray(value)[start:stop]
+
+    # For each pattern, either sample normalized distances along its shape
+    # (collected in ``fracs`` with ``frac_counts`` per pattern)
+    # or choose some of its stops (flagged in ``chosen``)
+    frac_counts = np.zeros(num_patterns, dtype=int)
+    if method == "distance":
         # Use stop points and insert more points by distance
-        d = value
-        for pattern, group in st.groupby("stop_pattern"):
-            shape_id = group["shape_id"].iat[0]
-            if (shape_id in geom_by_shape) and group[
-                "shape_dist_traveled"
-            ].notnull().all():
-                # Scale distances to interval [0, 1] to avoid changing
-                # coordinate systems.
-                D = group["shape_dist_traveled"].max()
-                dists = group["shape_dist_traveled"].values / D
-                new_dists = insert_points_by_dist(dists, d / D)
-                geom = geom_by_shape[shape_id]
-                points = [
-                    list(geom.interpolate(x, normalized=True).coords[0])
-                    for x in new_dists
-                ]
-            else:
-                # Best can do is use the stop points
-                points = group[["stop_lon", "stop_lat"]].values.tolist()
-
-            points_and_patterns.append([points, pattern])
-
-    elif method == "num_points" and value > 0:
-        # Use stop points and insert more points by number
-        n = value
-        for pattern, group in st.groupby("stop_pattern"):
-            shape_id = group["shape_id"].iat[0]
-            k = group.shape[0]  # Number of stops along trip
-            if (
-                k < n
-                and (shape_id in geom_by_shape)
-                and group["shape_dist_traveled"].notnull().all()
-            ):
-                # Scale distances to interval [0, 1] to avoid changing
-                # coordinate systems.
-                D = group["shape_dist_traveled"].max()
-                dists = group["shape_dist_traveled"].values / D
-                new_dists = insert_points_by_num(dists, n - k)
-                geom = geom_by_shape[shape_id]
-                points = [
-                    list(geom.interpolate(d, normalized=True).coords[0])
-                    for d in new_dists
-                ]
-            elif k > n:
-                # Use n stop points only
-                if n == 0:
-                    points = []
-                elif n == 1:
-                    # First stop
-                    points = group[["stop_lon", "stop_lat"]].iloc[0].values.tolist()
-                elif n == 2:
-                    # First and last stop
-                    ix = [0, k - 1]
-                    points = group[["stop_lon", "stop_lat"]].iloc[ix].values.tolist()
-                else:
-                    # First, last, and n - 2 random stops
-                    ix = np.concatenate(
-                        [
-                            [0, k - 1],
-                            np.random.choice(range(1, k - 1), n - 2, replace=False),
-                        ]
-                    )
-                    ix = sorted(ix)
-                    points = group[["stop_lon", "stop_lat"]].iloc[ix].values.tolist()
-            else:
-                # Best can do is use the stop points
-                points = group[["stop_lon", "stop_lat"]].values.tolist()
-
-            points_and_patterns.append([points, pattern])
-
-    elif method == "stop_multiplier" and value > 0:
-        m = value
-        for pattern, group in st.groupby("stop_pattern"):
-            shape_id = group["shape_id"].iat[0]
-            k = group.shape[0]  # Number of stops along trip
-            n = int(m * k)
-            if (
-                k < n
-                and (shape_id in geom_by_shape)
-                and group["shape_dist_traveled"].notnull().all()
-            ):
-                # Scale distances to interval [0, 1] to avoid changing
-                # coordinate systems.
-                D = group["shape_dist_traveled"].max()
-                dists = group["shape_dist_traveled"].values / D
-                new_dists = insert_points_by_num(dists, n - k)
-                geom = geom_by_shape[shape_id]
-                points = [
-                    list(geom.interpolate(d, normalized=True).coords[0]) + [d]
-                    for d in new_dists
-                ]
-            elif k > n:
-                # Use n stop points only
-                if n == 0:
-                    points = []
-                elif n == 1:
-                    # First stop
-                    points = group[["stop_lon", "stop_lat"]].iloc[0].values.tolist()
-                elif n == 2:
-                    # First and last stop
-                    ix = [0, k - 1]
-                    points = group[["stop_lon", "stop_lat"]].iloc[ix].values.tolist()
-                else:
-                    # First, last, and n - 2 random stops
-                    ix = np.concatenate(
-                        [
-                            [0, k - 1],
-                            np.random.choice(range(1, k - 1), n - 2, replace=False),
-                        ]
-                    )
-                    ix = sorted(ix)
-                    points = group[["stop_lon", "stop_lat"]].iloc[ix].values.tolist()
-            else:
-                # Best can do is use the stop points
-                points = group[["stop_lon", "stop_lat"]].values.tolist()
-
-            points_and_patterns.append([points, pattern])
+        d = np.broadcast_to(value, num_patterns)
+        use_shape = usable
+        chosen = np.repeat(~use_shape, k)
+        rows = np.repeat(use_shape, k)
+        # Measure from the origins of the patterns, if given,
+        # since the bins of the points inserted start at 0
+        origins = arrays.get("origins", np.zeros(len(k_all)))[start:stop]
+        fracs, frac_offsets = insert_points_by_dist_batch(
+            dists[rows] / np.repeat(D, k)[rows] - np.repeat(origins, k)[rows],
+            np.concatenate([[0], np.cumsum(k[use_shape])]),
+            d[use_shape] / D[use_shape],
+        )
+        frac_counts[use_shape] = np.diff(frac_offsets)
+        fracs += np.repeat(origins[use_shape], frac_counts[use_shape])
 
     else:
+        if method == "num_points":
+            n = np.broadcast_to(np.asarray(value).astype(int), num_patterns)
+        else:
+            # Set n = int(m*k)
+            n = (value * k).astype(int)
+
+        # Use stop points and insert more points by number
+        use_shape = (k < n) & usable
+        chosen = np.repeat(~use_shape & (k <= n), k)
+        rows = np.repeat(use_shape, k)
+        fracs, frac_offsets = insert_points_by_num_batch(
+            dists[rows] / np.repeat(D, k)[rows],
+            np.concatenate([[0], np.cumsum(k[use_shape])]),
+            (n - k)[use_shape],
+        )
+        frac_counts[use_shape] = np.diff(frac_offsets)
+
+        # Use n stop points only for patterns with k > n stops, namely
+        # no points (n=0); the first stop (n=1); the first and last stop (n=2);
+        # the first, last, and n - 2 random stops (n > 2).
+        # Do this by ranking stops within each pattern by random keys,
+        # forcing the first stop to rank first and the last stop second.
+        rows = np.flatnonzero(np.repeat(k > n, k))
+        if rows.size:
+            row_codes = pattern_codes[rows]
+            keys = arrays["keys"][row_start:row_stop][rows]
+            keys[np.isin(rows, offsets[1:] - 1)] = -1
+            keys[np.isin(rows, starts)] = -2
+            order = np.lexsort((keys, row_codes))
+            ranks = np.empty(rows.size, dtype=int)
+            ranks[order] = _ragged_arange(np.unique(row_codes, return_counts=True)[1])
+            chosen[rows[ranks < n[row_codes]]] = True
+
+    # Assemble the sample points of all patterns into one array,
+    # interpolating all the shape points in one pass
+    frac_codes = np.repeat(np.arange(num_patterns), frac_counts)
+    chosen_rows = np.flatnonzero(chosen)
+    chosen_codes = pattern_codes[chosen_rows]
+    stop_counts = np.bincount(chosen_codes, minlength=num_patterns)
+    counts = frac_counts + stop_counts
+    out_offsets = np.concatenate([[0], np.cumsum(counts)])
+    points = np.empty((out_offsets[-1], 2))
+    shapes = ShapeStore(
+        arrays["shape_coords"],
+        arrays["shape_offsets"],
+        lengths=arrays["shape_lengths"],
+    )
+    points[out_offsets[frac_codes] + _ragged_arange(frac_counts)] = shapes.interpolate(
+        shape_codes[frac_codes], fracs, normalized=True
+    )
+    points[out_offsets[chosen_codes] + _ragged_arange(stop_counts)] = stop_coords[
+        chosen_rows
+    ]
+
+    return points, counts
+
+
+def _sample_shard(
+    spec: dict, method: str, value: float, start: int, stop: int
+) -> Tuple[np.array, np.array]:
+    """
+    Helper function.
+    Process pool version of :func:`_sample_points`, which takes the
+    arrays as the attribute ``spec`` of a :class:`.parallel.SharedArrays`
+    instance.
+    """
+    return _sample_points(parallel.attach_arrays(spec), method, value, start, stop)
+
+
+def sample_segment_points(
+    feed: "Feed",
+    trip_ids: Optional[List[str]] = None,
+    method: str = "num_points",
+    value: float = 100,
+    stop_patterns: Optional[pd.DataFrame] = None,
+    workers: Optional[int] = None,
+) -> Tuple[List[List], dict]:
+    """
+    Segment version of :func:`sample_trip_points`, with the same
+    arguments, for matching the stretches that stop patterns share,
+    such as the trunks of branching routes, only once.
+
+    Cut the stop pattern of each representative trip into pieces, namely
+    maximal runs of consecutive stop-to-stop segments that no stop
+    pattern joins, leaves, starts, or ends in the middle of.
+    Then sample the points of each distinct piece as if it were a stop
+    pattern along the shape of the first trip with that piece,
+    except that with method ``'num_points'`` each piece gets a share of
+    ``value`` points proportional to its part of the longest stop pattern
+    with that piece, and at least its stops.
+
+    Return a pair of the form
+
+    - list of pairs of the form (list of (longitude, latitude) sample
+      points along a piece, piece ID), where the piece ID is a 64-bit
+      integer hash of the stop IDs of the piece, which is the same
+      across feeds
+    - dictionary of the form stop pattern -> list of the IDs of its
+      pieces in order, for the stop patterns with at least two stops
+
+    Use :func:`assemble_pieces` to join the matches of the pieces into
+    matches of the stop patterns.
+    """
+    if method not in ["distance", "num_points", "stop_multiplier"] or not value > 0:
         raise ValueError("Invalid method-value combination")
 
-    return points_and_patterns
+    patterns, arrays = _get_sampling_arrays(feed, trip_ids, stop_patterns)
+    if not len(patterns):
+        return [], {}
+
+    # Index the segments from each stop to the next stop of its pattern
+    k = arrays["k"]
+    stop_hashes = arrays["stop_hashes"]
+    pattern_codes = np.repeat(np.arange(len(k)), k)
+    seg_rows = np.flatnonzero(np.diff(pattern_codes) == 0)
+    if not seg_rows.size:
+        return [], {}
+
+    seg_codes, __ = pd.factorize(
+        _hash_sequences(
+            np.column_stack([stop_hashes[seg_rows], stop_hashes[seg_rows + 1]]).ravel(),
+            np.full(seg_rows.size, 2),
+        )
+    )
+    num_segs = seg_codes.max() + 1
+    seg_patterns = pattern_codes[seg_rows]
+    is_first = np.concatenate([[True], np.diff(seg_patterns) != 0])
+    is_last = np.concatenate([np.diff(seg_patterns) != 0, [True]])
+    starts_some = np.bincount(seg_codes[is_first], minlength=num_segs) > 0
+    ends_some = np.bincount(seg_codes[is_last], minlength=num_segs) > 0
+
+    # Keep a transition from a segment to the next one of its pattern
+    # within a piece if every pattern with either segment makes it
+    trans = np.flatnonzero(~is_last)
+    a, b = seg_codes[trans], seg_codes[trans + 1]
+    pairs = np.unique(np.column_stack([a, b]), axis=0)
+    num_succ = np.bincount(pairs[:, 0], minlength=num_segs)
+    num_pred = np.bincount(pairs[:, 1], minlength=num_segs)
+    keep = (num_succ[a] == 1) & ~ends_some[a] & (num_pred[b] == 1) & ~starts_some[b]
+
+    # Cut the patterns into pieces, each with the stops from the start of
+    # its first segment to the end of its last segment
+    new_piece = np.ones(seg_rows.size, dtype=bool)
+    new_piece[trans[keep] + 1] = False
+    first_segs = np.flatnonzero(new_piece)
+    piece_k = np.diff(np.concatenate([first_segs, [seg_rows.size]])) + 1
+    piece_starts = seg_rows[first_segs]
+    piece_patterns = pattern_codes[piece_starts]
+    rows = np.repeat(piece_starts, piece_k) + _ragged_arange(piece_k)
+    piece_ids = _hash_sequences(stop_hashes[rows], piece_k).view(np.int64)
+
+    # Sample the first occurrence of each distinct piece
+    __, reps = np.unique(piece_ids, return_index=True)
+    reps = np.sort(reps)
+    rows = np.repeat(piece_starts[reps], piece_k[reps]) + _ragged_arange(
+        piece_k[reps]
+    )
+    rep_patterns = piece_patterns[reps]
+    piece_arrays = {
+        "k": piece_k[reps],
+        "stop_coords": arrays["stop_coords"][rows],
+        "dists": arrays["dists"][rows],
+        "keys": arrays["keys"][rows],
+        "D": arrays["D"][rep_patterns],
+        "usable": arrays["usable"][rep_patterns],
+        "shape_codes": arrays["shape_codes"][rep_patterns],
+        "shape_coords": arrays["shape_coords"],
+        "shape_offsets": arrays["shape_offsets"],
+        "shape_lengths": arrays["shape_lengths"],
+    }
+    # Measure from the starts of the pieces along their shapes
+    k, dists, D, usable = (piece_arrays[x] for x in ["k", "dists", "D", "usable"])
+    firsts = np.cumsum(k) - k
+    piece_arrays["origins"] = np.zeros(len(k))
+    piece_arrays["origins"][usable] = dists[firsts][usable] / D[usable]
+    if method == "num_points":
+        # Share the points of the longest pattern with each piece
+        max_D = (
+            pd.Series(arrays["D"][piece_patterns])
+            .groupby(piece_ids)
+            .max()
+            .loc[piece_ids[reps]]
+            .to_numpy()
+        )
+        shares = np.zeros(len(k))
+        lengths = dists[firsts + k - 1] - dists[firsts]
+        shares[usable] = lengths[usable] / max_D[usable]
+        value = np.maximum(k, np.round(value * shares)).astype(int)
+
+    points, counts = _sample_arrays(piece_arrays, method, value, workers)
+    out_offsets = np.concatenate([[0], np.cumsum(counts)])
+    points_and_pieces = [
+        [points[out_offsets[i] : out_offsets[i + 1]].tolist(), int(piece_ids[j])]
+        for i, j in enumerate(reps)
+    ]
+
+    # List the pieces of each pattern
+    bounds = np.flatnonzero(np.diff(piece_patterns)) + 1
+    pieces_by_pattern = {
+        patterns[codes[0]]: ids.tolist()
+        for codes, ids in zip(
+            np.split(piece_patterns, bounds), np.split(piece_ids, bounds)
+        )
+    }
+    return points_and_pieces, pieces_by_pattern
+
+
+def assemble_pieces(mpoints_by_piece: dict, pieces_by_pattern: dict) -> dict:
+    """
+    Given a dictionary of the form piece ID -> matched points, e.g.
+    from matching the output of :func:`sample_segment_points`, and
+    a dictionary of the form stop pattern -> list of piece IDs, as output
+    by that function, return a dictionary of the form
+    stop pattern -> NumPy array of the matched points of its pieces
+    joined in order, for the stop patterns whose pieces all matched.
+    """
+    mpoints_by_pattern = {}
+    for pattern, piece_ids in pieces_by_pattern.items():
+        chunks = [mpoints_by_piece.get(piece_id) for piece_id in piece_ids]
+        if all(chunk is not None and len(chunk) for chunk in chunks):
+            mpoints = np.concatenate(chunks)
+            # Drop repeated consecutive points, such as at the joins of pieces
+            keep = np.ones(len(mpoints), dtype=bool)
+            keep[1:] = (mpoints[1:] != mpoints[:-1]).any(axis=1)
+            mpoints_by_pattern[pattern] = mpoints[keep]
+
+    return mpoints_by_pattern
 
 
 def _get_trip_ids(
@@ -361,6 +967,533 @@ def _get_trip_ids(
     return trip_ids
 
 
+def dedupe_points(
+    points_and_ids: List[List], precision: int = DEDUPE_PRECISION
+) -> Tuple[List[List], dict]:
+    """
+    Given a list of pairs of the form (list of longitude-latitude points,
+    ID), such as the output of :func:`sample_trip_points`, group the
+    pairs whose points are equal after rounding their coordinates to
+    ``precision`` decimal places, and return a pair of the form
+
+    - list of the first pair of each group, in the given order
+    - dictionary of the form ID of the first pair of a group -> list of
+      IDs of the other pairs of the group, for the groups of more than
+      one pair
+
+    so that each distinct list of points need only be matched once.
+    """
+    first_by_key = {}
+    unique = []
+    duplicates = collections.defaultdict(list)
+    for points, id_ in points_and_ids:
+        key = np.round(np.asarray(points, dtype=float) * 10**precision)
+        key = key.astype(np.int64).tobytes()
+        if key in first_by_key:
+            duplicates[first_by_key[key]].append(id_)
+        else:
+            first_by_key[key] = id_
+            unique.append((points, id_))
+
+    return unique, dict(duplicates)
+
+
+def _get_reusable_matches(
+    feed: "Feed",
+    stop_patterns: pd.DataFrame,
+    prev_feed: "Feed",
+    prev_mm_feed: "Feed",
+) -> dict:
+    """
+    Helper function.
+    Given a GTFS feed (GTFSTK Feed instance), the output of
+    :func:`get_stop_patterns` for some of its trips, a previous version
+    of the feed, and the output of :func:`match_feed` for that previous
+    version, return a dictionary of the form
+
+    stop pattern -> list of (longitude, latitude) matched points
+
+    for the stop patterns that can reuse their previous matched shapes,
+    namely the patterns that
+
+    - occur in the previous feed and were matched there, that is,
+      have different shapes in the previous feed and its matched version,
+    - have the same shape geometry in both feeds, and
+    - have no stops whose locations changed between the feeds.
+
+    """
+    # Get the stop patterns of both feeds that have the same shape geometry
+    t = _get_representative_trips(stop_patterns)
+    t["shape_hash"] = t["shape_id"].map(_get_shape_hashes(feed, t["shape_id"]))
+    prev_t = _get_representative_trips(
+        get_stop_patterns(prev_feed, as_string=False)
+    ).rename(columns={"shape_id": "prev_shape_id"})
+    prev_shape_ids = prev_t["prev_shape_id"]
+    prev_t["prev_shape_hash"] = prev_shape_ids.map(
+        _get_shape_hashes(prev_feed, prev_shape_ids)
+    )
+    prev_t["prev_mm_shape_hash"] = prev_shape_ids.map(
+        _get_shape_hashes(prev_mm_feed, prev_shape_ids)
+    )
+    t = t.merge(
+        prev_t[
+            [
+                "stop_pattern_id",
+                "prev_shape_id",
+                "prev_shape_hash",
+                "prev_mm_shape_hash",
+            ]
+        ]
+    )
+    t = t[
+        t["prev_mm_shape_hash"].notna()
+        & (t["prev_mm_shape_hash"] != t["prev_shape_hash"])
+        & (t["shape_hash"].fillna(0) == t["prev_shape_hash"].fillna(0))
+    ]
+
+    # Drop the stop patterns with moved stops
+    stops = feed.stops[["stop_id", "stop_lon", "stop_lat"]].merge(
+        prev_feed.stops[["stop_id", "stop_lon", "stop_lat"]],
+        on="stop_id",
+        how="left",
+        suffixes=("", "_prev"),
+    )
+    moved = ~(
+        (np.abs(stops["stop_lon"] - stops["stop_lon_prev"]) <= 1e-6)
+        & (np.abs(stops["stop_lat"] - stops["stop_lat_prev"]) <= 1e-6)
+    )
+    st = feed.stop_times[feed.stop_times["trip_id"].isin(t["trip_id"])]
+    moved_trip_ids = st.loc[
+        st["stop_id"].isin(stops.loc[moved, "stop_id"]), "trip_id"
+    ].unique()
+    t = t[~t["trip_id"].isin(moved_trip_ids)]
+
+    # Get the previous matched points
+    shapes = prev_mm_feed.shapes
+    shapes = shapes[shapes["shape_id"].isin(t["prev_shape_id"])].sort_values(
+        ["shape_id", "shape_pt_sequence"]
+    )
+    points_by_shape = {
+        shape: group[["shape_pt_lon", "shape_pt_lat"]].to_numpy(dtype=float)
+        for shape, group in shapes.groupby("shape_id")
+    }
+    return {
+        pattern: points_by_shape[shape]
+        for pattern, shape in t[["stop_pattern", "prev_shape_id"]].values
+    }
+
+
+def _get_pattern_stops(feed: "Feed", stop_patterns: pd.DataFrame) -> dict:
+    """
+    Helper function.
+    Given a GTFS feed (GTFSTK Feed instance) and the output of
+    :func:`get_stop_patterns` for some of its trips, return a dictionary
+    of the form
+
+    stop pattern -> NumPy array of (longitude, latitude) stop points
+
+    computed from one trip per stop pattern.
+    """
+    t = _get_representative_trips(stop_patterns)[["trip_id", "stop_pattern"]]
+    st = feed.stop_times[feed.stop_times["trip_id"].isin(t["trip_id"])]
+    st = (
+        st[["trip_id", "stop_sequence", "stop_id"]]
+        .merge(t)
+        .merge(feed.stops[["stop_id", "stop_lon", "stop_lat"]])
+        .sort_values(["trip_id", "stop_sequence"])
+    )
+
+    # Split the stop points by trip without grouping
+    __, starts = np.unique(st["trip_id"].to_numpy(), return_index=True)
+    patterns = st["stop_pattern"].to_numpy()[starts]
+    points = st[["stop_lon", "stop_lat"]].to_numpy(dtype=float)
+    return dict(zip(patterns, np.split(points, starts[1:])))
+
+
+def _get_stored_matches(
+    feed: "Feed",
+    stop_patterns: pd.DataFrame,
+    segment_store: SegmentStore,
+    service: str,
+    profile: str,
+) -> dict:
+    """
+    Helper function.
+    Given a GTFS feed (GTFSTK Feed instance), the output of
+    :func:`get_stop_patterns` for some of its trips, a segment store,
+    and a map matching service name and profile, return a dictionary
+    of the form
+
+    stop pattern -> NumPy array of (longitude, latitude) matched points
+
+    for the stop patterns whose segments between consecutive stops are
+    all in the store, joined from those segments.
+    """
+    stops_by_pattern = _get_pattern_stops(feed, stop_patterns)
+    paths = segment_store.get_paths(list(stops_by_pattern.values()), service, profile)
+    return {
+        pattern: mpoints
+        for pattern, mpoints in zip(stops_by_pattern, paths)
+        if mpoints is not None
+    }
+
+
+def _store_matches(
+    stops_by_pattern: dict,
+    mpoints_by_pattern: dict,
+    segment_store: SegmentStore,
+    service: str,
+    profile: str,
+) -> int:
+    """
+    Helper function.
+    Given the output of :func:`_get_pattern_stops`, a dictionary of
+    the form stop pattern -> matched points, a segment store, and a map
+    matching service name and profile, store the segments of the matched
+    stop patterns via :meth:`.segments.SegmentStore.set_paths`, and
+    return the number of stop patterns whose segments were stored.
+    """
+    patterns = [
+        pattern
+        for pattern, mpoints in mpoints_by_pattern.items()
+        if pattern in stops_by_pattern and len(mpoints)
+    ]
+    return sum(
+        segment_store.set_paths(
+            [stops_by_pattern[pattern] for pattern in patterns],
+            [mpoints_by_pattern[pattern] for pattern in patterns],
+            service,
+            profile,
+        )
+    )
+
+
+def _build_shapes(
+    shape_ids: np.array,
+    pattern_codes: np.array,
+    mpoints_list: List[List[List[float]]],
+    dist_units: Optional[str] = None,
+    categorical: bool = False,
+) -> pd.DataFrame:
+    """
+    Helper function.
+    Given a NumPy array of shape IDs, a NumPy array of equal size of
+    indices into the given list of lists of longitude-latitude points,
+    return a GTFS shapes table in which each shape has the points at
+    its index.
+    If distance units (a key of ``METERS_PER_DIST_UNIT``) are given,
+    then also compute a ``shape_dist_traveled`` column in those units
+    with the haversine formula.
+    If ``categorical``, then make the ``shape_id`` column categorical,
+    with the given (unique) shape IDs as categories.
+    Build the columns from concatenated NumPy arrays.
+    """
+    columns = ["shape_id", "shape_pt_sequence", "shape_pt_lon", "shape_pt_lat"]
+    if dist_units is not None:
+        columns.append("shape_dist_traveled")
+    pattern_codes = np.asarray(pattern_codes, dtype=int)
+    if not pattern_codes.size:
+        return pd.DataFrame(columns=columns)
+
+    # Concatenate the points of each list once
+    counts = np.array([len(p) for p in mpoints_list], dtype=int)
+    coords = np.concatenate(
+        [np.asarray(p, dtype=float).reshape(-1, 2) for p in mpoints_list]
+    )
+    starts = np.cumsum(counts) - counts
+
+    # Gather the rows of each shape
+    shape_counts = counts[pattern_codes]
+    seq = _ragged_arange(shape_counts)
+    rows = np.repeat(starts[pattern_codes], shape_counts) + seq
+    if categorical:
+        shape_id = pd.Categorical.from_codes(
+            np.repeat(np.arange(len(shape_counts)), shape_counts),
+            categories=pd.Index(shape_ids),
+        )
+    else:
+        shape_id = np.repeat(np.asarray(shape_ids, dtype=object), shape_counts)
+    f = pd.DataFrame(
+        {
+            "shape_id": shape_id,
+            "shape_pt_sequence": seq,
+            "shape_pt_lon": coords[rows, 0],
+            "shape_pt_lat": coords[rows, 1],
+        }
+    )
+
+    if dist_units is not None:
+        # Compute the distances along each list of points once
+        lon, lat = np.radians(coords).T
+        a = (
+            np.sin(np.diff(lat) / 2) ** 2
+            + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+        )
+        seglens = 2 * local.EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+        seglens = np.concatenate([[0], seglens]) / METERS_PER_DIST_UNIT[dist_units]
+        seglens[starts] = 0
+        cum = np.cumsum(seglens)
+        f["shape_dist_traveled"] = cum[rows] - np.repeat(
+            cum[starts[pattern_codes]], shape_counts
+        )
+
+    return f
+
+
+def _build_matched_feed(
+    feed: "Feed",
+    stop_patterns: pd.DataFrame,
+    mpoints_by_pattern: dict,
+    shape_dist_traveled: bool = False,
+) -> "Feed":
+    """
+    Helper function.
+    Given a GTFS feed (GTFSTK Feed instance), the output of
+    :func:`get_stop_patterns` for some of its trips, and a dictionary
+    of the form stop pattern -> array of (longitude, latitude) matched
+    points, return a new feed in which the shapes of those trips are
+    the matched points of their stop patterns.
+    The shapes of other trips remain unchanged.
+    If ``shape_dist_traveled``, then compute that column for the new
+    shapes in the distance units of the feed.
+    If the shape IDs of the trips or shapes are categorical, then so
+    are those of the new shapes table.
+    """
+    # Each shape gets the points of its last matched stop pattern
+    t = stop_patterns[stop_patterns["stop_pattern"].isin(mpoints_by_pattern)]
+    t = t.drop_duplicates("shape_id", keep="last")
+    categorical = _is_categorical(t["shape_id"]) or (
+        feed.shapes is not None and _is_categorical(feed.shapes["shape_id"])
+    )
+    patterns = list(mpoints_by_pattern)
+    new_shapes = _build_shapes(
+        t["shape_id"].to_numpy(dtype=object),
+        pd.Index(patterns).get_indexer(t["stop_pattern"]),
+        [mpoints_by_pattern[pattern] for pattern in patterns],
+        dist_units=feed.dist_units if shape_dist_traveled else None,
+        categorical=categorical,
+    )
+
+    feed = feed.copy()
+    if feed.shapes is None:
+        feed.shapes = new_shapes
+    else:
+        shapes = feed.shapes
+        shapes = shapes[~shapes["shape_id"].isin(new_shapes["shape_id"])]
+        feed.shapes = pd.concat([shapes, new_shapes], ignore_index=True)
+        if categorical:
+            # Concatenating categoricals with different categories
+            # yields objects, so unite the categories instead
+            old = pd.Categorical(shapes["shape_id"])
+            new = new_shapes["shape_id"].array
+            new = pd.Categorical.from_codes(
+                new.codes, categories=new.categories.astype(old.categories.dtype)
+            )
+            feed.shapes["shape_id"] = union_categoricals([old, new])
+
+    return feed
+
+
+def _dedupe_points(points_and_ids: List[List]) -> Tuple[List[List], dict]:
+    """
+    Helper function for :func:`match_feed`.
+    Apply :func:`dedupe_points` to the given sample points and log
+    the number of calls saved.
+    """
+    points_and_ids, duplicates = dedupe_points(points_and_ids)
+    logger.info(
+        "Matching {!s} lists of sample points equal to others "
+        "once".format(sum(len(v) for v in duplicates.values()))
+    )
+    return points_and_ids, duplicates
+
+
+def _prepare_match(
+    feed: "Feed",
+    route_types: List[int],
+    trip_ids: Optional[List[str]],
+    method: str,
+    value: float,
+    prev_feed: Optional["Feed"] = None,
+    prev_mm_feed: Optional["Feed"] = None,
+    workers: Optional[int] = None,
+    metrics: Optional[Metrics] = None,
+    job: Optional[Job] = None,
+    segments: bool = False,
+    segment_store: Optional[SegmentStore] = None,
+    service: str = "",
+    profile: str = "",
+    stop_patterns: Optional[pd.DataFrame] = None,
+) -> Tuple[pd.DataFrame, List[List], dict, Optional[dict]]:
+    """
+    Helper function for :func:`match_feed`, with the same arguments.
+    Select the trips to match, get their stop patterns, reuse previous
+    matches if possible, join the matches of the stop patterns whose
+    segments are all in the segment store (if any) for the given service
+    and profile, and sample the points of the remaining stop
+    patterns, timing these stages in the given metrics (if any),
+    counting the stop patterns in the given job (if any), and skipping
+    the sampling if the job is cancelled.
+    Return a tuple of the form
+
+    - output of :func:`get_stop_patterns` for the selected trips
+    - output of :func:`sample_trip_points` for the stop patterns to match,
+      or if ``segments``, the sample points of their pieces output by
+      :func:`sample_segment_points`
+    - dictionary of the form stop pattern -> previous matched points,
+      for the stop patterns that reuse previous matches or stored
+      segments
+    - if ``segments``, the dictionary of the form stop pattern -> list of
+      piece IDs output by :func:`sample_segment_points`; else ``None``
+
+    """
+    if metrics is None:
+        metrics = Metrics()
+    if job is None:
+        job = Job()
+    job.start()
+
+    # Select relevant trip IDs and get their stop patterns
+    with metrics.time("stop_patterns"):
+        trip_ids = _get_trip_ids(feed, route_types, trip_ids)
+        if stop_patterns is None:
+            stop_patterns = get_stop_patterns(feed, trip_ids)
+            sampled = stop_patterns
+        else:
+            # Sample the trips of the selected stop patterns that
+            # a feed with stop times for only one trip per stop pattern
+            # has, which need not be selected
+            sampled = stop_patterns
+            stop_patterns = stop_patterns[stop_patterns["trip_id"].isin(trip_ids)]
+            sampled = sampled[
+                sampled["stop_pattern_id"].isin(stop_patterns["stop_pattern_id"])
+            ]
+            trip_ids = sampled["trip_id"]
+    job.update(num_patterns=stop_patterns["stop_pattern_id"].nunique())
+
+    # Reuse previous matches if possible
+    if prev_feed is not None and prev_mm_feed is not None:
+        with metrics.time("reuse"):
+            mpoints_by_pattern = _get_reusable_matches(
+                feed, sampled, prev_feed, prev_mm_feed
+            )
+        logger.info("Reusing {!s} previous matches".format(len(mpoints_by_pattern)))
+        job.update(num_reused=len(mpoints_by_pattern))
+        trip_ids = sampled.loc[
+            lambda x: ~x["stop_pattern"].isin(mpoints_by_pattern), "trip_id"
+        ]
+    else:
+        mpoints_by_pattern = {}
+
+    # Join stored segments if possible
+    if segment_store is not None:
+        with metrics.time("segments"):
+            stored = _get_stored_matches(
+                feed,
+                sampled[~sampled["stop_pattern"].isin(mpoints_by_pattern)],
+                segment_store,
+                service,
+                profile,
+            )
+        logger.info("Joining {!s} matches from stored segments".format(len(stored)))
+        job.update(num_reused=len(stored))
+        mpoints_by_pattern.update(stored)
+        trip_ids = sampled.loc[
+            lambda x: ~x["stop_pattern"].isin(mpoints_by_pattern), "trip_id"
+        ]
+
+    # Get sample points by stop pattern or by piece of stop pattern
+    if job.is_cancelled():
+        return stop_patterns, [], mpoints_by_pattern, {} if segments else None
+
+    with metrics.time("sampling"):
+        sample = sample_segment_points if segments else sample_trip_points
+        points_and_ids = sample(
+            feed,
+            trip_ids,
+            method=method,
+            value=value,
+            stop_patterns=sampled,
+            workers=workers,
+        )
+    if segments:
+        points_and_ids, pieces_by_pattern = points_and_ids
+        job.update(num_sampled=len(pieces_by_pattern))
+    else:
+        pieces_by_pattern = None
+        job.update(num_sampled=len(points_and_ids))
+
+    return stop_patterns, points_and_ids, mpoints_by_pattern, pieces_by_pattern
+
+
+def _finish_match(
+    feed: "Feed",
+    stop_patterns: pd.DataFrame,
+    all_patterns: Optional[pd.DataFrame],
+    points_and_ids: List[List],
+    duplicates: dict,
+    pieces_by_pattern: Optional[dict],
+    mpoints_by_pattern: dict,
+    mpoints_and_ids: List[List],
+    shape_dist_traveled: bool,
+    segment_store: Optional[SegmentStore],
+    service: str,
+    profile: str,
+    metrics: Metrics,
+    job: Job,
+) -> "Feed":
+    """
+    Helper function for :func:`match_feed` and
+    :func:`.async_matchers.match_feed_async`.
+    Given the output of :func:`_prepare_match` and of
+    :func:`_dedupe_points` (or an empty dictionary of duplicates),
+    the given stop patterns ``all_patterns`` (if any), and the
+    matched points of the sample points in the form of a list of pairs
+    (matched points, ID), record the IDs that failed to match,
+    give the duplicates their matches, join the matched pieces,
+    store the segments of the new matches in the segment store (if any),
+    and return the matched feed.
+    """
+    mpoints_by_id = {id_: mpoints for mpoints, id_ in mpoints_and_ids}
+    for __, id_ in points_and_ids:
+        if id_ in mpoints_by_id:
+            mpoints = mpoints_by_id[id_]
+            mpoints_by_id.update({other: mpoints for other in duplicates.get(id_, [])})
+        else:
+            for other in [id_] + duplicates.get(id_, []):
+                metrics.record_dropped(other, job.reason or "no match")
+
+    # Join the matched pieces into matched stop patterns
+    if pieces_by_pattern is not None:
+        mpoints_by_id = assemble_pieces(mpoints_by_id, pieces_by_pattern)
+        for pattern in pieces_by_pattern:
+            if pattern not in mpoints_by_id:
+                metrics.record_dropped(pattern, job.reason or "piece not matched")
+
+    # Store the segments of the new matches
+    if segment_store is not None:
+        with metrics.time("segments"):
+            if all_patterns is None:
+                all_patterns = stop_patterns
+            stops_by_pattern = _get_pattern_stops(
+                feed, all_patterns[all_patterns["stop_pattern"].isin(mpoints_by_id)]
+            )
+            num_stored = _store_matches(
+                stops_by_pattern, mpoints_by_id, segment_store, service, profile
+            )
+            segment_store.evict()
+        logger.info("Storing the segments of {!s} matches".format(num_stored))
+
+    mpoints_by_pattern.update(mpoints_by_id)
+
+    # Create new feed with matched shapes found and old shapes
+    # for the rest of the trips
+    with metrics.time("shapes"):
+        return _build_matched_feed(
+            feed, stop_patterns, mpoints_by_pattern, shape_dist_traveled
+        )
+
+
 def match_feed(
     feed: "Feed",
     service: str,
@@ -369,6 +1502,16 @@ def match_feed(
     trip_ids: Optional[List[str]] = None,
     method: str = "num_points",
     value: float = 100,
+    prev_feed: Optional["Feed"] = None,
+    prev_mm_feed: Optional["Feed"] = None,
+    workers: Optional[int] = None,
+    shape_dist_traveled: bool = False,
+    dedupe: bool = True,
+    segments: bool = False,
+    segment_store: Optional[SegmentStore] = None,
+    stop_patterns: Optional[pd.DataFrame] = None,
+    metrics: Optional[Metrics] = None,
+    job: Optional[Job] = None,
     **service_opts
 ) -> "Feed":
     """
@@ -386,99 +1529,497 @@ def match_feed(
       function in the ``matchers`` module. Local Mapzen and OSRM
       services can also be used by giving a custom URL. Service calls
       are made asynchronously.
+      Alternatively, match in-process with no web service by choosing
+      the service ``'local'`` and passing a road graph
+      (:class:`.local.RoadGraph` instance) as the service option
+      ``graph``; see :func:`.local.match_with_local`.
     #. Use the new shapes obtained to replace the old shapes (if any)
       of the selected trips only.  The shapes of other trips will
       remain unchanged.
     #. Return the resulting new GTFS feed.
 
+    If a previous version of the feed ``prev_feed`` and its matched
+    version ``prev_mm_feed`` (the output of this function for
+    ``prev_feed``) are given, then work incrementally: reuse the
+    previously matched shapes of the stop patterns that were matched
+    before and whose stops and shapes did not change, and sample and
+    match only the other stop patterns.
+
+    If ``workers`` is greater than 1, then sample, and match with the
+    service ``'local'``, in a pool of that many processes;
+    see :func:`sample_trip_points` and :func:`.local.match_with_local`.
+    The web services are matched concurrently anyway.
+
+    If ``shape_dist_traveled``, then give the new shapes that column,
+    computed in the distance units of the feed.
+
+    If ``dedupe``, then match only once the stop patterns whose sample
+    points are equal up to about a meter, e.g. short turns or express
+    variants sampled at the same points, via :func:`dedupe_points`,
+    and give all of them the same match.
+
+    If ``segments``, then cut the stop patterns into pieces shared by
+    other stop patterns, such as the trunks of branching routes, sample
+    and match each distinct piece once, and join the matches of
+    the pieces of each stop pattern; see :func:`sample_segment_points`.
+    This can save many requests, or much CPU time with the service
+    ``'local'``, when many stop patterns share long stretches, assuming
+    that they travel the same way between the same consecutive stops.
+
+    If a :class:`.segments.SegmentStore` instance is given as
+    ``segment_store``, then before sampling, take the matches of the stop
+    patterns whose segments between consecutive stops are all in the
+    store, joining their segments; and after matching, split the new
+    matches at their stops, store their segments, and evict the least
+    recently used segments from the store.
+    The segments are keyed by the locations of their stops, the service,
+    and its URL (the service option ``url``, defaulting to the public
+    one), so they carry over to new versions of the feed, and to other
+    feeds, as long as the stops stay put.
+    With the service ``'local'``, use a separate store per road graph.
+
+    If the output of :func:`get_stop_patterns` for the feed is already
+    at hand, then pass it in as ``stop_patterns`` to avoid recomputing
+    it.
+    Then ``feed.stop_times`` need only contain the stop times of one
+    trip per stop pattern, as chosen by the function
+    :func:`.stop_times.read_stop_patterns`, which reads both from a
+    stop times file too big to load whole.
+
+    If a :class:`.metrics.Metrics` instance is given, then record there
+    the wall time of each stage, the requests to the web service,
+    the cache hits, and the stop patterns that failed to match,
+    e.g. to export them afterwards via its method ``to_json``.
+
+    If a :class:`.jobs.Job` instance is given, then count the progress
+    of the stages there, and stop early once the job is cancelled or
+    times out, returning the feed with the matches done so far.
+
     NOTES:
 
     - Extra parameters can be passed to the map matching function of
-      choice using the extra keyword arguments ``service_opts``.
+      choice using the extra keyword arguments ``service_opts``,
+      e.g. a :class:`.scheduler.Scheduler` instance ``scheduler`` to set
+      rate limits and retries; the failures are in the ``dropped`` of
+      the metrics.
     - At present, the map matching services only work well for road
       travel, hence the default setting
       ``route_types=ROAD_ROUTE_TYPES``. Not yet suitable for rail,
       ferry, or gondola travel.
     - One map matching API call is made per (unique) stop pattern of
-      the given trip set. Use the function
-      :func:`get_num_match_calls` to compute the number of such
-      calls.
-    - At present, each map matching service accepts at most 100 points
-      per query, so choosing a method that creates more than 100 points
-      for a particular stop pattern will return empty results. This
-      limit can be avoided by using a local deployment of the Mapzen
-      or OSRM service.
+      the given trip set, or per chunk of sample points; see below.
+      Use the function :func:`get_num_match_calls` to compute the number
+      of calls, and :func:`get_num_saved_calls` to compute the number
+      of calls that ``dedupe`` saves.
+    - At present, each public map matching service accepts at most 100
+      points per query, so the sample points of a stop pattern with more
+      than 100 points are matched in overlapping chunks (one API call
+      each) whose results are stitched together.
+      The chunk size can be changed via the ``max_points`` service
+      option, e.g. set ``max_points=None`` when using a local deployment
+      of the OSRM service, which has no such limit.
     - Every empty map matching service result will be ignored and the
       corresponding feed shape(s) will not be updated, that is, the
       original shape(s) (if any) in ``feed`` will be copied over to the
       new feed.
+    - To avoid re-matching sample points that were matched before,
+      e.g. when matching a new version of a feed, pass a persistent
+      cache, such as ``cache=SQLiteCache("matches.db")``, in
+      ``service_opts``; see the ``cache`` module.
 
     """
-    # Select relevant trip IDs
-    trip_ids = _get_trip_ids(feed, route_types, trip_ids)
+    if metrics is None:
+        metrics = Metrics()
+    if job is None:
+        job = Job()
+    profile = service_opts.get("url", matchers.URLS.get(service, ""))
+
+    # Keep the given stop patterns, which can include trips with stop
+    # times that are not selected
+    all_patterns = stop_patterns
+    (
+        stop_patterns,
+        points_and_ids,
+        mpoints_by_pattern,
+        pieces_by_pattern,
+    ) = _prepare_match(
+        feed,
+        route_types,
+        trip_ids,
+        method,
+        value,
+        prev_feed,
+        prev_mm_feed,
+        workers,
+        metrics,
+        job,
+        segments,
+        segment_store,
+        service,
+        profile,
+        all_patterns,
+    )
+    if dedupe:
+        points_and_ids, duplicates = _dedupe_points(points_and_ids)
+    else:
+        duplicates = {}
+
+    # Map match sample points
+    with metrics.time("matching"):
+        if service == "osrm":
+            mpoints_and_ids = matchers.match_with_osrm(
+                points_and_ids, metrics=metrics, job=job, **service_opts
+            )
+        elif service == "mapbox":
+            mpoints_and_ids = matchers.match_with_mapbox(
+                points_and_ids, api_key, metrics=metrics, job=job, **service_opts
+            )
+        elif service == "google":
+            mpoints_and_ids = matchers.match_with_google(
+                points_and_ids, api_key, metrics=metrics, job=job, **service_opts
+            )
+        elif service == "local":
+            mpoints_and_ids = local.match_with_local(
+                points_and_ids, workers=workers, job=job, **service_opts
+            )
+        else:
+            raise ValueError("Service must be one of {!s}".format(SERVICES))
+
+    return _finish_match(
+        feed,
+        stop_patterns,
+        all_patterns,
+        points_and_ids,
+        duplicates,
+        pieces_by_pattern,
+        mpoints_by_pattern,
+        mpoints_and_ids,
+        shape_dist_traveled,
+        segment_store,
+        service,
+        profile,
+        metrics,
+        job,
+    )
 
-    # Get sample points by stop pattern
-    points_and_patterns = sample_trip_points(feed, trip_ids, method=method, value=value)
+
+def iter_match_feed(
+    feed: "Feed",
+    service: str,
+    api_key: Optional[str] = None,
+    route_types: List[int] = ROAD_ROUTE_TYPES,
+    trip_ids: Optional[List[str]] = None,
+    method: str = "num_points",
+    value: float = 100,
+    prev_feed: Optional["Feed"] = None,
+    prev_mm_feed: Optional["Feed"] = None,
+    workers: Optional[int] = None,
+    shape_dist_traveled: bool = False,
+    dedupe: bool = True,
+    segments: bool = False,
+    segment_store: Optional[SegmentStore] = None,
+    stop_patterns: Optional[pd.DataFrame] = None,
+    metrics: Optional[Metrics] = None,
+    job: Optional[Job] = None,
+    **service_opts
+) -> Iterator[pd.DataFrame]:
+    """
+    Generator version of :func:`match_feed`, with the same arguments.
+    For each matched stop pattern, as soon as its match is done,
+    yield a DataFrame of GTFS shapes rows with the matched points for
+    the shapes of the selected trips with that stop pattern,
+    starting with the stop patterns that reuse previous matches.
+    Each shape is yielded at most once, so memory use does not grow
+    with the number of matches.
+    The metrics (if given) record the stages before matching and
+    the requests, but not the time spent matching, which includes the
+    time the consumer spends between matches.
+    Cancelling the job (if given) ends the generator early.
+    With ``segments``, yield each stop pattern once all its pieces are
+    matched, keeping the matched pieces until the end.
+    With ``segment_store``, store the segments of each new match before
+    yielding it, and evict once all matches are yielded.
+    """
+    if service not in SERVICES:
+        raise ValueError("Service must be one of {!s}".format(SERVICES))
+    profile = service_opts.get("url", matchers.URLS.get(service, ""))
+
+    # Keep the given stop patterns, which can include trips with stop
+    # times that are not selected
+    all_patterns = stop_patterns
+    (
+        stop_patterns,
+        points_and_ids,
+        mpoints_by_pattern,
+        pieces_by_pattern,
+    ) = _prepare_match(
+        feed,
+        route_types,
+        trip_ids,
+        method,
+        value,
+        prev_feed,
+        prev_mm_feed,
+        workers,
+        metrics,
+        job,
+        segments,
+        segment_store,
+        service,
+        profile,
+        all_patterns,
+    )
+    if dedupe:
+        points_and_ids, duplicates = _dedupe_points(points_and_ids)
+    else:
+        duplicates = {}
+
+    # Assign each shape to one stop pattern, like :func:`match_feed`
+    shapes_by_pattern = collections.defaultdict(list)
+    pattern_by_shape = dict(
+        zip(stop_patterns["shape_id"], stop_patterns["stop_pattern"])
+    )
+    for shape, pattern in pattern_by_shape.items():
+        shapes_by_pattern[pattern].append(shape)
+
+    dist_units = feed.dist_units if shape_dist_traveled else None
+    categorical = _is_categorical(stop_patterns["shape_id"])
+
+    def build_shapes(pattern, mpoints):
+        shape_ids = shapes_by_pattern[pattern]
+        return _build_shapes(
+            shape_ids,
+            np.zeros(len(shape_ids), dtype=int),
+            [mpoints],
+            dist_units,
+            categorical=categorical,
+        )
+
+    for pattern, mpoints in mpoints_by_pattern.items():
+        yield build_shapes(pattern, mpoints)
+
+    if segment_store is not None:
+        if all_patterns is None:
+            all_patterns = stop_patterns
+        patterns = set(stop_patterns["stop_pattern"]) - set(mpoints_by_pattern)
+        stops_by_pattern = _get_pattern_stops(
+            feed, all_patterns[all_patterns["stop_pattern"].isin(patterns)]
+        )
+
+    def store(pattern, mpoints):
+        if segment_store is not None:
+            _store_matches(
+                stops_by_pattern, {pattern: mpoints}, segment_store, service, profile
+            )
+
+    del mpoints_by_pattern
 
     # Map match sample points
     if service == "osrm":
-        mpoints_and_patterns = matchers.match_with_osrm(
-            points_and_patterns, **service_opts
+        mpoints_and_ids = matchers.iter_match_osrm(
+            points_and_ids, metrics=metrics, job=job, **service_opts
         )
     elif service == "mapbox":
-        mpoints_and_patterns = matchers.match_with_mapbox(
-            points_and_patterns, api_key, **service_opts
+        mpoints_and_ids = matchers.iter_match_mapbox(
+            points_and_ids, api_key, metrics=metrics, job=job, **service_opts
         )
     elif service == "google":
-        mpoints_and_patterns = matchers.match_with_google(
-            points_and_patterns, api_key, **service_opts
+        mpoints_and_ids = matchers.iter_match_google(
+            points_and_ids, api_key, metrics=metrics, job=job, **service_opts
+        )
+    else:
+        mpoints_and_ids = local.iter_match_local(
+            points_and_ids, workers=workers, job=job, **service_opts
         )
+
+    if pieces_by_pattern is None:
+        for mpoints, id_ in mpoints_and_ids:
+            for pattern in [id_] + duplicates.get(id_, []):
+                store(pattern, mpoints)
+                yield build_shapes(pattern, mpoints)
+        if segment_store is not None:
+            segment_store.evict()
+        return
+
+    # Yield each stop pattern once all its pieces are matched
+    patterns_by_piece = collections.defaultdict(list)
+    num_left = {}
+    for pattern, piece_ids in pieces_by_pattern.items():
+        for piece_id in set(piece_ids):
+            patterns_by_piece[piece_id].append(pattern)
+        num_left[pattern] = len(set(piece_ids))
+
+    mpoints_by_piece = {}
+    for mpoints, id_ in mpoints_and_ids:
+        for piece_id in [id_] + duplicates.get(id_, []):
+            mpoints_by_piece[piece_id] = mpoints
+            for pattern in patterns_by_piece[piece_id]:
+                num_left[pattern] -= 1
+                if not num_left[pattern]:
+                    pieces = {pattern: pieces_by_pattern[pattern]}
+                    joined = assemble_pieces(mpoints_by_piece, pieces)[pattern]
+                    store(pattern, joined)
+                    yield build_shapes(pattern, joined)
+    if segment_store is not None:
+        segment_store.evict()
+
+
+@contextlib.contextmanager
+def _open_shapes(
+    path: pl.Path, columns: List[str], like: Optional[pd.DataFrame] = None
+):
+    """
+    Helper function for :func:`stream_match_feed`.
+    Open a GTFS shapes file with the given columns at the given path,
+    a Parquet file if the path ends in ``.parquet`` (see
+    :class:`.parquet.ShapesWriter`, to which ``like`` is passed)
+    and a CSV file otherwise, and yield a function that appends
+    a shapes table to it.
+    """
+    path = pl.Path(path)
+    if path.suffix == ".parquet":
+        with parquet.ShapesWriter(path, columns, like=like) as writer:
+            yield writer.write
     else:
-        valid_services = ["osrm", "mapbox", "google"]
-        raise ValueError("Service must be one of {!s}".format(valid_services))
+        with path.open("w", newline="") as f:
+            pd.DataFrame(columns=columns).to_csv(f, index=False)
+            yield lambda shapes: shapes.reindex(columns=columns).to_csv(
+                f, header=False, index=False
+            )
 
-    mpoints_by_pattern = {pattern: mpoints for mpoints, pattern in mpoints_and_patterns}
 
-    # Create new feed with matched shapes found and old shapes
-    # for the rest of the trips
-    t = get_stop_patterns(feed, trip_ids)
-    t = t[t["stop_pattern"].isin(mpoints_by_pattern)].copy()
-    mpoints_by_shape = {
-        shape: mpoints_by_pattern[pattern]
-        for shape, pattern in t[["shape_id", "stop_pattern"]].values
-    }
-    S = [
-        [shape, i, lon, lat]
-        for shape, mpoints in mpoints_by_shape.items()
-        for i, (lon, lat) in enumerate(mpoints)
-    ]
-    new_shapes = pd.DataFrame(
-        S, columns=["shape_id", "shape_pt_sequence", "shape_pt_lon", "shape_pt_lat"]
-    )
-    feed = feed.copy()
+def stream_match_feed(
+    feed: "Feed",
+    service: str,
+    path: str,
+    api_key: Optional[str] = None,
+    route_types: List[int] = ROAD_ROUTE_TYPES,
+    trip_ids: Optional[List[str]] = None,
+    method: str = "num_points",
+    value: float = 100,
+    prev_feed: Optional["Feed"] = None,
+    prev_mm_feed: Optional["Feed"] = None,
+    workers: Optional[int] = None,
+    shape_dist_traveled: bool = False,
+    **service_opts
+) -> None:
+    """
+    Streaming version of :func:`match_feed`, with the same arguments
+    plus a file path ``path``.
+    Write to that path the GTFS shapes table of the feed that
+    :func:`match_feed` would return, by writing the matched shapes
+    yielded by :func:`iter_match_feed` as they arrive, followed by the
+    shapes of ``feed`` that were not matched.
+    Write a Parquet file, with one row group per write, if the path
+    ends in ``.parquet`` (see :mod:`.parquet`), and a CSV file otherwise.
+    The other tables of that feed equal those of ``feed``.
+    """
+    columns = ["shape_id", "shape_pt_sequence", "shape_pt_lon", "shape_pt_lat"]
+    shapes = feed.shapes
+    if shapes is not None:
+        columns += [c for c in shapes.columns if c not in columns]
+    if shape_dist_traveled and "shape_dist_traveled" not in columns:
+        columns.append("shape_dist_traveled")
+
+    matched_shapes = set()
+    with _open_shapes(path, columns, like=shapes) as write:
+        for new_shapes in iter_match_feed(
+            feed,
+            service,
+            api_key=api_key,
+            route_types=route_types,
+            trip_ids=trip_ids,
+            method=method,
+            value=value,
+            prev_feed=prev_feed,
+            prev_mm_feed=prev_mm_feed,
+            workers=workers,
+            shape_dist_traveled=shape_dist_traveled,
+            **service_opts,
+        ):
+            write(new_shapes)
+            matched_shapes.update(new_shapes["shape_id"])
+
+        if shapes is not None:
+            write(shapes[~shapes["shape_id"].isin(matched_shapes)])
+
+
+def _count_match_calls(
+    feed: "Feed",
+    route_types: List[int],
+    trip_ids: Optional[List[str]],
+    stop_patterns: Optional[pd.DataFrame],
+    dedupe: bool,
+    method: str,
+    value: float,
+) -> Tuple[int, int]:
+    """
+    Helper function for :func:`get_num_match_calls` and
+    :func:`get_num_saved_calls`, whose arguments it takes.
+    Return a pair of the form (number of unique stop patterns,
+    number of calls made by :func:`match_feed` with the given
+    ``dedupe``).
+    """
+    trip_ids = _get_trip_ids(feed, route_types, trip_ids)
+    if stop_patterns is None:
+        p = get_stop_patterns(feed, trip_ids, as_string=False)
+    else:
+        p = stop_patterns[stop_patterns["trip_id"].isin(trip_ids)]
+    num_patterns = p.stop_pattern_id.nunique()
+    if not dedupe:
+        return num_patterns, num_patterns
 
-    shapes = feed.shapes.copy()
-    feed.shapes = pd.concat(
-        [shapes[~shapes.shape_id.isin(mpoints_by_shape)], new_shapes,]
+    points_and_patterns = sample_trip_points(
+        feed, method=method, value=value, stop_patterns=p
     )
-
-    return feed
+    unique, __ = dedupe_points(points_and_patterns)
+    return num_patterns, len(unique)
 
 
 def get_num_match_calls(
     feed: "Feed",
     route_types: List[int] = ROAD_ROUTE_TYPES,
     trip_ids: Optional[List[str]] = None,
+    stop_patterns: Optional[pd.DataFrame] = None,
+    dedupe: bool = False,
+    method: str = "num_points",
+    value: float = 100,
 ) -> int:
     """
-    Return the number of unique stop patterns for the given GTFS feed
-    (GTFSTK Feed instance) and trip IDs (defaults to all trip IDs)
-    by calling the function :func:`get_stop_patterns` and counting
-    unique stop patterns.
-    This number also equals the number of map matching API calls
-    made by the function :func:`create_shapes` with the given
-    route types and trip IDs.
+    Return the number of map matching API calls made by the function
+    :func:`match_feed` with the given GTFS feed (GTFSTK Feed instance),
+    route types, trip IDs (defaults to all trip IDs), ``dedupe``,
+    method, and value, when no stop pattern has more sample points
+    than a request accepts.
+    Without ``dedupe``, this is the number of unique stop patterns,
+    found by calling the function :func:`get_stop_patterns`;
+    with ``dedupe``, which :func:`match_feed` uses by default, also
+    sample the trip points like :func:`match_feed`, which takes longer,
+    and count the unique lists of sample points.
+    If the output of :func:`get_stop_patterns` for the feed is already
+    at hand, then pass it in as ``stop_patterns`` to avoid recomputing
+    it.
     """
-    trip_ids = _get_trip_ids(feed, route_types, trip_ids)
-    p = get_stop_patterns(feed, trip_ids)
-    return p.stop_pattern.nunique()
+    return _count_match_calls(
+        feed, route_types, trip_ids, stop_patterns, dedupe, method, value
+    )[1]
+
+
+def get_num_saved_calls(
+    feed: "Feed",
+    route_types: List[int] = ROAD_ROUTE_TYPES,
+    trip_ids: Optional[List[str]] = None,
+    stop_patterns: Optional[pd.DataFrame] = None,
+    method: str = "num_points",
+    value: float = 100,
+) -> int:
+    """
+    Return the number of map matching API calls that :func:`match_feed`
+    saves with ``dedupe=True``, that is, the output of
+    :func:`get_num_match_calls` without ``dedupe`` minus that with
+    ``dedupe``, for the given arguments, which are as there.
+    """
+    num_patterns, num_calls = _count_match_calls(
+        feed, route_types, trip_ids, stop_patterns, True, method, value
+    )
+    return num_patterns - num_calls
@@ -1,60 +1,535 @@
 """
 API functions for several popular map matching services.
 """
-from typing import List
-from functools import partial
+from typing import Callable, Iterator, List, Optional, Tuple
+import collections
+import concurrent.futures
+import heapq
+import time
+import urllib.parse
 
 from loguru import logger
-import polyline
+import numpy as np
+import requests
 from requests_futures.sessions import FuturesSession
 
+from .cache import BaseCache, make_cache_key
+from .jobs import POLL_INTERVAL, Job
+from .metrics import Metrics
+from .scheduler import Scheduler, get_scheduler, report_failures
+
 
 logger.disable("gtfs_map_matcher")
 MAX_WORKERS = 50  # Max number of concurrent threads for async HTTP requests
+CACHE_BATCH_SIZE = 100  # Number of new results to store in a cache at once
+
+#: Max number of points per request accepted by the public map matching services
+MAX_POINTS = {"osrm": 100, "mapbox": 100, "google": 100}
+
+#: URLs of the public map matching services
+URLS = {
+    "osrm": "http://router.project-osrm.org/match/v1/car",
+    "mapbox": "https://api.mapbox.com/matching/v5/mapbox/driving",
+    "google": "https://roads.googleapis.com/v1/snapToRoads",
+}
+
+#: Number of points shared by consecutive chunks of a long list of points
+OVERLAP = 2
+
+#: Encodings of coordinates accepted by OSRM's Map Matching API
+OSRM_ENCODINGS = ["text", "polyline", "polyline6"]
+
+#: HTTP methods accepted by Mapbox's Map Matching API
+MAPBOX_METHODS = ["GET", "POST"]
+
+
+def split_points(
+    points: List[List[float]], max_points: Optional[int], overlap: int = OVERLAP
+) -> List[List[List[float]]]:
+    """
+    Split the given list of points into chunks of at most ``max_points``
+    points each, with ``overlap`` points shared by consecutive chunks,
+    and return the list of chunks.
+    If ``max_points`` is ``None`` or at least the number of points,
+    then return the list containing only the given list of points.
+    """
+    n = len(points)
+    if max_points is None or n <= max_points:
+        return [points]
+    if not 0 <= overlap < max_points:
+        raise ValueError("Overlap must be nonnegative and less than max_points")
+
+    step = max_points - overlap
+    return [points[i : i + max_points] for i in range(0, n - overlap, step)]
+
+
+def stitch_points(chunks: List[np.array]) -> np.array:
+    """
+    Given a list of NumPy arrays (or lists) of matched longitude-latitude
+    points, such as results of matching chunks output by
+    :func:`split_points`, join them into one NumPy array of shape (n, 2)
+    and return the result.
+    Deduplicate the overlap of consecutive chunks by cutting
+    each chunk at its point, from its second half, nearest to the
+    first point of the next chunk.
+    """
+    chunks = [np.asarray(chunk, dtype=float).reshape(-1, 2) for chunk in chunks]
+    chunks = [chunk for chunk in chunks if len(chunk)]
+    result = chunks[0] if chunks else np.empty((0, 2))
+    for chunk in chunks[1:]:
+        k = len(result) // 2
+        dists = ((result[k:] - chunk[0]) ** 2).sum(axis=1)
+        result = np.concatenate([result[: k + int(dists.argmin())], chunk])
+
+    return result
+
+
+def decode_polyline(s: str, precision: int = 6) -> np.array:
+    """
+    Decode the given encoded polyline string, whose coordinates have
+    ``precision`` decimal places, into a float NumPy array of shape (n, 2)
+    of longitude-latitude points; see
+    https://developers.google.com/maps/documentation/utilities/polylinealgorithm.
+    Like ``polyline.decode``, but vectorized and in longitude-latitude
+    order, so that it makes no Python objects per point.
+    """
+    b = np.frombuffer(s.encode("ascii"), dtype=np.uint8).astype(np.int64) - 63
+
+    # Each value is a run of 5-bit groups, least significant first,
+    # all but the last of which have the continuation bit 0x20 set
+    ends = np.flatnonzero(b < 0x20)
+    if len(ends) % 2 or (len(ends) and ends[-1] != len(b) - 1):
+        raise ValueError("Invalid polyline {!r}".format(s))
+    if not len(ends):
+        return np.empty((0, 2))
+
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    shifts = 5 * (np.arange(len(b)) - np.repeat(starts, ends - starts + 1))
+    values = np.add.reduceat((b & 0x1F) << shifts, starts)
+
+    # Undo the zigzag encoding of signs and the deltas
+    values = np.where(values & 1, ~(values >> 1), values >> 1)
+    return np.cumsum(values.reshape(-1, 2), axis=0)[:, ::-1] / 10 ** precision
+
+
+def encode_polyline(points: np.array, precision: int = 6) -> str:
+    """
+    Inverse of function :func:`decode_polyline`, which encodes the given
+    NumPy array (or list) of longitude-latitude points as a polyline
+    string, rounding their coordinates to ``precision`` decimal places.
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)[:, ::-1] * 10 ** precision
+    # Round half away from zero like ``polyline.encode``
+    values = np.trunc(points + np.copysign(0.5, points)).astype(np.int64)
+    values = np.diff(values, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+    values = ((values << 1) ^ (values >> 63)).ravel()
+
+    # Split each value into 5-bit groups, least significant first,
+    # and set the continuation bit 0x20 of all but the last group
+    num_groups = max(1, -(-int(values.max(initial=0)).bit_length() // 5))
+    groups = values[:, None] >> (5 * np.arange(num_groups))
+    counts = np.maximum(1, (groups > 0).sum(axis=1))
+    chars = (groups & 0x1F) + 63
+    chars[np.arange(num_groups) < counts[:, None] - 1] += 0x20
+    mask = np.arange(num_groups) < counts[:, None]
+    return chars[mask].astype(np.uint8).tobytes().decode("ascii")
+
+
+def _round_points(
+    points: List[List[float]], precision: Optional[int] = None
+) -> List[List[float]]:
+    """
+    Helper function.
+    Return the given longitude-latitude points as a list of points with
+    coordinates rounded to ``precision`` decimal places, or unrounded if
+    ``precision`` is ``None``.
+    """
+    if precision is None:
+        return [[p[0], p[1]] for p in points]
+    return np.round(np.asarray(points, dtype=float).reshape(-1, 2), precision).tolist()
+
+
+def _plan_requests(
+    points_and_ids: List[List],
+    service: str,
+    params: dict,
+    cache: Optional[BaseCache] = None,
+    max_points: Optional[int] = None,
+) -> Tuple[dict, dict, dict, List[int]]:
+    """
+    Helper function.
+    Split each list of points in ``points_and_ids`` into chunks via
+    :func:`split_points` and look up the chunks in the cache (if given)
+    all at once.
+    Return a tuple of the form
+
+    - dictionary of the form (i, j) -> matched points of the jth chunk of
+      the ith list of points, for the chunks found in the cache
+    - dictionary of the form (i, j) -> jth chunk of the ith list of points,
+      for the chunks to request
+    - dictionary of the form (i, j) -> cache key of the jth chunk of the
+      ith list of points; empty if no cache is given
+    - list of the numbers of chunks of each list of points
+
+    """
+    mpoints_by_chunk = {}
+    chunks_to_request = {}
+    keys = {}
+    num_chunks = []
+    for i, (points, id_) in enumerate(points_and_ids):
+        chunks = split_points(points, max_points)
+        num_chunks.append(len(chunks))
+        for j, chunk in enumerate(chunks):
+            if cache is not None:
+                keys[i, j] = make_cache_key(service, params, chunk)
+            chunks_to_request[i, j] = chunk
+
+    if cache is not None:
+        found = cache.get_many(list(keys.values()))
+        for k, key in keys.items():
+            if key in found:
+                mpoints_by_chunk[k] = found[key]
+                del chunks_to_request[k]
+
+    return mpoints_by_chunk, chunks_to_request, keys, num_chunks
+
+
+def _join_chunks(
+    points_and_ids: List[List], mpoints_by_chunk: dict, num_chunks: List[int]
+) -> List[List]:
+    """
+    Helper function.
+    Given the output of :func:`_plan_requests` (with the matched points
+    of the requested chunks added to ``mpoints_by_chunk``), return a list
+    of pairs of the form (matched points, ID), in the order of
+    ``points_and_ids`` and skipping lists of points with unmatched chunks.
+    """
+    data = []
+    for i, (points, id_) in enumerate(points_and_ids):
+        chunks = [mpoints_by_chunk.get((i, j)) for j in range(num_chunks[i])]
+        if all(chunk is not None and len(chunk) for chunk in chunks):
+            data.append((stitch_points(chunks), id_))
+
+    return data
+
+
+def _iter_match(
+    points_and_ids: List[List],
+    service: str,
+    build_request: Callable,
+    parse_response: Callable,
+    params: dict,
+    cache: Optional[BaseCache] = None,
+    max_points: Optional[int] = None,
+    scheduler: Optional[Scheduler] = None,
+    metrics: Optional[Metrics] = None,
+    job: Optional[Job] = None,
+) -> Iterator[Tuple[int, np.array]]:
+    """
+    Helper function.
+    Generator version of :func:`_match`, which yields pairs of the form
+    (index i, matched points of the ith list of points in
+    ``points_and_ids``) as soon as all the chunks of the list are matched,
+    starting with the lists found in the cache, and skipping empty results.
+    Forget the matched chunks of each list once yielded, so that memory
+    use does not grow with the number of results.
+    """
+    if scheduler is None:
+        scheduler = get_scheduler(service)
+    if metrics is None:
+        metrics = Metrics()
+    if job is None:
+        job = Job()
+    job.start()
+    session = FuturesSession(max_workers=MAX_WORKERS)
+
+    def parse(response, *args, **kwargs):
+        request = response.request
+        metrics.record_response(
+            response.status_code,
+            response.elapsed.total_seconds(),
+            len(request.url) + len(request.body or ""),
+            len(response.content),
+        )
+        if scheduler.is_retryable(response):
+            response.data = []
+        else:
+            with metrics.time("parsing"):
+                response.data = parse_response(response)
+
+    mpoints_by_chunk, chunks_to_request, keys, num_chunks = _plan_requests(
+        points_and_ids, service, params, cache=cache, max_points=max_points
+    )
+    if cache is not None:
+        metrics.record_cache(len(mpoints_by_chunk), len(chunks_to_request))
+    num_left = collections.Counter(i for i, j in chunks_to_request)
+    failed = set()
+    failures = {}
+    job.update(num_requests=len(chunks_to_request))
+
+    def join(i):
+        chunks = [mpoints_by_chunk.pop((i, j), None) for j in range(num_chunks[i])]
+        return stitch_points(chunks) if i not in failed else []
+
+    futures = {}
+    attempts = collections.Counter()
+    retries = []  # Heap of pairs (time to retry, chunk key)
+    to_cache = {}  # New results to store in the cache, by cache key
+    to_send = collections.deque(chunks_to_request)
+    reserved = None  # Pair (time to send, chunk key) holding a token
+
+    def submit(k):
+        method, url, kwargs = build_request(chunks_to_request[k])
+        future = session.request(method, url, hooks={"response": parse}, **kwargs)
+        futures[future] = k
+        job.update(num_in_flight=1)
+
+    try:
+        # Yield cached results
+        for i in range(len(points_and_ids)):
+            if not num_left[i]:
+                job.update(num_matched=1)
+                yield i, join(i)
+
+        # Send requests as the scheduler allows, collect responses as they
+        # arrive, and retry the retryable failures after their backoff,
+        # until cancelled
+        while (to_send or reserved or futures or retries) and not job.is_cancelled():
+            now = time.monotonic()
+            while retries and retries[0][0] <= now:
+                to_send.appendleft(heapq.heappop(retries)[1])
+            while (to_send or reserved) and not job.is_cancelled():
+                if reserved is None:
+                    reserved = (now + scheduler.delay(), to_send.popleft())
+                if reserved[0] > now:
+                    break
+                submit(reserved[1])
+                reserved = None
+            if job.is_cancelled():
+                break
+
+            # Wait for a response until the next request may be sent
+            timeout = POLL_INTERVAL
+            if reserved is not None:
+                timeout = min(timeout, reserved[0] - now)
+            if retries:
+                timeout = min(timeout, retries[0][0] - now)
+            if not futures:
+                time.sleep(max(timeout, 0))
+                continue
+
+            done, __ = concurrent.futures.wait(
+                futures,
+                timeout=timeout,
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in done:
+                k = futures.pop(future)
+                i = k[0]
+                job.update(num_in_flight=-1)
+                try:
+                    response, error = future.result(), None
+                except requests.RequestException as e:
+                    response, error = None, e
+                    metrics.record_error()
+                except ValueError as e:
+                    response, error = None, e
+
+                if attempts[k] < scheduler.max_retries and scheduler.is_retryable(
+                    response, error
+                ):
+                    retry_time = time.monotonic() + scheduler.get_backoff(
+                        attempts[k], response
+                    )
+                    heapq.heappush(retries, (retry_time, k))
+                    attempts[k] += 1
+                    metrics.record_retry()
+                    continue
+
+                mpoints = response.data if error is None else []
+                if len(mpoints):
+                    mpoints_by_chunk[k] = mpoints
+                    if cache is not None:
+                        to_cache[keys[k]] = mpoints
+                        if len(to_cache) >= CACHE_BATCH_SIZE:
+                            cache.set_many(to_cache)
+                            to_cache.clear()
+                    job.update(num_completed=1)
+                else:
+                    id_ = points_and_ids[i][1]
+                    failures[id_] = scheduler.get_failure_reason(response, error)
+                    metrics.record_dropped(id_, failures[id_])
+                    failed.add(i)
+                    job.update(num_failed=1)
+
+                num_left[i] -= 1
+                if not num_left[i]:
+                    mpoints = join(i)
+                    if len(mpoints):
+                        job.update(num_matched=1)
+                        yield i, mpoints
+    finally:
+        if cache is not None and to_cache:
+            cache.set_many(to_cache)
+        if job.is_cancelled():
+            # Drop the pending requests and shut down the executor without
+            # waiting for the requests in flight
+            job.update(num_in_flight=-len(futures))
+            for future in futures:
+                future.cancel()
+            session.executor.shutdown(wait=False)
+            requests.Session.close(session)
+        else:
+            for future in futures:
+                future.cancel()
+            session.close()
+
+    if cache is not None:
+        cache.evict()
+    report_failures(failures)
+
+
+def _match(
+    points_and_ids: List[List],
+    service: str,
+    build_request: Callable,
+    parse_response: Callable,
+    params: dict,
+    cache: Optional[BaseCache] = None,
+    max_points: Optional[int] = None,
+    scheduler: Optional[Scheduler] = None,
+    metrics: Optional[Metrics] = None,
+    job: Optional[Job] = None,
+) -> List[List]:
+    """
+    Helper function.
+    For each pair (list of longitude-latitude points, ID) in
+    ``points_and_ids``, send the map matching request built by the
+    function ``build_request``, which takes a list of points and
+    returns a tuple (HTTP method, URL, dictionary of keyword arguments
+    for Requests), and parse the response with the function
+    ``parse_response``.
+    Make the requests asynchronously, paced and retried by the given
+    scheduler (:class:`.scheduler.Scheduler` instance) or by the default
+    scheduler of the service ``service``, and log the IDs of the lists
+    of points that fail to match.
+    If a :class:`.metrics.Metrics` instance is given, then record the
+    requests, cache hits, and failures there, the latter in its
+    ``dropped``.
+    If a :class:`.jobs.Job` instance is given, then count the progress
+    there, and stop sending requests and waiting for responses once
+    the job is cancelled, shutting down the executor without waiting
+    for the requests in flight and returning the matches so far.
+
+    If ``max_points`` is given, then split lists of more than that many
+    points into overlapping chunks via :func:`split_points`,
+    match the chunks, and join the results via :func:`stitch_points`.
+    A list of points whose chunks do not all match yields an empty result.
+
+    If a cache (:class:`.cache.BaseCache` instance) is given,
+    then look up each list of points (or chunk) there first,
+    keyed by the service name ``service``, the request parameters
+    ``params``, and the points, and store the new nonempty results there.
+
+    Return a list of pairs of the form (NumPy array of shape (n, 2) of
+    matched longitude-latitude points, ID), in the order of
+    ``points_and_ids`` and skipping empty results.
+    """
+    mpoints_by_index = dict(
+        _iter_match(
+            points_and_ids,
+            service,
+            build_request,
+            parse_response,
+            params,
+            cache=cache,
+            max_points=max_points,
+            scheduler=scheduler,
+            metrics=metrics,
+            job=job,
+        )
+    )
+    return [
+        (mpoints_by_index[i], id_)
+        for i, (points, id_) in enumerate(points_and_ids)
+        if i in mpoints_by_index
+    ]
 
 
 # OSRM matching functions ----------
-def encode_points_osrm(points: List[List[float]]) -> str:
+def encode_points_osrm(
+    points: List[List[float]], encoding: str = "text", precision: Optional[int] = None
+) -> str:
     """
     Given a list of longitude-latitude points, return their string
-    representation suitable for OSRM's Map Matching API
+    representation suitable for OSRM's Map Matching API,
+    in the given encoding (in ``OSRM_ENCODINGS``), namely
+
+    - ``"text"``: semicolon-separated longitude-latitude pairs, with
+      coordinates rounded to ``precision`` decimal places (unrounded
+      if ``None``)
+    - ``"polyline"`` or ``"polyline6"``: a URL-encoded polyline with
+      coordinates rounded to 5 or 6 decimal places, respectively,
+      which is much shorter
+
     """
-    return (";").join(["{!s},{!s}".format(p[0], p[1]) for p in points])
+    if encoding == "text":
+        return (";").join(
+            ["{!s},{!s}".format(p[0], p[1]) for p in _round_points(points, precision)]
+        )
+    elif encoding in ["polyline", "polyline6"]:
+        pline = encode_polyline(points, 6 if encoding == "polyline6" else 5)
+        return "{!s}({!s})".format(encoding, urllib.parse.quote(pline, safe=""))
+    else:
+        raise ValueError("Encoding must be one of {!s}".format(OSRM_ENCODINGS))
 
 
 def decode_points_osrm(points: str) -> List[List[float]]:
     """
     Inverse of function :func:`encode_points_osrm`.
     """
+    if points.startswith("polyline"):
+        precision = 6 if points.startswith("polyline6") else 5
+        pline = urllib.parse.unquote(points[points.index("(") + 1 : -1])
+        return decode_polyline(pline, precision).tolist()
     return [[float(x) for x in p.split(",")] for p in points.split(";")]
 
 
-def parse_response_osrm(response):
+def parse_response_osrm(response) -> np.array:
     r = response.json()
     if "matchings" in r:
-        pline = []
-        for m in r["matchings"]:
-            pline.extend(polyline.decode(m["geometry"], 6))
-        points = [[p[1], p[0]] for p in pline]
+        points = np.concatenate(
+            [np.empty((0, 2))]
+            + [decode_polyline(m["geometry"], 6) for m in r["matchings"]]
+        )
     else:
         logger.warning(r)
-        points = []
+        points = np.empty((0, 2))
 
     return points
 
 
-def match_with_osrm(
-    points_and_ids: List[List],
-    url: str = "http://router.project-osrm.org/match/v1/car",
-    **kwargs
-) -> List[List]:
+def _get_request_builder_osrm(
+    url: str, encoding: str = "text", precision: Optional[int] = None, **kwargs
+) -> Tuple[Callable, dict]:
     """
-    Public server accepts at most 100 points per request.
+    Helper function.
+    Return a function that builds the OSRM map matching request
+    (HTTP method, URL, dictionary of keyword arguments for Requests)
+    for a list of points, for the service at the given URL with the
+    given extra request parameters ``kwargs``, encoding the points via
+    :func:`encode_points_osrm` with the given encoding and precision.
+    Also return a dictionary of parameters identifying such requests
+    for caching.
     """
-    session = FuturesSession(max_workers=MAX_WORKERS)
+    if encoding not in OSRM_ENCODINGS:
+        raise ValueError("Encoding must be one of {!s}".format(OSRM_ENCODINGS))
 
-    def build_url(points):
-        return "{!s}/{!s}".format(url, encode_points_osrm(points))
+    def build_request(points):
+        full_url = "{!s}/{!s}".format(
+            url, encode_points_osrm(points, encoding, precision)
+        )
+        return "GET", full_url, {"params": params}
 
     params = {
         "geometries": "polyline6",
@@ -63,32 +538,111 @@ def match_with_osrm(
     if kwargs:
         params.update(kwargs)
 
-    def parse(id_, response, *args, **kwargs):
-        mpoints = parse_response_osrm(response)
-        if mpoints:
-            data = (mpoints, id_)
-        else:
-            data = None
-        response.data = data
+    # Rounding the points can change the results
+    cache_params = dict(params, url=url)
+    if encoding != "text":
+        cache_params["encoding"] = encoding
+    if precision is not None:
+        cache_params["precision"] = precision
 
-    futures = (
-        session.get(
-            build_url(points), params=params, hooks={"response": partial(parse, id_)},
-        )
-        for points, id_ in points_and_ids
+    return build_request, cache_params
+
+
+def match_with_osrm(
+    points_and_ids: List[List],
+    url: str = URLS["osrm"],
+    cache: Optional[BaseCache] = None,
+    max_points: Optional[int] = MAX_POINTS["osrm"],
+    scheduler: Optional[Scheduler] = None,
+    metrics: Optional[Metrics] = None,
+    job: Optional[Job] = None,
+    encoding: str = "text",
+    precision: Optional[int] = None,
+    **kwargs
+) -> List[List]:
+    """
+    Public server accepts at most 100 points per request, so longer
+    lists of points are matched in overlapping chunks of at most
+    ``max_points`` points and the results are stitched together.
+    Set ``max_points=None`` to disable chunking, e.g. for a local server.
+    If a cache (:class:`.cache.BaseCache` instance) is given, then reuse
+    results stored there and store new results there.
+    Requests are paced and retried by the given scheduler
+    (:class:`.scheduler.Scheduler` instance) or else by the default
+    scheduler of the service, and recorded in the given
+    :class:`.metrics.Metrics` instance (if any).
+    Their progress is counted in the given :class:`.jobs.Job` instance
+    (if any), and cancelling the job stops them, returning the matches
+    so far.
+    Points are sent in the given encoding (in ``OSRM_ENCODINGS``) with
+    coordinates rounded to ``precision`` decimal places (text only);
+    polylines make much shorter URLs than the default text.
+    """
+    build_request, params = _get_request_builder_osrm(
+        url, encoding=encoding, precision=precision, **kwargs
+    )
+    return _match(
+        points_and_ids,
+        "osrm",
+        build_request,
+        parse_response_osrm,
+        params,
+        cache=cache,
+        max_points=max_points,
+        scheduler=scheduler,
+        metrics=metrics,
+        job=job,
     )
 
-    return [f.result().data for f in futures if f.result().data]
+
+def iter_match_osrm(
+    points_and_ids: List[List],
+    url: str = URLS["osrm"],
+    cache: Optional[BaseCache] = None,
+    max_points: Optional[int] = MAX_POINTS["osrm"],
+    scheduler: Optional[Scheduler] = None,
+    metrics: Optional[Metrics] = None,
+    job: Optional[Job] = None,
+    encoding: str = "text",
+    precision: Optional[int] = None,
+    **kwargs
+) -> Iterator[Tuple[np.array, str]]:
+    """
+    Generator version of :func:`match_with_osrm`, which yields the pairs
+    (matched points, ID) in the order the requests complete.
+    """
+    build_request, params = _get_request_builder_osrm(
+        url, encoding=encoding, precision=precision, **kwargs
+    )
+    for i, mpoints in _iter_match(
+        points_and_ids,
+        "osrm",
+        build_request,
+        parse_response_osrm,
+        params,
+        cache=cache,
+        max_points=max_points,
+        scheduler=scheduler,
+        metrics=metrics,
+        job=job,
+    ):
+        yield mpoints, points_and_ids[i][1]
 
 
 # Mapbox (which uses OSRM) map matching functions ----------
-def encode_points_mapbox(points: List[List[float]]) -> str:
+def encode_points_mapbox(
+    points: List[List[float]], precision: Optional[int] = None
+) -> str:
     """
     Given a list of longitude-latitude points, return their dictionary
-    representation suitable for Mapbox's Map Matching API;
+    representation suitable for Mapbox's Map Matching API,
+    with coordinates rounded to ``precision`` decimal places
+    (unrounded if ``None``);
     see https://www.mapbox.com/api-documentation/#map-matching
     """
-    return (";").join(["{!s},{!s}".format(p[0], p[1]) for p in points])
+    return (";").join(
+        ["{!s},{!s}".format(p[0], p[1]) for p in _round_points(points, precision)]
+    )
 
 
 def decode_points_mapbox(points: str) -> List[List[float]]:
@@ -98,27 +652,52 @@ def decode_points_mapbox(points: str) -> List[List[float]]:
     return [[float(x) for x in p.split(",")] for p in points.split(";")]
 
 
-def parse_response_mapbox(response):
+def parse_response_mapbox(response) -> np.array:
     r = response.json()
     if "matchings" in r:
-        pline = []
-        for m in r["matchings"]:
-            pline.extend(polyline.decode(m["geometry"], 6))
-        points = [[p[1], p[0]] for p in pline]
+        points = np.concatenate(
+            [np.empty((0, 2))]
+            + [decode_polyline(m["geometry"], 6) for m in r["matchings"]]
+        )
     else:
         logger.warning(r)
-        points = []
+        points = np.empty((0, 2))
 
     return points
 
 
-def match_with_mapbox(points_and_ids: List[List], api_key: str, **kwargs):
-    session = FuturesSession(max_workers=MAX_WORKERS)
-
-    url = "https://api.mapbox.com/matching/v5/mapbox/driving"
-
-    def build_url(points):
-        return "{!s}/{!s}".format(url, encode_points_mapbox(points))
+def _get_request_builder_mapbox(
+    api_key: str,
+    http_method: str = "GET",
+    precision: Optional[int] = None,
+    url: str = URLS["mapbox"],
+    **kwargs
+) -> Tuple[Callable, dict]:
+    """
+    Helper function.
+    Return a function that builds the Mapbox map matching request
+    (HTTP method, URL, dictionary of keyword arguments for Requests)
+    for a list of points, for the service at the given URL with the
+    given API key and extra request parameters ``kwargs``,
+    encoding the points via
+    :func:`encode_points_mapbox` with the given precision.
+    If ``http_method`` is ``"POST"``, then send the points and parameters
+    other than the API key as a form in the request body instead of
+    in the URL.
+    Also return a dictionary of parameters identifying such requests
+    for caching.
+    """
+    if http_method not in MAPBOX_METHODS:
+        raise ValueError("Method must be one of {!s}".format(MAPBOX_METHODS))
+
+    def build_request(points):
+        coordinates = encode_points_mapbox(points, precision)
+        if http_method == "POST":
+            data = {k: v for k, v in params.items() if k != "access_token"}
+            data["coordinates"] = coordinates
+            return "POST", url, {"params": {"access_token": api_key}, "data": data}
+        full_url = "{!s}/{!s}".format(url, coordinates)
+        return "GET", full_url, {"params": params}
 
     params = {
         "access_token": api_key,
@@ -128,60 +707,99 @@ def match_with_mapbox(points_and_ids: List[List], api_key: str, **kwargs):
     if kwargs:
         params.update(kwargs)
 
-    def parse(id_, response, *args, **kwargs):
-        mpoints = parse_response_mapbox(response)
-        if mpoints:
-            data = (mpoints, id_)
-        else:
-            data = None
-        response.data = data
-
-    futures = (
-        session.get(
-            build_url(points), params=params, hooks={"response": partial(parse, id_)},
-        )
-        for points, id_ in points_and_ids
-    )
-
-    return [f.result().data for f in futures if f.result().data]
+    # Rounding the points or another server can change the results
+    cache_params = dict(params)
+    if precision is not None:
+        cache_params["precision"] = precision
+    if url != URLS["mapbox"]:
+        cache_params["url"] = url
 
+    return build_request, cache_params
 
-# def match_with_mapbox(points_and_ids: List[List], api_key: str, **kwargs):
-#     session = FuturesSession(max_workers=MAX_WORKERS)
 
-#     url = f"https://api.mapbox.com/matching/v5/mapbox/driving?access_token={api_key}"
-
-#     headers = {
-#         "Content-Type": "application/x-www-form-urlencoded",
-#     }
-#     def make_params(points, kwargs):
-#         params = {
-#             "geometries": "polyline6",
-#             "overview": "full",
-#             "coordinates": encode_points_mapbox(points),
-#         }
-
-#         if kwargs:
-#             params.update(kwargs)
-
-#         return params
-
-#     def parse(id_, response, *args, **kwargs):
-#         mpoints = parse_response_mapbox(response)
-#         if mpoints:
-#             data = (mpoints, id_)
-#         else:
-#             data = None
-#         response.data = data
+def match_with_mapbox(
+    points_and_ids: List[List],
+    api_key: str,
+    cache: Optional[BaseCache] = None,
+    max_points: Optional[int] = MAX_POINTS["mapbox"],
+    scheduler: Optional[Scheduler] = None,
+    metrics: Optional[Metrics] = None,
+    job: Optional[Job] = None,
+    http_method: str = "GET",
+    precision: Optional[int] = None,
+    url: str = URLS["mapbox"],
+    **kwargs
+) -> List[List]:
+    """
+    Mapbox accepts at most 100 points per request, so longer
+    lists of points are matched in overlapping chunks of at most
+    ``max_points`` points and the results are stitched together.
+    If a cache (:class:`.cache.BaseCache` instance) is given, then reuse
+    results stored there and store new results there.
+    Requests are paced and retried by the given scheduler
+    (:class:`.scheduler.Scheduler` instance) or else by the default
+    scheduler of the service, and recorded in the given
+    :class:`.metrics.Metrics` instance (if any).
+    Their progress is counted in the given :class:`.jobs.Job` instance
+    (if any), and cancelling the job stops them, returning the matches
+    so far.
+    Points are sent with coordinates rounded to ``precision`` decimal
+    places (unrounded if ``None``), in the URL of a GET request or,
+    if ``http_method="POST"``, in the body of a POST request, which avoids
+    URL length limits.
+    Set ``url`` to use another server with the same API, e.g. a proxy
+    or a mock server for testing.
+    """
+    build_request, params = _get_request_builder_mapbox(
+        api_key, http_method=http_method, precision=precision, url=url, **kwargs
+    )
+    return _match(
+        points_and_ids,
+        "mapbox",
+        build_request,
+        parse_response_mapbox,
+        params,
+        cache=cache,
+        max_points=max_points,
+        scheduler=scheduler,
+        metrics=metrics,
+        job=job,
+    )
 
-#     futures = (
-#         session.post(
-#             url, data=make_params(points, kwargs), headers=headers, hooks={"response": partial(parse, id_)},
-#         )
-#         for points, id_ in points_and_ids
-#     )
 
-#     return [f.result().data for f in futures if f.result().data]
+def iter_match_mapbox(
+    points_and_ids: List[List],
+    api_key: str,
+    cache: Optional[BaseCache] = None,
+    max_points: Optional[int] = MAX_POINTS["mapbox"],
+    scheduler: Optional[Scheduler] = None,
+    metrics: Optional[Metrics] = None,
+    job: Optional[Job] = None,
+    http_method: str = "GET",
+    precision: Optional[int] = None,
+    url: str = URLS["mapbox"],
+    **kwargs
+) -> Iterator[Tuple[np.array, str]]:
+    """
+    Generator version of :func:`match_with_mapbox`, which yields the pairs
+    (matched points, ID) in the order the requests complete.
+    """
+    build_request, params = _get_request_builder_mapbox(
+        api_key, http_method=http_method, precision=precision, url=url, **kwargs
+    )
+    for i, mpoints in _iter_match(
+        points_and_ids,
+        "mapbox",
+        build_request,
+        parse_response_mapbox,
+        params,
+        cache=cache,
+        max_points=max_points,
+        scheduler=scheduler,
+        metrics=metrics,
+        job=job,
+    ):
+        yield mpoints, points_and_ids[i][1]
 
 
 # Google map matching functions -------------
@@ -201,45 +819,118 @@ def decode_points_google(points: str) -> List[List]:
     return [[float(x) for x in p.split(",")[::-1]] for p in points.split("|")]
 
 
-def parse_response_google(response):
+def parse_response_google(response) -> np.array:
     r = response.json()
     if "snappedPoints" in r:
-        points = [
-            [p["location"]["longitude"], p["location"]["latitude"]]
-            for p in r["snappedPoints"]
-        ]
+        points = np.array(
+            [
+                [p["location"]["longitude"], p["location"]["latitude"]]
+                for p in r["snappedPoints"]
+            ],
+            dtype=float,
+        ).reshape(-1, 2)
     else:
         logger.warning(r)
-        points = []
+        points = np.empty((0, 2))
 
     return points
 
 
-def match_with_google(points_and_ids: List[List], api_key: str):
-    session = FuturesSession(max_workers=MAX_WORKERS)
+def _get_request_builder_google(
+    api_key: str, url: str = URLS["google"]
+) -> Tuple[Callable, dict]:
+    """
+    Helper function.
+    Return a function that builds the Google Snap to Roads request
+    (HTTP method, URL, dictionary of keyword arguments for Requests)
+    for a list of points, for the service at the given URL with the
+    given API key.
+    Also return a dictionary of parameters identifying such requests
+    for caching.
+    """
+
+    def build_request(points):
+        return "GET", url, {"params": dict(params, path=encode_points_google(points))}
+
+    params = {
+        "key": api_key,
+        "interpolate": True,
+    }
 
-    url = "https://roads.googleapis.com/v1/snapToRoads"
+    # Another server can change the results
+    cache_params = dict(params)
+    if url != URLS["google"]:
+        cache_params["url"] = url
 
-    def build_params(points):
-        return {
-            "key": api_key,
-            "path": encode_points_google(points),
-            "interpolate": True,
-        }
+    return build_request, cache_params
 
-    def parse(id_, response, *args, **kwargs):
-        mpoints = parse_response_google(response)
-        if mpoints:
-            data = (mpoints, id_)
-        else:
-            data = None
-        response.data = data
 
-    futures = (
-        session.get(
-            url, params=build_params(points), hooks={"response": partial(parse, id_)},
-        )
-        for points, id_ in points_and_ids
+def match_with_google(
+    points_and_ids: List[List],
+    api_key: str,
+    cache: Optional[BaseCache] = None,
+    max_points: Optional[int] = MAX_POINTS["google"],
+    scheduler: Optional[Scheduler] = None,
+    metrics: Optional[Metrics] = None,
+    job: Optional[Job] = None,
+    url: str = URLS["google"],
+) -> List[List]:
+    """
+    Google accepts at most 100 points per request, so longer
+    lists of points are matched in overlapping chunks of at most
+    ``max_points`` points and the results are stitched together.
+    If a cache (:class:`.cache.BaseCache` instance) is given, then reuse
+    results stored there and store new results there.
+    Requests are paced and retried by the given scheduler
+    (:class:`.scheduler.Scheduler` instance) or else by the default
+    scheduler of the service, and recorded in the given
+    :class:`.metrics.Metrics` instance (if any).
+    Their progress is counted in the given :class:`.jobs.Job` instance
+    (if any), and cancelling the job stops them, returning the matches
+    so far.
+    Set ``url`` to use another server with the same API, e.g. a proxy
+    or a mock server for testing.
+    """
+    build_request, params = _get_request_builder_google(api_key, url)
+    return _match(
+        points_and_ids,
+        "google",
+        build_request,
+        parse_response_google,
+        params,
+        cache=cache,
+        max_points=max_points,
+        scheduler=scheduler,
+        metrics=metrics,
+        job=job,
     )
 
-    return [f.result().data for f in futures if f.result().data]
+
+def iter_match_google(
+    points_and_ids: List[List],
+    api_key: str,
+    cache: Optional[BaseCache] = None,
+    max_points: Optional[int] = MAX_POINTS["google"],
+    scheduler: Optional[Scheduler] = None,
+    metrics: Optional[Metrics] = None,
+    job: Optional[Job] = None,
+    url: str = URLS["google"],
+) -> Iterator[Tuple[np.array, str]]:
+    """
+    Generator version of :func:`match_with_google`, which yields the pairs
+    (matched points, ID) in the order the requests complete.
+    """
+    build_request, params = _get_request_builder_google(api_key, url)
+    for i, mpoints in _iter_match(
+        points_and_ids,
+        "google",
+        build_request,
+        parse_response_google,
+        params,
+        cache=cache,
+        max_points=max_points,
+        scheduler=scheduler,
+        metrics=metrics,
+        job=job,
+    ):
+        yield mpoints, points_and_ids[i][1]
@@ -0,0 +1,186 @@
+"""
+Instrumentation of map matching runs.
+
+:func:`.main.match_feed` and the matchers take a :class:`Metrics`
+instance, which they fill in with the wall time of each stage of the
+run, the numbers and sizes of the requests, the latencies of the
+responses, the cache hits, and the stop patterns dropped.
+Export it to a JSON file for dashboards via :meth:`Metrics.to_json`.
+"""
+import collections
+import contextlib
+import json
+import pathlib as pl
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+
+#: Upper bounds in seconds of the bins of the histograms of response latencies
+LATENCY_BINS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf")]
+
+
+class Metrics:
+    """
+    Thread-safe record of a map matching run, with the attributes
+
+    - ``stages``: dictionary of the form stage name -> total wall time
+      in seconds; :func:`.main.match_feed` records the stages
+      ``"stop_patterns"``, ``"reuse"`` (if incremental), ``"segments"``
+      (if given a segment store), ``"sampling"``, ``"matching"``,
+      and ``"shapes"``, and the matchers record
+      ``"parsing"``, the total time spent parsing responses in the
+      request threads, which overlaps ``"matching"``
+    - ``num_requests``: number of requests sent, including retries
+    - ``num_retries``: number of requests that were retries
+    - ``num_errors``: number of requests that raised exceptions
+    - ``statuses``: counter of the HTTP status codes of the responses
+    - ``bytes_sent``: total size in bytes of the request URLs and bodies
+    - ``bytes_received``: total size in bytes of the response bodies
+    - ``latencies``: list of the response latencies in seconds
+    - ``cache_hits``, ``cache_misses``: numbers of lists of points
+      (or chunks) found and not found in the cache
+    - ``dropped``: dictionary of the form ID -> reason for the lists of
+      points, such as stop patterns, that failed to match
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.num_requests = 0
+        self.num_retries = 0
+        self.num_errors = 0
+        self.statuses = collections.Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latencies = []
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.dropped = {}
+
+    @contextlib.contextmanager
+    def time(self, stage: str):
+        """
+        Context manager that adds its wall time to the given stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def add_time(self, stage: str, seconds: float) -> None:
+        """
+        Add the given number of seconds to the given stage.
+        """
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+    def record_response(
+        self,
+        status: int,
+        latency: float,
+        bytes_sent: int = 0,
+        bytes_received: int = 0,
+    ) -> None:
+        """
+        Record a request that got a response with the given HTTP status
+        code after the given number of seconds, and the sizes in bytes
+        of the request and response.
+        """
+        with self.lock:
+            self.num_requests += 1
+            self.statuses[status] += 1
+            self.latencies.append(latency)
+            self.bytes_sent += bytes_sent
+            self.bytes_received += bytes_received
+
+    def record_error(self) -> None:
+        """
+        Record a request that raised an exception.
+        """
+        with self.lock:
+            self.num_requests += 1
+            self.num_errors += 1
+
+    def record_retry(self) -> None:
+        """
+        Record that a request is to be retried.
+        """
+        with self.lock:
+            self.num_retries += 1
+
+    def record_cache(self, hits: int, misses: int) -> None:
+        """
+        Record the given numbers of cache hits and misses.
+        """
+        with self.lock:
+            self.cache_hits += hits
+            self.cache_misses += misses
+
+    def record_dropped(self, id_, reason: str) -> None:
+        """
+        Record that the list of points with the given ID failed to match
+        for the given reason, unless a reason is already recorded.
+        """
+        with self.lock:
+            self.dropped.setdefault(id_, reason)
+
+    def get_latency_histogram(self, bins: Optional[list] = None) -> dict:
+        """
+        Return a dictionary of the form upper bound -> number of response
+        latencies greater than the previous bound and at most that bound,
+        for the given bounds in seconds (defaults to ``LATENCY_BINS``).
+        """
+        if bins is None:
+            bins = LATENCY_BINS
+        with self.lock:
+            latencies = np.array(self.latencies, dtype=float)
+        counts = np.bincount(
+            np.searchsorted(bins, latencies, side="left"), minlength=len(bins)
+        )
+        return {b: int(n) for b, n in zip(bins, counts[: len(bins)])}
+
+    def to_dict(self) -> dict:
+        """
+        Return a JSON-serializable dictionary summarizing the metrics,
+        with latency quantiles and a histogram instead of the latencies.
+        """
+        with self.lock:
+            latencies = np.array(self.latencies, dtype=float)
+            d = {
+                "stages": dict(self.stages),
+                "num_requests": self.num_requests,
+                "num_retries": self.num_retries,
+                "num_errors": self.num_errors,
+                "statuses": {str(k): v for k, v in sorted(self.statuses.items())},
+                "bytes_sent": self.bytes_sent,
+                "bytes_received": self.bytes_received,
+                "cache_hits": self.cache_hits,
+                "cache_misses": self.cache_misses,
+                "num_dropped": len(self.dropped),
+                "dropped": {str(k): v for k, v in self.dropped.items()},
+            }
+
+        if latencies.size:
+            d["latency"] = {
+                q: float(np.quantile(latencies, p))
+                for q, p in [("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1)]
+            }
+        else:
+            d["latency"] = {}
+        d["latency_histogram"] = {
+            ("+Inf" if np.isinf(b) else str(b)): n
+            for b, n in self.get_latency_histogram().items()
+        }
+        return d
+
+    def to_json(self, path: pl.Path) -> None:
+        """
+        Write the output of :meth:`to_dict` to a JSON file at the given path.
+        """
+        with pl.Path(path).open("w") as f:
+            json.dump(self.to_dict(), f, indent=2)
@@ -0,0 +1,105 @@
+"""
+Helpers for running the CPU-bound stages of :func:`.main.match_feed`,
+namely sampling and local map matching, in a process pool.
+Large read-only inputs, such as shape coordinates and road graphs,
+are NumPy arrays placed in shared memory once and attached to by the
+worker processes, instead of being pickled for every task.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import sys
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+class SharedArrays:
+    """
+    Context manager that copies the given dictionary of NumPy arrays
+    (of non-object data types) into shared memory, and frees the shared
+    memory on exit.
+    Its attribute ``spec`` is a small picklable description of the arrays,
+    which :func:`attach_arrays` turns back into a dictionary of arrays
+    in any process.
+    """
+
+    def __init__(self, arrays: dict):
+        self.blocks = []
+        self.spec = {}
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            self.blocks.append(block)
+            self.spec[name] = (block.name, array.shape, array.dtype.str)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        """
+        Free the shared memory.
+        """
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+#: Shared memory blocks attached to by this process, by name
+_blocks = {}
+
+
+def attach_arrays(spec: dict) -> dict:
+    """
+    Given the attribute ``spec`` of a :class:`SharedArrays` instance,
+    return its dictionary of arrays, backed by the shared memory
+    without copying.
+    The arrays are read-only.
+    """
+    arrays = {}
+    for name, (block_name, shape, dtype) in spec.items():
+        if block_name not in _blocks:
+            if sys.version_info >= (3, 13):
+                block = shared_memory.SharedMemory(name=block_name, track=False)
+            else:
+                block = shared_memory.SharedMemory(name=block_name)
+            _blocks[block_name] = block
+        array = np.ndarray(shape, dtype=dtype, buffer=_blocks[block_name].buf)
+        array.flags.writeable = False
+        arrays[name] = array
+    return arrays
+
+
+def split_balanced(weights: np.array, num_shards: int) -> List[Tuple[int, int]]:
+    """
+    Split the range of indices of the given NumPy array of nonnegative
+    weights into at most ``num_shards`` nonempty contiguous ranges of
+    roughly equal total weight, and return the list of the ranges as
+    pairs (start, stop) in order.
+    """
+    n = len(weights)
+    if not n:
+        return []
+
+    cum = np.cumsum(np.asarray(weights, dtype=float))
+    targets = cum[-1] * np.arange(1, num_shards) / num_shards
+    # End each shard after the item where the cumulative weight reaches a target
+    bounds = np.unique(
+        np.concatenate([[0], np.searchsorted(cum, targets) + 1, [n]]).clip(0, n)
+    )
+    return [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) if a < b]
+
+
+def get_executor(workers: Optional[int]) -> Optional[ProcessPoolExecutor]:
+    """
+    Return a process pool executor with the given number of workers,
+    or ``None`` if that number is ``None`` or at most 1, in which case
+    the work should run in this process.
+    """
+    if workers is None or workers <= 1:
+        return None
+    return ProcessPoolExecutor(max_workers=workers)
@@ -0,0 +1,193 @@
+"""
+Parquet input and output of GTFS tables via PyArrow.
+
+:func:`shapes_to_arrow` converts a GTFS shapes table, such as the one
+of the feed output by :func:`.main.match_feed`, to an Arrow table
+without copying its numeric columns and with its categorical columns
+dictionary-encoded, and :func:`write_shapes` writes it to a Parquet
+file.
+:func:`.main.stream_match_feed` writes Parquet files via
+:class:`ShapesWriter` given a path ending in ``.parquet``,
+and :func:`.stop_times.read_stop_patterns` reads them.
+
+Requires the optional dependency PyArrow,
+e.g. ``poetry add gtfs_map_matcher -E parquet``.
+"""
+import pathlib as pl
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+#: Arrow types of the GTFS shapes columns, by name
+SHAPES_TYPES = {
+    "shape_id": "dictionary",
+    "shape_pt_sequence": "int64",
+    "shape_pt_lon": "float64",
+    "shape_pt_lat": "float64",
+    "shape_dist_traveled": "float64",
+}
+
+
+def import_pyarrow():
+    """
+    Import and return the PyArrow module, with its submodule ``parquet``,
+    or raise an ImportError saying how to install it.
+    """
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError(
+            "Parquet input and output requires PyArrow; "
+            "install the extra 'parquet' of gtfs_map_matcher"
+        ) from None
+    return pyarrow
+
+
+def _to_arrow_type(pa, name: str):
+    """
+    Helper function.
+    Return the Arrow type of the given name in ``SHAPES_TYPES``.
+    """
+    if name == "dictionary":
+        return pa.dictionary(pa.int32(), pa.string())
+    return getattr(pa, name)()
+
+
+def _column_to_arrow(pa, column: pd.Series):
+    """
+    Helper function.
+    Convert the given column to an Arrow array, dictionary-encoding
+    categorical columns via their codes and categories, and wrapping
+    the buffers of NumPy numeric columns without NaNs without copying.
+    """
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        codes = column.cat.codes.to_numpy().astype(np.int32)
+        categories = column.cat.categories.to_numpy(dtype=object)
+        return pa.DictionaryArray.from_arrays(
+            pa.array(codes, mask=codes < 0), pa.array(categories, type=pa.string())
+        )
+    if isinstance(column.dtype, np.dtype) and column.dtype.kind in "biuf":
+        values = np.ascontiguousarray(column.to_numpy())
+        if column.dtype.kind != "f" or not np.isnan(values).any():
+            return pa.array(values)
+    if pd.api.types.is_string_dtype(column.dtype):
+        values = column.to_numpy(dtype=object)
+        return pa.array(values, type=pa.string(), from_pandas=True)
+    return pa.array(column, from_pandas=True)
+
+
+def shapes_to_arrow(shapes: pd.DataFrame) -> "pyarrow.Table":
+    """
+    Convert the given GTFS shapes table to an Arrow table, with its
+    columns converted in order as follows.
+
+    - Categorical columns, such as the ``'shape_id'`` column of the
+      shapes built by :func:`.main.match_feed` from categorical shape IDs,
+      become dictionary arrays sharing their codes and categories.
+    - Numeric NumPy columns without NaNs, such as the coordinates,
+      become arrays over the same memory, without copying.
+    - Other columns are converted by PyArrow, with NaNs as nulls and
+      string columns as Arrow strings.
+
+    """
+    pa = import_pyarrow()
+    return pa.Table.from_arrays(
+        [_column_to_arrow(pa, shapes[c]) for c in shapes.columns],
+        names=[str(c) for c in shapes.columns],
+    )
+
+
+def write_shapes(shapes: pd.DataFrame, path: pl.Path, **kwargs) -> None:
+    """
+    Write the given GTFS shapes table to a Parquet file at the given path
+    via :func:`shapes_to_arrow`, passing the keyword arguments to
+    ``pyarrow.parquet.write_table``, e.g. ``compression="zstd"``.
+    """
+    pa = import_pyarrow()
+    pa.parquet.write_table(shapes_to_arrow(shapes), str(path), **kwargs)
+
+
+class ShapesWriter:
+    """
+    Context manager that writes GTFS shapes tables with the given columns
+    to a Parquet file at the given path one row group at a time,
+    via the method :meth:`write`, passing the keyword arguments to
+    ``pyarrow.parquet.ParquetWriter``.
+    The columns in ``SHAPES_TYPES`` get those types, with the shape IDs
+    dictionary-encoded, and the other columns get the types inferred
+    from the DataFrame ``like`` (if given), else strings.
+    """
+
+    def __init__(
+        self,
+        path: pl.Path,
+        columns: List[str],
+        like: Optional[pd.DataFrame] = None,
+        **kwargs
+    ):
+        pa = self.pa = import_pyarrow()
+        self.columns = list(columns)
+
+        others = [c for c in self.columns if c not in SHAPES_TYPES]
+        if like is not None and others:
+            like_schema = pa.Schema.from_pandas(
+                like.reindex(columns=others), preserve_index=False
+            )
+        fields = []
+        for c in self.columns:
+            if c in SHAPES_TYPES:
+                type_ = _to_arrow_type(pa, SHAPES_TYPES[c])
+            elif like is not None and c in like.columns:
+                type_ = like_schema.field(c).type
+            else:
+                type_ = pa.string()
+            if type_ == pa.null():
+                type_ = pa.string()
+            fields.append(pa.field(c, type_))
+        self.schema = pa.schema(fields)
+        self.writer = pa.parquet.ParquetWriter(str(path), self.schema, **kwargs)
+
+    def to_arrow(self, shapes: pd.DataFrame) -> "pyarrow.Table":
+        """
+        Convert the given GTFS shapes table to an Arrow table with the
+        schema of the file, taking its columns one by one without
+        copying the frame, converting them as in :func:`shapes_to_arrow`,
+        dictionary-encoding non-categorical shape IDs, and filling
+        missing columns with nulls.
+        """
+        pa = self.pa
+        arrays = []
+        for field in self.schema:
+            if field.name not in shapes.columns:
+                arrays.append(pa.nulls(len(shapes), field.type))
+                continue
+            array = _column_to_arrow(pa, shapes[field.name])
+            if pa.types.is_dictionary(field.type) and not pa.types.is_dictionary(
+                array.type
+            ):
+                array = array.dictionary_encode()
+            if not array.type.equals(field.type):
+                array = array.cast(field.type)
+            arrays.append(array)
+        return pa.Table.from_arrays(arrays, schema=self.schema)
+
+    def write(self, shapes: pd.DataFrame) -> None:
+        """
+        Append the given GTFS shapes table to the file as a row group,
+        via :meth:`to_arrow`.
+        """
+        self.writer.write_table(self.to_arrow(shapes))
+
+    def close(self) -> None:
+        """
+        Finish the file.
+        """
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
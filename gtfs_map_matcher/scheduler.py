@@ -0,0 +1,176 @@
+"""
+Rate limiting and retrying of map matching requests.
+
+The matchers take a :class:`Scheduler`, which paces their requests by
+a token bucket, says which failed requests to retry and how long to
+back off before doing so, and names the reasons of the requests that
+still fail.
+By default, they use the scheduler of their service returned by
+:func:`get_scheduler`, which is shared by all calls so that concurrent
+runs together stay within the service's quota.
+A scheduler holds only this rate and backoff state, so the matchers
+keep the failures of each call to themselves, in their metrics
+(:class:`.metrics.Metrics` instance), and log them via
+:func:`report_failures`.
+"""
+import threading
+import time
+from typing import Optional
+
+from loguru import logger
+
+
+#: Default rate limits of the map matching services in requests per second,
+#: where ``None`` means no limit
+RATE_LIMITS = {"osrm": None, "mapbox": 300 / 60, "google": None}
+
+#: HTTP status codes of responses to retry
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+MAX_RETRIES = 5  # Max number of retries of a request
+BACKOFF = 1  # Seconds to wait before the first retry
+MAX_BACKOFF = 60  # Max seconds to wait before a retry
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter, which allows ``rate`` events
+    per second on average and bursts of up to ``burst`` events
+    (defaults to the greater of ``rate`` and 1).
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        if rate <= 0:
+            raise ValueError("Rate must be positive")
+
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Take a token and return the number of seconds to wait before
+        the event it allows.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= 1
+            return max(0, -self.tokens / self.rate)
+
+    def acquire(self) -> None:
+        """
+        Take a token, waiting until the event it allows.
+        """
+        time.sleep(self.reserve())
+
+
+class Scheduler:
+    """
+    Schedules map matching requests, limiting them to ``rate`` requests
+    per second (no limit if ``None``) with bursts of up to ``burst``
+    requests, and retrying requests that raise exceptions or get responses
+    with status codes in ``retry_statuses`` at most ``max_retries`` times.
+    Waits ``backoff * 2**i`` seconds, at most ``max_backoff`` seconds,
+    before the ith retry (starting at 0), or longer if the response has
+    a Retry-After header.
+    """
+
+    def __init__(
+        self,
+        rate: Optional[float] = None,
+        burst: Optional[float] = None,
+        max_retries: int = MAX_RETRIES,
+        backoff: float = BACKOFF,
+        max_backoff: float = MAX_BACKOFF,
+        retry_statuses: tuple = RETRY_STATUSES,
+    ):
+        self.bucket = TokenBucket(rate, burst) if rate is not None else None
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_statuses = retry_statuses
+
+    def delay(self) -> float:
+        """
+        Reserve a request and return the number of seconds to wait before
+        sending it.
+        """
+        return self.bucket.reserve() if self.bucket is not None else 0
+
+    def acquire(self) -> None:
+        """
+        Reserve a request, waiting until it may be sent.
+        """
+        time.sleep(self.delay())
+
+    def is_retryable(self, response=None, error: Optional[Exception] = None) -> bool:
+        """
+        Return ``True`` if and only if the request that got the given
+        response (Requests or HTTPX) or raised the given exception
+        should be retried.
+        """
+        return error is not None or (
+            response is not None and response.status_code in self.retry_statuses
+        )
+
+    def get_backoff(self, attempt: int, response=None) -> float:
+        """
+        Return the number of seconds to wait before retrying a request
+        for the ``attempt``th time (starting at 0) after it got the given
+        response (if any).
+        """
+        backoff = min(self.backoff * 2 ** attempt, self.max_backoff)
+        try:
+            retry_after = float(response.headers["Retry-After"])
+        except (AttributeError, KeyError, TypeError, ValueError):
+            retry_after = 0
+        return max(backoff, min(retry_after, self.max_backoff))
+
+    def get_failure_reason(
+        self, response=None, error: Optional[Exception] = None
+    ) -> str:
+        """
+        Return the reason that a list of points failed to match after
+        getting the given response or raising the given exception
+        (if any).
+        """
+        if error is not None:
+            return repr(error)
+        if response is not None and response.status_code >= 400:
+            return "HTTP {!s}".format(response.status_code)
+        return "no match"
+
+
+def report_failures(failures: dict) -> None:
+    """
+    Log a warning listing the given failures of a matcher call,
+    a dictionary of the form ID -> reason.
+    """
+    if failures:
+        logger.warning(
+            "{!s} lists of points failed to match: {!s}".format(
+                len(failures), failures
+            )
+        )
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(service: str) -> Scheduler:
+    """
+    Return the default scheduler of the given map matching service,
+    which has the rate limit ``RATE_LIMITS[service]`` and is shared by all
+    matcher calls that are not given a scheduler.
+    """
+    with _schedulers_lock:
+        if service not in _schedulers:
+            _schedulers[service] = Scheduler(rate=RATE_LIMITS.get(service))
+        return _schedulers[service]
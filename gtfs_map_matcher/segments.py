@@ -0,0 +1,405 @@
+"""
+A persistent store of matched geometries between consecutive stops.
+
+Stop locations and road networks change slowly, so the matched path
+between two consecutive stops is reusable across versions of a feed,
+and even across feeds that share stops.
+:class:`SegmentStore` keeps such paths in an SQLite database, keyed by
+the coordinates of the two stops and by the map matching service and
+profile, with the paths encoded compactly as polylines.
+:func:`.main.match_feed` consults it via its argument ``segment_store``
+before sampling the stop patterns, assembling the stop patterns whose
+segments are all stored, and splits the new matches at their stops to
+store their segments.
+"""
+import hashlib
+import json
+import pathlib as pl
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+import numpy as np
+
+from . import local
+from .cache import MAX_QUERY_PARAMS
+from .matchers import decode_polyline, encode_polyline
+
+
+#: Max distance in meters from a stop to a matched path for splitting
+#: the path there
+SNAP_DIST = 100
+
+
+def make_segment_keys(
+    stops: np.array, service: str, profile: str = "", precision: int = 6
+) -> List[bytes]:
+    """
+    Given a NumPy array (or list) of longitude-latitude stop points,
+    return a list of 16-byte keys, one for each pair of consecutive
+    stops, hashing their coordinates rounded to ``precision`` decimal
+    places along with the given map matching service name and profile,
+    e.g. the URL of the service.
+    """
+    header = json.dumps([service, profile]).encode()
+    q = np.round(np.asarray(stops, dtype=float).reshape(-1, 2) * 10**precision)
+    q = q.astype("<i8")
+    return [
+        hashlib.blake2b(header + row.tobytes(), digest_size=16).digest()
+        for row in np.concatenate([q[:-1], q[1:]], axis=1)
+    ]
+
+
+def _drop_repeats(points: np.array) -> np.array:
+    """
+    Helper function.
+    Drop the points equal to their predecessors from the given NumPy
+    array of points.
+    """
+    keep = np.ones(len(points), dtype=bool)
+    keep[1:] = (points[1:] != points[:-1]).any(axis=1)
+    return points[keep]
+
+
+def _locate(points: np.array, pos: np.array) -> np.array:
+    """
+    Helper function.
+    Given a NumPy array of shape (n, 2) of points of a path, with n > 1,
+    and a NumPy array of positions along the path, each of the form
+    index of line segment of the path plus fraction along that segment,
+    return the NumPy array of points of the path at those positions.
+    """
+    i = np.minimum(pos.astype(int), len(points) - 2)
+    t = (pos - i)[:, None]
+    return points[i] + t * (points[i + 1] - points[i])
+
+
+def _argmin_accumulate(values: np.array) -> np.array:
+    """
+    Helper function.
+    Return the NumPy array whose ith entry is the index of the first
+    minimum of ``values[: i + 1]``.
+    """
+    is_new_min = np.empty(len(values), dtype=bool)
+    is_new_min[0] = True
+    is_new_min[1:] = values[1:] < np.minimum.accumulate(values)[:-1]
+    return np.maximum.accumulate(np.where(is_new_min, np.arange(len(values)), 0))
+
+
+def split_at_stops(
+    mpoints: np.array, stops: np.array, max_dist: float = SNAP_DIST
+) -> Optional[List[np.array]]:
+    """
+    Given a NumPy array of shape (n, 2) of longitude-latitude points
+    of a path matched through the given stops, in order, project the
+    stops onto the path in order, and return the list of the parts of
+    the path between consecutive projections, as NumPy arrays.
+    Each stop projects onto the closest point of one of the stretches
+    of the path within ``max_dist`` meters of it, or onto the projection
+    of the previous stop, choosing the projections that minimize the
+    total distance from the stops to their projections, so that paths
+    passing a stop more than once split at the right pass.
+    Return ``None`` if the path has fewer than two points or some stop
+    has no such projection.
+    """
+    mpoints = np.asarray(mpoints, dtype=float)
+    stops = np.asarray(stops, dtype=float).reshape(-1, 2)
+    if len(mpoints) < 2:
+        return None
+
+    # Project every stop onto every line segment of the path,
+    # measuring in meters on an equirectangular projection about the stops
+    scale = np.radians(local.EARTH_RADIUS) * np.array(
+        [np.cos(np.radians(stops[:, 1].mean())), 1]
+    )
+    xy = stops * scale
+    p = mpoints * scale
+    a = p[:-1]
+    ab = np.diff(p, axis=0)
+    norms = (ab**2).sum(axis=1)
+    norms[norms == 0] = 1
+    ts = np.clip(((xy[:, None, :] - a) * ab).sum(axis=2) / norms, 0, 1)
+    dists = np.hypot(*(a + ts[..., None] * ab - xy[:, None, :]).transpose(2, 0, 1))
+
+    # Find the candidate projections of each stop, namely the closest
+    # point of each stretch of consecutive line segments near the stop
+    # and the nearby candidates of the previous stop, and choose the
+    # candidates in order along the path with least total distance
+    # by dynamic programming
+    candidates = []  # Arrays of candidate positions, one per stop
+    backs = []  # Arrays of indices of previous candidates, one per stop
+    prev_pos = np.array([-np.inf])
+    prev_cost = np.array([0.0])
+    for k in range(len(stops)):
+        near = np.flatnonzero(dists[k] <= max_dist)
+        runs = np.split(near, np.flatnonzero(np.diff(near) > 1) + 1)
+        js = np.array(
+            [run[dists[k, run].argmin()] for run in runs if run.size], dtype=int
+        )
+        pos = js + ts[k, js]
+        if k > 0:
+            pos = np.unique(np.concatenate([pos, prev_pos]))
+        d = np.hypot(*(_locate(p, pos) - xy[k]).T)
+        pos, d = pos[d <= max_dist], d[d <= max_dist]
+        if not pos.size:
+            return None
+
+        # Cheapest previous candidate at or before each candidate
+        order = np.argsort(prev_pos, kind="stable")
+        n = np.searchsorted(prev_pos[order], pos, side="right") - 1
+        cum_cost = np.minimum.accumulate(prev_cost[order])
+        cum_arg = order[_argmin_accumulate(prev_cost[order])]
+        cost = np.where(n >= 0, cum_cost[np.maximum(n, 0)], np.inf) + d
+
+        candidates.append(pos)
+        backs.append(cum_arg[np.maximum(n, 0)])
+        prev_pos, prev_cost = pos, cost
+
+    if not np.isfinite(prev_cost).any():
+        return None
+
+    # Trace back the chosen candidates
+    c = prev_cost.argmin()
+    positions = []
+    for k in range(len(stops) - 1, -1, -1):
+        positions.append(candidates[k][c])
+        c = backs[k][c]
+    positions.reverse()
+
+    # Cut the path at the chosen positions
+    ends = _locate(mpoints, np.array(positions))
+    return [
+        _drop_repeats(
+            np.concatenate(
+                [[ends[k]], mpoints[int(start) + 1 : int(np.ceil(stop))], [ends[k + 1]]]
+            )
+        )
+        for k, (start, stop) in enumerate(zip(positions[:-1], positions[1:]))
+    ]
+
+
+def join_segments(segments: List[np.array]) -> np.array:
+    """
+    Inverse of function :func:`split_at_stops`, which concatenates
+    the given NumPy arrays of points, dropping the points repeated
+    at the joins.
+    """
+    return _drop_repeats(np.concatenate(segments))
+
+
+def _decode_polylines(blobs: List[bytes], precision: int) -> List[np.array]:
+    """
+    Helper function.
+    Decode the given ASCII polylines like :func:`.matchers.decode_polyline`
+    but all at once, which is faster for many short polylines.
+    """
+    if not blobs:
+        return []
+
+    # Decode the concatenation, whose deltas run across the polylines,
+    # and count the points of each polyline by its terminal characters
+    joined = b"".join(blobs)
+    scale = 10**precision
+    points = np.round(decode_polyline(joined.decode("ascii"), precision) * scale)
+    is_end = np.frombuffer(joined, dtype=np.uint8) < 95
+    bounds = np.cumsum([len(blob) for blob in blobs])
+    counts = np.diff(np.concatenate([[0], np.cumsum(is_end)[bounds - 1]])) // 2
+
+    # Make the first point of each polyline absolute again
+    starts = np.cumsum(counts) - counts
+    offsets = np.where(starts[:, None] > 0, points[np.maximum(starts - 1, 0)], 0)
+    points = (points - np.repeat(offsets, counts, axis=0)) / scale
+    return np.split(points, starts[1:])
+
+
+class SegmentStore:
+    """
+    Matched paths between consecutive stops stored in an SQLite database
+    at the given path, keyed as in :func:`make_segment_keys`.
+    Holds at most ``max_size`` segments and at most ``max_bytes`` bytes
+    of encoded paths (unlimited if ``None``), discarding the least
+    recently used segments first.
+    Paths are encoded as polylines with coordinates rounded to
+    ``precision`` decimal places, which takes a few bytes per point.
+    Thread-safe, so that, e.g., :func:`.async_matchers.match_feed_async`
+    can use it in its executor.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_size: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        precision: int = 6,
+    ):
+        self.path = pl.Path(path)
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.precision = precision
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS segments ("
+                "key BLOB PRIMARY KEY, points BLOB, accessed REAL)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS segments_accessed "
+                "ON segments (accessed)"
+            )
+        self.evict()
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM segments").fetchone()[0]
+
+    def get_num_bytes(self) -> int:
+        """
+        Return the total size in bytes of the encoded paths stored.
+        """
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COALESCE(SUM(LENGTH(points)), 0) FROM segments"
+            ).fetchone()[0]
+
+    def get_many(self, keys: List[bytes]) -> dict:
+        """
+        Return a dictionary of the form key -> NumPy array of path points
+        for the given keys that are stored, and mark them as used.
+        """
+        keys = list(set(keys))
+        rows = []
+        with self.lock:
+            for i in range(0, len(keys), MAX_QUERY_PARAMS):
+                batch = keys[i : i + MAX_QUERY_PARAMS]
+                rows.extend(
+                    self.conn.execute(
+                        "SELECT key, points FROM segments WHERE key IN ({!s})".format(
+                            ",".join("?" * len(batch))
+                        ),
+                        batch,
+                    ).fetchall()
+                )
+
+            now = time.time()
+            with self.conn:
+                self.conn.executemany(
+                    "UPDATE segments SET accessed = ? WHERE key = ?",
+                    [(now, key) for key, __ in rows],
+                )
+        return dict(
+            zip(
+                [key for key, __ in rows],
+                _decode_polylines([blob for __, blob in rows], self.precision),
+            )
+        )
+
+    def set_many(self, points_by_key: dict) -> None:
+        """
+        Store the given dictionary of the form key -> NumPy array of
+        path points.
+        """
+        rows = [
+            (key, encode_polyline(points, self.precision).encode())
+            for key, points in points_by_key.items()
+        ]
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO segments VALUES (?, ?, ?)",
+                [(key, blob, now) for key, blob in rows],
+            )
+
+    def get_paths(
+        self, stops_list: List[np.array], service: str, profile: str = ""
+    ) -> List[Optional[np.array]]:
+        """
+        Given a list of arrays of longitude-latitude stop points, return
+        the list of matched paths through them joined from the stored
+        segments between consecutive stops, with ``None`` for the paths
+        with some segment not stored.
+        """
+        keys_list = [
+            make_segment_keys(stops, service, profile, self.precision)
+            for stops in stops_list
+        ]
+        found = self.get_many([key for keys in keys_list for key in keys])
+        return [
+            join_segments([found[key] for key in keys])
+            if keys and all(key in found for key in keys)
+            else None
+            for keys in keys_list
+        ]
+
+    def get_path(
+        self, stops: np.array, service: str, profile: str = ""
+    ) -> Optional[np.array]:
+        """
+        Return the matched path through the given longitude-latitude stop
+        points joined from the stored segments between consecutive stops,
+        or ``None`` if some segment is not stored.
+        """
+        return self.get_paths([stops], service, profile)[0]
+
+    def set_paths(
+        self,
+        stops_list: List[np.array],
+        mpoints_list: List[np.array],
+        service: str,
+        profile: str = "",
+    ) -> List[bool]:
+        """
+        Given a list of arrays of longitude-latitude stop points and
+        a list of matched paths through them, split each path via
+        :func:`split_at_stops` and store the segments.
+        Return the list of booleans indicating which paths could be split.
+        """
+        points_by_key = {}
+        done = []
+        for stops, mpoints in zip(stops_list, mpoints_list):
+            segments = split_at_stops(mpoints, stops)
+            if segments is not None:
+                keys = make_segment_keys(stops, service, profile, self.precision)
+                points_by_key.update(zip(keys, segments))
+            done.append(segments is not None)
+        self.set_many(points_by_key)
+        return done
+
+    def set_path(
+        self, stops: np.array, mpoints: np.array, service: str, profile: str = ""
+    ) -> bool:
+        """
+        Split the given matched path through the given longitude-latitude
+        stop points via :func:`split_at_stops` and store its segments.
+        Return ``True`` if the path could be split and ``False`` otherwise.
+        """
+        return self.set_paths([stops], [mpoints], service, profile)[0]
+
+    def evict(self) -> None:
+        """
+        Discard the least recently used segments in excess of ``max_size``
+        and of ``max_bytes``.
+        """
+        with self.lock, self.conn:
+            if self.max_size is not None:
+                self.conn.execute(
+                    "DELETE FROM segments WHERE key NOT IN ("
+                    "SELECT key FROM segments ORDER BY accessed DESC LIMIT ?)",
+                    (self.max_size,),
+                )
+            if self.max_bytes is not None:
+                self.conn.execute(
+                    "DELETE FROM segments WHERE key IN ("
+                    "SELECT key FROM (SELECT key, SUM(LENGTH(points)) OVER "
+                    "(ORDER BY accessed DESC, key) AS total FROM segments) "
+                    "WHERE total > ?)",
+                    (self.max_bytes,),
+                )
+
+    def clear(self) -> None:
+        """
+        Discard all segments.
+        """
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM segments")
@@ -0,0 +1,137 @@
+"""
+Compact storage of GTFS shapes for batched interpolation along them,
+instead of one Shapely LineString per shape.
+"""
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+class ShapeStore:
+    """
+    GTFS shapes held in NumPy arrays, namely
+
+    - ``coords``: float array of shape (m, 2) of the longitude-latitude
+      coordinates of the shapes concatenated
+    - ``offsets``: integer array such that shape i has coordinates
+      ``coords[offsets[i]:offsets[i + 1]]``
+    - ``lengths``: float array of the cumulative planar lengths along the
+      concatenated shapes, where consecutive shapes are joined with
+      zero length; computed if not given
+
+    along with the list of IDs of the shapes ``shape_ids`` (optional).
+    Every shape has at least one point.
+    As with Shapely, lengths are measured in the units of the coordinates.
+    """
+
+    def __init__(
+        self,
+        coords: np.array,
+        offsets: np.array,
+        shape_ids: Optional[List[str]] = None,
+        lengths: Optional[np.array] = None,
+    ):
+        self.coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.shape_ids = list(shape_ids) if shape_ids is not None else None
+
+        if lengths is None:
+            if len(self.coords):
+                seglens = np.hypot(*np.diff(self.coords, axis=0).T)
+            else:
+                seglens = np.array([])
+            seglens[self.offsets[1:-1] - 1] = 0
+            lengths = np.concatenate([[0], np.cumsum(seglens)])[: len(self.coords)]
+        self.lengths = np.asarray(lengths, dtype=float)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __repr__(self):
+        return "ShapeStore({!s} shapes, {!s} points)".format(
+            len(self), len(self.coords)
+        )
+
+    @classmethod
+    def from_feed(
+        cls, feed: "Feed", shape_ids: Optional[List[str]] = None
+    ) -> "ShapeStore":
+        """
+        Build a shape store from the shapes of the given GTFS feed
+        (GTFSTK Feed instance) with the given IDs (defaults to all shapes),
+        in order of shape ID.
+        IDs of missing shapes are ignored.
+        """
+        if feed.shapes is None:
+            s = pd.DataFrame(columns=["shape_id", "shape_pt_lon", "shape_pt_lat"])
+        else:
+            s = feed.shapes
+            if shape_ids is not None:
+                s = s.loc[lambda x: x["shape_id"].isin(shape_ids)]
+            s = s.sort_values(["shape_id", "shape_pt_sequence"])
+
+        codes, index = pd.factorize(s["shape_id"])
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(codes))])
+        return cls(
+            s[["shape_pt_lon", "shape_pt_lat"]].to_numpy(dtype=float),
+            offsets,
+            shape_ids=index,
+        )
+
+    def get_codes(self, shape_ids: List[str]) -> np.array:
+        """
+        Return a NumPy array of the indices of the shapes with the given IDs
+        in this store, with -1 for the IDs not found.
+        """
+        return pd.Index(self.shape_ids).get_indexer(shape_ids)
+
+    def get_coords(self, code: int) -> np.array:
+        """
+        Return the NumPy array of coordinates of the shape with the
+        given index.
+        """
+        return self.coords[self.offsets[code] : self.offsets[code + 1]]
+
+    def get_lengths(self, codes: Optional[np.array] = None) -> np.array:
+        """
+        Return a NumPy array of the lengths of the shapes with the given
+        indices (defaults to all shapes).
+        """
+        if codes is None:
+            codes = np.arange(len(self))
+        codes = np.asarray(codes, dtype=np.int64)
+        start = self.offsets[codes]
+        end = self.offsets[codes + 1]
+        return self.lengths[end - 1] - self.lengths[start]
+
+    def interpolate(
+        self, codes: np.array, distances: np.array, normalized: bool = False
+    ) -> np.array:
+        """
+        Given a NumPy array of shape indices and a NumPy array of equal size
+        of distances along the shapes, return the NumPy array of
+        longitude-latitude points located at those distances along those
+        shapes, like Shapely's ``LineString.interpolate`` but for all points
+        at once.
+        If ``normalized``, then interpret the distances as fractions of the
+        shape lengths.
+        Distances are clipped to the shape lengths.
+        """
+        codes = np.asarray(codes, dtype=np.int64)
+        distances = np.asarray(distances, dtype=float)
+        lengths = self.lengths
+        start = self.offsets[codes]
+        end = self.offsets[codes + 1]
+        total = lengths[end - 1] - lengths[start]
+        if normalized:
+            distances = distances * total
+        target = lengths[start] + np.clip(distances, 0, total)
+        i = np.searchsorted(lengths, target, side="right") - 1
+        i = np.clip(i, start, np.maximum(end - 2, start))
+        j = np.minimum(i + 1, end - 1)
+        seglens = lengths[j] - lengths[i]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            alpha = np.where(seglens > 0, (target - lengths[i]) / seglens, 0)
+        alpha = np.clip(alpha, 0, 1)[:, None]
+        return self.coords[i] + alpha * (self.coords[j] - self.coords[i])
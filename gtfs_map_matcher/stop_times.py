@@ -0,0 +1,164 @@
+"""
+Reading GTFS stop times too big to load whole.
+
+:func:`read_stop_patterns` streams a ``stop_times.txt`` file in chunks,
+or a Parquet file in batches, computes the stop pattern of every trip
+as it goes, and materializes only the stop times of one trip per stop
+pattern, which is all that :func:`.main.match_feed` samples.
+For example::
+
+    feed = gk.read_feed(path_without_stop_times, dist_units="km")
+    stop_patterns, feed.stop_times = read_stop_patterns(
+        "stop_times.txt", feed.trips
+    )
+    mm_feed = match_feed(feed, "osrm", stop_patterns=stop_patterns)
+
+Then ``mm_feed`` has the matched shapes of all the trips, and the stop
+times of only the representative trips.
+
+The stop times of each trip must be contiguous in the file, as in most
+feeds, which are sorted by trip ID, but not necessarily sorted by stop
+sequence.
+Reading Parquet files requires the optional dependency PyArrow,
+e.g. ``poetry add gtfs_map_matcher -E parquet``.
+"""
+import pathlib as pl
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .main import _get_representative_trips, _get_stop_pattern_ids
+from .parquet import import_pyarrow
+
+
+#: Default number of rows per chunk
+CHUNKSIZE = 1_000_000
+
+#: Data types of the stop times columns that must not be parsed as numbers
+DTYPES = {
+    "trip_id": str,
+    "stop_id": str,
+    "arrival_time": str,
+    "departure_time": str,
+    "stop_headsign": str,
+}
+
+
+def _iter_parquet(
+    path: pl.Path, chunksize: int, columns: Optional[List[str]] = None
+) -> Iterator[pd.DataFrame]:
+    """
+    Helper function.
+    Yield the rows of the given Parquet file in DataFrames of at most
+    ``chunksize`` rows, reading one batch at a time.
+    """
+    pa = import_pyarrow()
+    for batch in pa.parquet.ParquetFile(str(path)).iter_batches(
+        batch_size=chunksize, columns=columns
+    ):
+        yield batch.to_pandas()
+
+
+def iter_stop_times(
+    path: pl.Path,
+    chunksize: int = CHUNKSIZE,
+    columns: Optional[List[str]] = None,
+) -> Iterator[pd.DataFrame]:
+    """
+    Read the GTFS stop times at the given path, a CSV file or a Parquet
+    file (ending in ``.parquet``), in chunks of about ``chunksize`` rows,
+    restricted to the given columns (defaults to all columns), and
+    yield DataFrames of the stop times of whole trips, holding back
+    the rows of the last trip of each chunk until the next chunk.
+    Raise a ValueError if the stop times of a trip are not contiguous.
+    """
+    path = pl.Path(path)
+    if path.suffix == ".parquet":
+        chunks = _iter_parquet(path, chunksize, columns)
+    else:
+        chunks = pd.read_csv(
+            path,
+            chunksize=chunksize,
+            usecols=columns,
+            dtype=DTYPES,
+            encoding="utf-8-sig",
+        )
+
+    seen = set()
+    held = None
+    for chunk in chunks:
+        if held is not None:
+            chunk = pd.concat([held, chunk], ignore_index=True)
+        if chunk.empty:
+            continue
+
+        # Find the runs of equal trip IDs and check that they are new
+        trip_ids = chunk["trip_id"].to_numpy()
+        starts = np.flatnonzero(trip_ids[1:] != trip_ids[:-1]) + 1
+        run_ids = trip_ids[np.concatenate([[0], starts])]
+        if len(set(run_ids)) < len(run_ids) or not seen.isdisjoint(run_ids):
+            raise ValueError(
+                "Stop times must be contiguous by trip ID; "
+                "sort them by trip ID first"
+            )
+
+        # Hold back the last trip, which can continue in the next chunk
+        cut = starts[-1] if len(starts) else 0
+        seen.update(run_ids[:-1])
+        held = chunk.iloc[cut:]
+        if cut:
+            yield chunk.iloc[:cut]
+
+    if held is not None and not held.empty:
+        yield held
+
+
+def read_stop_patterns(
+    path: pl.Path,
+    trips: pd.DataFrame,
+    chunksize: int = CHUNKSIZE,
+    sep: str = "->",
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Streaming version of :func:`.main.get_stop_patterns`, which reads
+    the GTFS stop times at the given path (see :func:`iter_stop_times`)
+    instead of taking a feed, and takes the GTFS trips table of the feed.
+    Return a pair of the form
+
+    - the output of :func:`.main.get_stop_patterns` for all trips
+    - the stop times of one trip per stop pattern, namely the trips
+      that :func:`.main.match_feed` samples
+
+    Read the file twice, first the columns needed to compute the stop
+    patterns, and then all columns, keeping only the rows of the chosen
+    trips, so that memory use grows with the number of trips and the
+    number of stop patterns, but not with the number of stop times.
+    """
+    # Compute the stop pattern of each trip
+    columns = ["trip_id", "stop_id", "stop_sequence"]
+    frames = [
+        _get_stop_pattern_ids(chunk, sep=None)
+        for chunk in iter_stop_times(path, chunksize, columns=columns)
+    ]
+    if not frames:
+        raise ValueError("No stop times in {!s}".format(path))
+    stop_patterns = trips.merge(pd.concat(frames, ignore_index=True))
+
+    # Read the stop times of the representative trips
+    rep_trip_ids = _get_representative_trips(stop_patterns)["trip_id"]
+    stop_times = pd.concat(
+        [
+            chunk[chunk["trip_id"].isin(rep_trip_ids)]
+            for chunk in iter_stop_times(path, chunksize)
+        ],
+        ignore_index=True,
+    )
+
+    # Name the stop patterns after their representative trips' stops
+    names = _get_stop_pattern_ids(stop_times, sep=sep)
+    names = names.drop_duplicates("stop_pattern_id").set_index("stop_pattern_id")
+    stop_patterns["stop_pattern"] = (
+        names["stop_pattern"].reindex(stop_patterns["stop_pattern_id"]).values
+    )
+    return stop_patterns, stop_times
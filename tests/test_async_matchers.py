@@ -0,0 +1,188 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+httpx = pytest.importorskip('httpx')
+
+from .context import test_feed
+from gtfs_map_matcher import *
+from gtfs_map_matcher.async_matchers import *
+
+
+points_and_ids = [
+    ([[174.843234, -41.137425], [174.828152, -41.130639]], 'bingo'),
+    ([[174.80496399999998, -41.22333], [174.796785, -41.247057]], 'bongo'),
+]
+json = {'matchings': [{'geometry': 'bmrzFqr|i`@vrC|r@'}], 'code': 'Ok'}
+
+
+def make_client(requests_, fail=False):
+    """
+    Return an HTTPX client that answers every request with the JSON
+    above, or fails to connect if ``fail``, and records the requests
+    in the given list.
+    """
+    def handler(request):
+        requests_.append(request)
+        if fail:
+            raise httpx.ConnectError('bingo', request=request)
+        return httpx.Response(200, json=json)
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def test_match_with_osrm_async():
+    requests_ = []
+
+    async def run():
+        async with make_client(requests_) as client:
+            return await match_with_osrm_async(points_and_ids, client=client)
+
+    r = asyncio.run(run())
+    assert len(requests_) == 2
+    assert [id_ for __, id_ in r] == ['bingo', 'bongo']
+    assert all(len(mpoints) == 2 for mpoints, __ in r)
+
+    # Same results as the synchronous matcher
+    assert np.array_equal(r[0][0], parse_response_osrm(httpx.Response(200, json=json)))
+
+
+def test_match_with_osrm_async_cache(tmp_path):
+    requests_ = []
+    cache = SQLiteCache(tmp_path / 'cache.db')
+
+    async def run():
+        async with make_client(requests_) as client:
+            r = await match_with_osrm_async(points_and_ids, client=client, cache=cache)
+            s = await match_with_osrm_async(points_and_ids, client=client, cache=cache)
+            return r, s
+
+    r, s = asyncio.run(run())
+    assert [(m.tolist(), id_) for m, id_ in r] == [(m.tolist(), id_) for m, id_ in s]
+    assert len(requests_) == 2
+    assert len(cache) == 2
+
+    # Cache hits are recorded
+    metrics = Metrics()
+
+    async def run():
+        async with make_client(requests_) as client:
+            return await match_with_osrm_async(
+                points_and_ids, client=client, cache=cache, metrics=metrics
+            )
+
+    asyncio.run(run())
+    assert (metrics.cache_hits, metrics.cache_misses) == (2, 0)
+    assert metrics.num_requests == 0
+
+
+def test_match_with_osrm_async_errors():
+    requests_ = []
+    scheduler = Scheduler(max_retries=2, backoff=0)
+    metrics = Metrics()
+
+    async def run():
+        async with make_client(requests_, fail=True) as client:
+            return await match_with_osrm_async(
+                points_and_ids,
+                client=client,
+                max_concurrency=1,
+                scheduler=scheduler,
+                metrics=metrics,
+            )
+
+    r = asyncio.run(run())
+    assert len(requests_) == 6
+    assert r == []
+    assert set(metrics.dropped) == {'bingo', 'bongo'}
+    assert metrics.num_requests == metrics.num_errors == 6
+    assert metrics.num_retries == 4
+
+
+def test_match_feed_async():
+    requests_ = []
+    tids = test_feed.trips.trip_id.iloc[:2].tolist()
+
+    async def run():
+        async with make_client(requests_) as client:
+            return await match_feed_async(
+                test_feed, 'osrm', trip_ids=tids, client=client
+            )
+
+    mm_feed = asyncio.run(run())
+    assert len(requests_) == get_num_match_calls(test_feed, trip_ids=tids, dedupe=True)
+    shids = test_feed.trips.loc[lambda x: x.trip_id.isin(tids), 'shape_id']
+    mm_shapes = mm_feed.shapes.loc[lambda x: x.shape_id.isin(shids)]
+    assert mm_shapes.groupby('shape_id').size().eq(2).all()
+
+    # Takes the options of match_feed, none of which reach the service
+    requests_.clear()
+    metrics = Metrics()
+
+    async def run():
+        async with make_client(requests_) as client:
+            return await match_feed_async(
+                test_feed,
+                'osrm',
+                trip_ids=tids,
+                client=client,
+                dedupe=True,
+                stop_patterns=get_stop_patterns(test_feed),
+                metrics=metrics,
+                job=Job(),
+            )
+
+    mm_feed2 = asyncio.run(run())
+    assert len(requests_) == get_num_match_calls(test_feed, trip_ids=tids, dedupe=True)
+    assert not any('dedupe' in str(request.url) for request in requests_)
+    assert {'sampling', 'matching', 'parsing', 'shapes'} <= set(metrics.stages)
+    assert metrics.num_requests == len(requests_)
+    assert metrics.statuses == {200: metrics.num_requests}
+    assert metrics.bytes_sent > 0
+    assert metrics.bytes_received > 0
+    assert len(metrics.latencies) == metrics.num_requests
+    assert not metrics.dropped
+    assert mm_feed2.shapes.equals(mm_feed.shapes)
+
+    with pytest.raises(ValueError):
+        asyncio.run(match_feed_async(test_feed, 'bingo'))
+
+
+def test_match_feed_async_segment_store(tmp_path):
+    # Match each list of sample points to itself
+    requests_ = []
+
+    def echo(request):
+        requests_.append(request)
+        path = request.url.path.rsplit('/', 1)[-1]
+        points = [[float(x) for x in p.split(',')] for p in path.split(';')]
+        body = {'matchings': [{'geometry': encode_polyline(points, 6)}], 'code': 'Ok'}
+        return httpx.Response(200, json=body)
+
+    store = SegmentStore(tmp_path / 'segments.db')
+    tids = test_feed.trips.trip_id.iloc[:2].tolist()
+
+    async def run(metrics=None):
+        transport = httpx.MockTransport(echo)
+        async with httpx.AsyncClient(transport=transport) as client:
+            return await match_feed_async(
+                test_feed,
+                'osrm',
+                trip_ids=tids,
+                client=client,
+                segment_store=store,
+                metrics=metrics,
+            )
+
+    mm_feed = asyncio.run(run())
+    n = len(requests_)
+    assert n == get_num_match_calls(test_feed, trip_ids=tids, dedupe=True)
+    assert len(store) > 0
+
+    # Stored patterns need no requests
+    metrics = Metrics()
+    mm_feed2 = asyncio.run(run(metrics))
+    assert len(requests_) == n
+    assert 'segments' in metrics.stages
+    assert set(mm_feed2.shapes.shape_id) == set(mm_feed.shapes.shape_id)
@@ -0,0 +1,96 @@
+import time
+
+import numpy as np
+import pytest
+
+from gtfs_map_matcher import *
+
+
+points = [[174.843234, -41.137425], [174.828152, -41.130639]]
+
+
+def test_make_cache_key():
+    key = make_cache_key("osrm", {"overview": "full"}, points)
+    assert isinstance(key, str)
+
+    # Insensitive to rounding noise and secrets
+    points2 = [[x + 1e-9, y - 1e-9] for x, y in points]
+    assert make_cache_key("osrm", {"overview": "full"}, points2) == key
+    assert (
+        make_cache_key("mapbox", {"access_token": "a"}, points)
+        == make_cache_key("mapbox", {"access_token": "b"}, points)
+    )
+
+    # Sensitive to everything else
+    assert make_cache_key("mapbox", {"overview": "full"}, points) != key
+    assert make_cache_key("osrm", {"overview": "simple"}, points) != key
+    assert make_cache_key("osrm", {"overview": "full"}, points[::-1]) != key
+    assert make_cache_key("osrm", {"overview": "full"}, points, precision=1) != key
+
+
+def test_encode_points():
+    assert decode_points(encode_points(points)).tolist() == points
+    assert decode_points(encode_points([])).shape == (0, 2)
+
+
+@pytest.mark.parametrize("cache_class", [SQLiteCache, DirectoryCache])
+def test_cache(tmp_path, cache_class):
+    path = tmp_path / "cache"
+    cache = cache_class(path)
+    assert cache.get("a") is None
+    cache.set("a", points)
+    assert cache.get("a").tolist() == points
+    assert len(cache) == 1
+
+    # Persistent
+    cache = cache_class(path)
+    assert cache.get("a").tolist() == points
+
+    # Evict least recently used
+    cache = cache_class(path, max_size=2)
+    cache.set("b", points)
+    time.sleep(0.01)
+    cache.get("a")
+    time.sleep(0.01)
+    cache.set("c", points)
+    cache.evict()
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a").tolist() == points
+
+    # Evict old
+    cache = cache_class(path, max_age=0)
+    assert cache.get("c") is None
+    assert len(cache) == 0
+
+    cache = cache_class(path)
+    cache.set("a", points)
+    cache.clear()
+    assert len(cache) == 0
+
+
+@pytest.mark.parametrize("cache_class", [SQLiteCache, DirectoryCache])
+def test_cache_many(tmp_path, cache_class):
+    path = tmp_path / "cache"
+    cache = cache_class(path)
+    assert cache.get_many(["a", "b"]) == {}
+    cache.set_many({"a": points, "b": points[::-1]})
+    assert len(cache) == 2
+    found = cache.get_many(["a", "b", "c", "a"])
+    assert {k: v.tolist() for k, v in found.items()} == {
+        "a": points,
+        "b": points[::-1],
+    }
+
+    # Looking up many marks them as used
+    cache = cache_class(path, max_size=2)
+    time.sleep(0.01)
+    cache.get_many(["a"])
+    time.sleep(0.01)
+    cache.set("c", points)
+    cache.evict()
+    assert set(cache.get_many(["a", "b", "c"])) == {"a", "c"}
+
+    # Expired results are not found
+    cache = cache_class(path, max_age=0)
+    assert cache.get_many(["a", "c"]) == {}
@@ -0,0 +1,35 @@
+import time
+
+from gtfs_map_matcher import *
+
+
+def test_job():
+    progress = []
+    job = Job(callback=progress.append)
+    assert job.get_time_left() is None
+    job.start()
+    assert not job.is_cancelled()
+
+    job.update(num_requests=3, num_in_flight=1)
+    job.update(num_in_flight=-1, num_completed=1)
+    assert job.progress['num_requests'] == 3
+    assert job.progress['num_in_flight'] == 0
+    assert job.progress['num_completed'] == 1
+    assert len(progress) == 2
+    assert progress[0]['num_in_flight'] == 1
+
+    job.cancel()
+    job.cancel('timeout')
+    assert job.is_cancelled()
+    assert job.reason == 'cancelled'
+
+
+def test_job_timeout():
+    job = Job(timeout=0.05)
+    job.start()
+    assert 0 < job.get_time_left() <= 0.05
+    assert not job.is_cancelled()
+    time.sleep(0.06)
+    assert job.get_time_left() == 0
+    assert job.is_cancelled()
+    assert job.reason == 'timeout'
@@ -0,0 +1,139 @@
+import numpy as np
+import pytest
+
+from .context import test_feed
+from gtfs_map_matcher import *
+
+
+lon0, lat0 = 174.8, -41.2
+
+# Grid of two-way roads 0.001 degrees apart
+lines = [
+    [[lon0 + j / 1000, lat0 + i / 1000] for j in range(6)] for i in range(6)
+] + [[[lon0 + i / 1000, lat0 + j / 1000] for j in range(6)] for i in range(6)]
+graph = RoadGraph.from_lines(lines)
+
+
+def is_on_road(p):
+    x, y = np.round((np.array(p) - [lon0, lat0]) * 1000, 9)
+    return x == int(x) or y == int(y)
+
+
+def test_road_graph():
+    assert graph.node_coords.shape == (36, 2)
+    assert graph.edges.shape == (2 * 2 * 6 * 5, 2)
+    # Edges are 111 m north-south and 84 m east-west
+    assert np.allclose(np.unique(graph.edge_lengths.round(3)), [83.668, 111.195])
+
+    g = RoadGraph.from_lines(lines, oneway=True)
+    assert g.edges.shape[0] == graph.edges.shape[0] // 2
+
+
+def test_road_graph_npz(tmp_path):
+    path = tmp_path / 'graph.npz'
+    graph.to_npz(path)
+    g = RoadGraph.from_npz(path)
+    assert np.array_equal(g.node_coords, graph.node_coords)
+    assert np.array_equal(g.edges, graph.edges)
+
+
+def test_road_graph_from_osm(tmp_path):
+    xml = """<?xml version="1.0" encoding="UTF-8"?>
+    <osm version="0.6">
+      <node id="1" lat="-41.2" lon="174.8"/>
+      <node id="2" lat="-41.2" lon="174.801"/>
+      <node id="3" lat="-41.199" lon="174.801"/>
+      <node id="4" lat="-41.199" lon="174.8"/>
+      <way id="10">
+        <nd ref="1"/><nd ref="2"/><nd ref="3"/>
+        <tag k="highway" v="residential"/>
+      </way>
+      <way id="11">
+        <nd ref="3"/><nd ref="4"/>
+        <tag k="highway" v="primary"/><tag k="oneway" v="yes"/>
+      </way>
+      <way id="12">
+        <nd ref="4"/><nd ref="1"/>
+        <tag k="highway" v="footway"/>
+      </way>
+    </osm>
+    """
+    path = tmp_path / 'roads.osm'
+    path.write_text(xml)
+    g = RoadGraph.from_osm(path)
+    assert g.node_coords.shape == (4, 2)
+    assert g.edges.shape == (5, 2)
+
+
+def test_get_candidates():
+    points = [[lon0 + 0.0001, lat0 + 0.00005], [lon0 + 0.0025, lat0 + 0.0025]]
+    point_ids, edge_ids, fracs, dists = graph.get_candidates(points, radius=20)
+    assert set(point_ids) == {0}
+    assert (np.diff(dists[point_ids == 0]) >= 0).all()
+    assert dists.max() <= 20
+    assert np.allclose(fracs[0], 0.1) or np.allclose(fracs[0], 0.9)
+
+    __, edge_ids, __, __ = graph.get_candidates(points, max_candidates=1)
+    assert edge_ids.size == 2
+
+
+def test_match_with_local():
+    # Noisy points along the bottom road then up the fourth one
+    points = [
+        [lon0 + 0.0001, lat0 + 0.00005],
+        [lon0 + 0.0021, lat0 - 0.00004],
+        [lon0 + 0.00303, lat0 + 0.0011],
+        [lon0 + 0.00298, lat0 + 0.0032],
+    ]
+    far_points = [[lon0 + 1, lat0 + 1]] * 2
+    r = match_with_local([(points, 'bingo'), (far_points, 'bongo')], graph)
+    assert len(r) == 1
+    mpoints, id_ = r[0]
+    assert id_ == 'bingo'
+    assert all(is_on_road(p) for p in mpoints)
+    # Passes through the corner
+    assert any(np.allclose(p, [lon0 + 0.003, lat0]) for p in mpoints)
+    assert np.allclose(mpoints[0], [lon0 + 0.0001, lat0])
+    assert np.allclose(mpoints[-1], [lon0 + 0.003, lat0 + 0.0032])
+
+    # Count matches and stop once cancelled
+    job = Job()
+    match_with_local([(points, 'bingo')] * 2, graph, job=job)
+    assert job.progress['num_matched'] == 2
+    job.cancel()
+    assert match_with_local([(points, 'bingo')], graph, job=job) == []
+
+    # One-way roads are respected: these ones only go west and south
+    g = RoadGraph.from_lines([line[::-1] for line in lines], oneway=True)
+    assert match_with_local([(points[:2], 'bingo')], g) == []
+    assert match_with_local([(points[1::-1], 'bingo')], g)
+
+
+def test_match_with_local_workers():
+    points_and_ids = [
+        ([[lon0 + i / 1000, lat0 + 0.00003 * (-1) ** i] for i in range(j)], j)
+        for j in range(2, 7)
+    ]
+    r = match_with_local(points_and_ids, graph)
+    assert [id_ for __, id_ in r] == [2, 3, 4, 5, 6]
+    s = match_with_local(points_and_ids, graph, workers=2)
+    assert [(m.tolist(), id_) for m, id_ in s] == [(m.tolist(), id_) for m, id_ in r]
+
+
+def test_match_feed_local():
+    tids = test_feed.trips.trip_id.iloc[:2].tolist()
+    shids = test_feed.trips.loc[lambda x: x.trip_id.isin(tids), 'shape_id']
+    roads = [
+        group[['shape_pt_lon', 'shape_pt_lat']].values
+        for __, group in test_feed.shapes.loc[
+            lambda x: x.shape_id.isin(shids)
+        ].sort_values(['shape_id', 'shape_pt_sequence']).groupby('shape_id')
+    ]
+    g = RoadGraph.from_lines(roads)
+    mm_feed = match_feed(test_feed, 'local', trip_ids=tids, graph=g)
+    for shid in shids:
+        shape = mm_feed.shapes.loc[lambda x: x.shape_id == shid]
+        assert shape.shape[0] > 2
+
+    with pytest.raises(TypeError):
+        match_feed(test_feed, 'local', trip_ids=tids)
@@ -1,10 +1,19 @@
+import json
+
 import numpy as np
+import pandas as pd
+import pytest
 import responses
 import re
 
 from .context import test_feed
 from gtfs_map_matcher import *
-from gtfs_map_matcher.main import _get_trip_ids
+from gtfs_map_matcher.main import (
+    _build_shapes,
+    _get_representative_trips,
+    _get_trip_ids,
+    _hash_ids,
+)
 
 
 def test_insert_points_by_num():
@@ -17,6 +26,39 @@ def test_insert_points_by_num():
     assert np.array_equal(
         insert_points_by_num(xs, 3), np.array([0, 1 / 4, 1 / 2, 3 / 4, 7 / 8, 1])
     )
+    assert np.array_equal(
+        insert_points_by_num(xs, 3, method="iterative"),
+        np.array([0, 1 / 4, 1 / 2, 3 / 4, 7 / 8, 1]),
+    )
+
+    # Closed form spreads points at least as well as the iterative reference
+    rng = np.random.default_rng(42)
+    for __ in range(100):
+        xs = np.sort(rng.choice(1000, rng.integers(2, 20), replace=False)) / 1000
+        n = int(rng.integers(0, 100))
+        ys = insert_points_by_num(xs, n)
+        zs = insert_points_by_num(xs, n, method="iterative")
+        assert ys.size == zs.size == xs.size + n
+        assert np.isin(xs, ys).all()
+        assert np.diff(ys).min() > 0
+        assert np.diff(ys).max() <= np.diff(zs).max() + 1e-12
+
+    with pytest.raises(ValueError):
+        insert_points_by_num(xs, 1, method="bingo")
+
+
+def test_insert_points_by_num_batch():
+    arrays = [np.array([0, 3 / 4, 1]), np.array([2, 3]), np.array([0, 1, 5, 6])]
+    ns = [3, 0, 4]
+    xs = np.concatenate(arrays)
+    offsets = [0, 3, 5, 9]
+    ys, new_offsets = insert_points_by_num_batch(xs, offsets, ns)
+    assert np.array_equal(new_offsets, [0, 6, 8, 16])
+    for i in range(len(arrays)):
+        assert np.array_equal(
+            ys[new_offsets[i] : new_offsets[i + 1]],
+            insert_points_by_num(arrays[i], ns[i]),
+        )
 
 
 def test_insert_points_by_dist():
@@ -27,6 +69,29 @@ def test_insert_points_by_dist():
         insert_points_by_dist(xs, 1 / 4), np.array([0, 1 / 4, 1 / 2, 3 / 4, 1])
     )
     assert np.array_equal(insert_points_by_dist(xs, 2), xs)
+    assert np.array_equal(
+        insert_points_by_dist(np.array([0, 0.1, 0.35, 1]), 1 / 4),
+        np.array([0, 0.1, 0.35, 0.5, 0.75, 1]),
+    )
+
+
+def test_insert_points_by_dist_batch():
+    arrays = [np.array([0, 3 / 4, 1]), np.array([2]), np.array([0, 0.1, 0.35, 1])]
+    ds = [1 / 4, 1 / 4, 1 / 4]
+    xs = np.concatenate(arrays)
+    offsets = [0, 3, 4, 8]
+    ys, new_offsets = insert_points_by_dist_batch(xs, offsets, ds)
+    assert np.array_equal(new_offsets, [0, 5, 6, 12])
+    for i in range(len(arrays)):
+        assert np.array_equal(
+            ys[new_offsets[i] : new_offsets[i + 1]],
+            insert_points_by_dist(arrays[i], ds[i]),
+        )
+
+    # Scalar distance
+    ys2, new_offsets2 = insert_points_by_dist_batch(xs, offsets, 1 / 4)
+    assert np.array_equal(ys2, ys)
+    assert np.array_equal(new_offsets2, new_offsets)
 
 
 def test_get_stop_patterns():
@@ -34,6 +99,43 @@ def test_get_stop_patterns():
     assert "stop_pattern" in p.columns
     assert isinstance(p.stop_pattern.iat[0], str)
 
+    # Pattern IDs and pattern strings determine each other
+    assert p.groupby("stop_pattern_id").stop_pattern.nunique().max() == 1
+    assert p.groupby("stop_pattern").stop_pattern_id.nunique().max() == 1
+    trip_id = p.trip_id.iat[0]
+    st = test_feed.stop_times.loc[lambda x: x.trip_id == trip_id].sort_values(
+        "stop_sequence"
+    )
+    assert p.stop_pattern.iat[0] == "->".join(st.stop_id)
+
+    q = get_stop_patterns(test_feed, p.trip_id.iloc[:10], as_string=False)
+    assert "stop_pattern" not in q.columns
+    assert q.shape[0] == 10
+    assert q.stop_pattern_id.tolist() == p.stop_pattern_id.iloc[:10].tolist()
+
+
+def test_get_representative_trips():
+    p = get_stop_patterns(test_feed, as_string=False)
+    t = _get_representative_trips(p)
+    assert t.stop_pattern_id.is_unique
+    assert set(t.stop_pattern_id) == set(p.stop_pattern_id)
+
+    # The first trip in order with the least shape ID, even if its ID is greater
+    p = p.assign(trip_id=p.trip_id.astype(str))
+    counts = p.groupby(["stop_pattern_id", "shape_id"]).trip_id.transform("size")
+    q = p.loc[counts > 1].sort_values("trip_id", ascending=False)
+    pid = q.stop_pattern_id.iat[0]
+    q = q.loc[lambda x: x.stop_pattern_id == pid]
+    expect = q.loc[lambda x: x.shape_id == x.shape_id.min(), "trip_id"]
+    assert _get_representative_trips(q).trip_id.tolist() == [expect.iat[0]]
+    assert _get_representative_trips(q.iloc[::-1]).trip_id.tolist() == [
+        expect.iat[-1]
+    ]
+
+    # No shapes
+    t = _get_representative_trips(p.drop(columns="shape_id").iloc[:1])
+    assert t.shape_id.isna().all()
+
 
 def test_sample_trip_points():
     trip_id = test_feed.trips.trip_id.iat[0]
@@ -65,6 +167,89 @@ def test_sample_trip_points():
     assert len(points) == len(pattern.split("->"))
     assert len(points[0]) == 2
 
+    # Fewer points than stops
+    points_and_patterns = sample_trip_points(
+        test_feed, [trip_id], method="num_points", value=2
+    )
+    points, pattern = points_and_patterns[0]
+    stops = test_feed.stops.set_index("stop_id")
+    first, *__, last = pattern.split("->")
+    assert points == stops.loc[[first, last], ["stop_lon", "stop_lat"]].values.tolist()
+
+    points_and_patterns = sample_trip_points(
+        test_feed, [trip_id], method="stop_multiplier", value=0.5
+    )
+    points, pattern = points_and_patterns[0]
+    assert len(points) == int(0.5 * len(pattern.split("->")))
+
+    # All trips
+    points_and_patterns = sample_trip_points(test_feed, method="num_points", value=30)
+    n = get_stop_patterns(test_feed).stop_pattern.nunique()
+    assert len(points_and_patterns) == n
+    assert all(len(points) == 30 for points, pattern in points_and_patterns)
+
+    # Precomputed stop patterns
+    stop_patterns = get_stop_patterns(test_feed, as_string=False)
+    assert (
+        sample_trip_points(
+            test_feed, method="num_points", value=30, stop_patterns=stop_patterns
+        )
+        == points_and_patterns
+    )
+
+    with pytest.raises(ValueError):
+        sample_trip_points(test_feed, [trip_id], method="bingo")
+
+
+def test_sample_trip_points_workers():
+    for method, value in [("num_points", 10), ("distance", 0.5)]:
+        a = sample_trip_points(test_feed, method=method, value=value)
+        b = sample_trip_points(test_feed, method=method, value=value, workers=2)
+        assert a == b
+
+
+def test_sample_segment_points():
+    # Add a short turn of a trip, which shares its first stops
+    feed = test_feed.copy()
+    tid = feed.trips.trip_id.iat[0]
+    trip = feed.trips.loc[lambda x: x.trip_id == tid].assign(trip_id="short")
+    feed.trips = pd.concat([feed.trips, trip], ignore_index=True)
+    st = feed.stop_times.loc[lambda x: x.trip_id == tid].sort_values("stop_sequence")
+    k = st.shape[0]
+    feed.stop_times = pd.concat(
+        [feed.stop_times, st.iloc[: k // 2].assign(trip_id="short")],
+        ignore_index=True,
+    )
+
+    tids = [tid, "short"]
+    stop_patterns = get_stop_patterns(feed, tids)
+    pattern, short_pattern = stop_patterns.set_index("trip_id").loc[
+        tids, "stop_pattern"
+    ]
+    methods = [("distance", 0.1), ("num_points", 100), ("stop_multiplier", 2)]
+    for method, value in methods:
+        points_and_pieces, pieces_by_pattern = sample_segment_points(
+            feed, tids, method=method, value=value
+        )
+        assert set(pieces_by_pattern) == {pattern, short_pattern}
+        assert len(pieces_by_pattern[pattern]) == 2
+        assert pieces_by_pattern[short_pattern] == pieces_by_pattern[pattern][:1]
+        assert [id_ for __, id_ in points_and_pieces] == pieces_by_pattern[pattern]
+
+        # The pieces join up into the whole trip
+        mpoints_by_piece = {id_: np.array(p) for p, id_ in points_and_pieces}
+        mpoints = assemble_pieces(mpoints_by_piece, pieces_by_pattern)[pattern]
+        points = sample_trip_points(feed, [tid], method=method, value=value)[0][0]
+        assert np.allclose(mpoints[[0, -1]], np.array(points)[[0, -1]])
+
+    # Using the feed's stop distances, the pieces split the points by distance
+    points_and_pieces, __ = sample_segment_points(
+        feed, tids, method="num_points", value=100
+    )
+    sizes = [len(p) for p, __ in points_and_pieces]
+    assert 100 <= sum(sizes) <= 102
+    assert assemble_pieces({}, pieces_by_pattern) == {}
+
 
 def test_get_trip_ids():
     tids = _get_trip_ids(test_feed, [3])
@@ -132,6 +317,360 @@ def test_match_feed():
     mm_shapes = mm_feed.shapes.loc[lambda x: x.shape_id == shid]
     assert mm_shapes.shape[0] == 2
 
+    # Optionally compute distances along the new shapes, here in kilometers
+    mm_feed = match_feed(test_feed, "osrm", trip_ids=[tid], shape_dist_traveled=True)
+    mm_shapes = mm_feed.shapes.loc[lambda x: x.shape_id == shid]
+    assert mm_shapes.shape_dist_traveled.tolist() == [0, pytest.approx(0.2786, 1e-3)]
+
+    # Record metrics
+    metrics = Metrics()
+    match_feed(test_feed, "osrm", trip_ids=[tid], metrics=metrics)
+    assert set(metrics.stages) == {
+        "stop_patterns",
+        "sampling",
+        "matching",
+        "parsing",
+        "shapes",
+    }
+    assert metrics.num_requests == get_num_match_calls(test_feed, trip_ids=[tid])
+    assert metrics.statuses == {200: metrics.num_requests}
+    assert metrics.bytes_sent > 0
+    assert metrics.bytes_received > 0
+    assert not metrics.dropped
+
+    # Report progress and return the unmatched feed when out of time
+    job = Job()
+    match_feed(test_feed, "osrm", trip_ids=[tid], job=job)
+    assert job.progress["num_patterns"] == 1
+    assert job.progress["num_sampled"] == 1
+    assert job.progress["num_matched"] == 1
+
+    n = len(responses.calls)
+    job = Job(timeout=0)
+    mm_feed = match_feed(test_feed, "osrm", trip_ids=[tid], job=job)
+    assert len(responses.calls) == n
+    assert job.reason == "timeout"
+    assert job.progress["num_sampled"] == 0
+    pd.testing.assert_frame_equal(mm_feed.shapes, test_feed.shapes, check_dtype=False)
+
+
+def test_build_shapes():
+    mpoints_list = [[[0, 0], [1, 0], [1, 1]], [[2, 2], [3, 3]]]
+    f = _build_shapes(["a", "b", "c"], [1, 0, 1], mpoints_list)
+    assert f.shape_id.tolist() == ["a"] * 2 + ["b"] * 3 + ["c"] * 2
+    assert f.shape_pt_sequence.tolist() == [0, 1, 0, 1, 2, 0, 1]
+    assert f.shape_pt_lon.tolist() == [2, 3, 0, 1, 1, 2, 3]
+    assert "shape_dist_traveled" not in f
+
+    f = _build_shapes(["a", "b"], [1, 0], mpoints_list, dist_units="km")
+    # One degree of longitude along the equator
+    assert f.shape_dist_traveled.tolist()[2:4] == [0, pytest.approx(111.195, 1e-4)]
+    assert f.shape_dist_traveled.iat[0] == 0
+    assert f.shape_dist_traveled.iat[1] == pytest.approx(157.25, 1e-3)
+
+    f = _build_shapes(["a", "b", "c"], [1, 0, 1], mpoints_list, categorical=True)
+    assert isinstance(f.shape_id.dtype, pd.CategoricalDtype)
+    assert f.shape_id.cat.categories.tolist() == ["a", "b", "c"]
+    assert f.shape_id.tolist() == ["a"] * 2 + ["b"] * 3 + ["c"] * 2
+
+    f = _build_shapes([], [], [])
+    assert f.empty
+    assert list(f.columns) == [
+        "shape_id",
+        "shape_pt_sequence",
+        "shape_pt_lon",
+        "shape_pt_lat",
+    ]
+
+
+def test_dedupe_points():
+    points_and_ids = [
+        ([[0, 0], [1, 1]], "a"),
+        ([[0, 0.000001], [1, 1]], "b"),
+        ([[0, 0], [1, 1], [2, 2]], "c"),
+        ([[0, 0], [1, 1]], "d"),
+    ]
+    unique, duplicates = dedupe_points(points_and_ids)
+    assert [id_ for __, id_ in unique] == ["a", "c"]
+    assert duplicates == {"a": ["b", "d"]}
+
+    unique, duplicates = dedupe_points(points_and_ids, precision=6)
+    assert [id_ for __, id_ in unique] == ["a", "b", "c"]
+    assert duplicates == {"a": ["d"]}
+
+    assert dedupe_points([]) == ([], {})
+
+
+@responses.activate
+def test_match_feed_dedupe():
+    url = re.compile("http://router.project-osrm.org/match/v1/car*")
+    json = {"matchings": [{"geometry": "bmrzFqr|i`@vrC|r@"}], "code": "Ok"}
+    responses.add(responses.GET, url, status=200, json=json)
+
+    # Add a trip with a new stop pattern at the same stop locations
+    # as another trip
+    feed = test_feed.copy()
+    tid, shid = feed.trips[["trip_id", "shape_id"]].iloc[0]
+    trip = feed.trips.loc[lambda x: x.trip_id == tid].assign(trip_id="clone")
+    feed.trips = pd.concat([feed.trips, trip], ignore_index=True)
+    st = feed.stop_times.loc[lambda x: x.trip_id == tid]
+    stops = feed.stops.loc[lambda x: x.stop_id.isin(st.stop_id)]
+    feed.stops = pd.concat(
+        [feed.stops, stops.assign(stop_id=stops.stop_id + "-clone")],
+        ignore_index=True,
+    )
+    feed.stop_times = pd.concat(
+        [
+            feed.stop_times,
+            st.assign(trip_id="clone", stop_id=st.stop_id + "-clone"),
+        ],
+        ignore_index=True,
+    )
+    feed.shapes = pd.concat(
+        [
+            feed.shapes,
+            feed.shapes.loc[lambda x: x.shape_id == shid].assign(shape_id="clone"),
+        ],
+        ignore_index=True,
+    )
+    feed.trips.loc[lambda x: x.trip_id == "clone", "shape_id"] = "clone"
+
+    tids = [tid, "clone"]
+    assert get_num_match_calls(feed, trip_ids=tids) == 2
+    assert get_num_match_calls(feed, trip_ids=tids, dedupe=True) == 1
+    assert get_num_saved_calls(feed, trip_ids=tids) == 1
+
+    mm_feed = match_feed(feed, "osrm", trip_ids=tids)
+    assert len(responses.calls) == 1
+    mm_shapes = mm_feed.shapes.loc[lambda x: x.shape_id.isin([shid, "clone"])]
+    assert mm_shapes.groupby("shape_id").size().to_dict() == {shid: 2, "clone": 2}
+
+    new_shapes = pd.concat(iter_match_feed(feed, "osrm", trip_ids=tids))
+    assert len(responses.calls) == 2
+    assert set(new_shapes.shape_id) == {shid, "clone"}
+
+    match_feed(feed, "osrm", trip_ids=tids, dedupe=False)
+    assert len(responses.calls) == 4
+
+
+@responses.activate
+def test_match_feed_segments():
+    url = re.compile("http://router.project-osrm.org/match/v1/car*")
+    json = {"matchings": [{"geometry": "bmrzFqr|i`@vrC|r@"}], "code": "Ok"}
+    responses.add(responses.GET, url, status=200, json=json)
+
+    # Add a short turn of a trip on another shape
+    feed = test_feed.copy()
+    tid, shid = feed.trips[["trip_id", "shape_id"]].iloc[0]
+    trip = feed.trips.loc[lambda x: x.trip_id == tid].assign(
+        trip_id="short", shape_id="short"
+    )
+    feed.trips = pd.concat([feed.trips, trip], ignore_index=True)
+    st = feed.stop_times.loc[lambda x: x.trip_id == tid].sort_values("stop_sequence")
+    feed.stop_times = pd.concat(
+        [feed.stop_times, st.iloc[: st.shape[0] // 2].assign(trip_id="short")],
+        ignore_index=True,
+    )
+
+    tids = [tid, "short"]
+    mm_feed = match_feed(feed, "osrm", trip_ids=tids, segments=True)
+    assert len(responses.calls) == 2
+    mm_shapes = mm_feed.shapes.loc[lambda x: x.shape_id.isin([shid, "short"])]
+    assert mm_shapes.groupby("shape_id").size().to_dict() == {shid: 4, "short": 2}
+
+    new_shapes = pd.concat(iter_match_feed(feed, "osrm", trip_ids=tids, segments=True))
+    assert len(responses.calls) == 4
+    assert new_shapes.groupby("shape_id").size().to_dict() == {shid: 4, "short": 2}
+
+    # A failed piece fails its patterns
+    responses.replace(responses.GET, url, status=400, json={"code": "NoMatch"})
+    metrics = Metrics()
+    mm_feed = match_feed(feed, "osrm", trip_ids=tids, segments=True, metrics=metrics)
+    assert {"short", shid} & set(mm_feed.shapes.shape_id) == {shid}
+    assert len(metrics.dropped) == 4
+
+
+@responses.activate
+def test_match_feed_incremental():
+    url = re.compile("http://router.project-osrm.org/match/v1/car*")
+    json = {"matchings": [{"geometry": "bmrzFqr|i`@vrC|r@"}], "code": "Ok"}
+    responses.add(responses.GET, url, status=200, json=json)
+
+    tids = test_feed.trips.trip_id.iloc[:2].tolist()
+    mm_feed = match_feed(test_feed, "osrm", trip_ids=tids)
+    n = len(responses.calls)
+    assert n == get_num_match_calls(test_feed, trip_ids=tids, dedupe=True)
+
+    # Unchanged feed needs no requests
+    mm_feed2 = match_feed(
+        test_feed, "osrm", trip_ids=tids, prev_feed=test_feed, prev_mm_feed=mm_feed
+    )
+    assert len(responses.calls) == n
+    assert mm_feed2.shapes.shape == mm_feed.shapes.shape
+
+    # Moving a stop of the first trip triggers a request for its pattern only
+    feed = test_feed.copy()
+    st = feed.stop_times
+    stop_ids = set(st.loc[lambda x: x.trip_id == tids[0], "stop_id"]) - set(
+        st.loc[lambda x: x.trip_id == tids[1], "stop_id"]
+    )
+    stop_id = sorted(stop_ids)[0]
+    feed.stops.loc[lambda x: x.stop_id == stop_id, "stop_lat"] += 0.01
+    match_feed(feed, "osrm", trip_ids=tids, prev_feed=test_feed, prev_mm_feed=mm_feed)
+    assert len(responses.calls) == n + 1
+
+    # Patterns not matched before get matched
+    tid = test_feed.trips.trip_id.iat[2]
+    match_feed(
+        test_feed, "osrm", trip_ids=[tid], prev_feed=test_feed, prev_mm_feed=mm_feed
+    )
+    assert len(responses.calls) == n + 2
+
+    # Unmatched patterns are recorded as dropped
+    responses.replace(responses.GET, url, status=400, json={"code": "NoMatch"})
+    metrics = Metrics()
+    match_feed(test_feed, "osrm", trip_ids=tids, metrics=metrics)
+    assert len(metrics.dropped) == get_num_match_calls(test_feed, trip_ids=tids)
+    assert set(metrics.dropped.values()) == {"HTTP 400"}
+
+
+@responses.activate
+def test_match_feed_segment_store(tmp_path):
+    # Match each list of sample points to itself
+    def echo(request):
+        path = request.path_url.split("?")[0].rsplit("/", 1)[-1]
+        points = [[float(x) for x in p.split(",")] for p in path.split(";")]
+        body = {"matchings": [{"geometry": encode_polyline(points, 6)}], "code": "Ok"}
+        return 200, {}, json.dumps(body)
+
+    for url in ["http://router.project-osrm.org", "http://localhost:5000"]:
+        url = re.compile(url + "/match/v1/car*")
+        responses.add_callback(responses.GET, url, callback=echo)
+
+    store = SegmentStore(tmp_path / "segments.db")
+    tids = test_feed.trips.trip_id.iloc[:2].tolist()
+    mm_feed = match_feed(test_feed, "osrm", trip_ids=tids, segment_store=store)
+    n = len(responses.calls)
+    assert n == get_num_match_calls(test_feed, trip_ids=tids, dedupe=True)
+    assert len(store) > 0
+
+    # Stored patterns need no requests and get their joined segments
+    metrics = Metrics()
+    mm_feed2 = match_feed(
+        test_feed, "osrm", trip_ids=tids, segment_store=store, metrics=metrics
+    )
+    assert len(responses.calls) == n
+    assert "segments" in metrics.stages
+    shids = test_feed.trips.loc[lambda x: x.trip_id.isin(tids), "shape_id"]
+    for shid in shids:
+        a = mm_feed.shapes.loc[lambda x: x.shape_id == shid]
+        b = mm_feed2.shapes.loc[lambda x: x.shape_id == shid]
+        assert np.allclose(
+            a[["shape_pt_lon", "shape_pt_lat"]].values[[0, -1]],
+            b[["shape_pt_lon", "shape_pt_lat"]].values[[0, -1]],
+            atol=1e-3,
+        )
+
+    # Also when iterating, and other services or URLs miss the store
+    list(iter_match_feed(test_feed, "osrm", trip_ids=tids, segment_store=store))
+    assert len(responses.calls) == n
+    match_feed(
+        test_feed,
+        "osrm",
+        trip_ids=tids,
+        segment_store=store,
+        url="http://localhost:5000/match/v1/car",
+    )
+    assert len(responses.calls) == 2 * n
+
+    # Moving a stop triggers a request for its patterns only
+    feed = test_feed.copy()
+    st = feed.stop_times
+    stop_ids = set(st.loc[lambda x: x.trip_id == tids[0], "stop_id"]) - set(
+        st.loc[lambda x: x.trip_id == tids[1], "stop_id"]
+    )
+    stop_id = sorted(stop_ids)[0]
+    feed.stops.loc[lambda x: x.stop_id == stop_id, "stop_lat"] += 0.01
+    match_feed(feed, "osrm", trip_ids=tids, segment_store=store)
+    assert len(responses.calls) == 2 * n + 1
+
+
+@responses.activate
+def test_iter_match_feed(tmp_path):
+    url = re.compile("http://router.project-osrm.org/match/v1/car*")
+    json = {"matchings": [{"geometry": "bmrzFqr|i`@vrC|r@"}], "code": "Ok"}
+    responses.add(responses.GET, url, status=200, json=json)
+
+    tids = test_feed.trips.trip_id.iloc[:3].tolist()
+    mm_feed = match_feed(test_feed, "osrm", trip_ids=tids)
+    n = len(responses.calls)
+    shids = test_feed.trips.loc[lambda x: x.trip_id.isin(tids), "shape_id"]
+
+    new_shapes = pd.concat(iter_match_feed(test_feed, "osrm", trip_ids=tids))
+    assert len(responses.calls) == 2 * n
+    assert set(new_shapes.shape_id) == set(shids)
+    assert new_shapes.groupby("shape_id").size().eq(2).all()
+
+    # Streamed shapes equal those of match_feed
+    path = tmp_path / "shapes.txt"
+    stream_match_feed(test_feed, "osrm", path, trip_ids=tids)
+    shapes = pd.read_csv(path, dtype={"shape_id": str})
+    cols = ["shape_id", "shape_pt_sequence"]
+    assert list(shapes.columns) == list(mm_feed.shapes.columns)
+    pd.testing.assert_frame_equal(
+        shapes.sort_values(cols).reset_index(drop=True),
+        mm_feed.shapes.sort_values(cols).reset_index(drop=True),
+        check_dtype=False,
+    )
+
+    with pytest.raises(ValueError):
+        next(iter_match_feed(test_feed, "bingo"))
+
+
+def test_hash_ids():
+    ids = pd.Series(["b", "a", "b", None, "c"])
+    expect = _hash_ids(ids)
+    assert np.array_equal(_hash_ids(ids.astype("category")), expect)
+    assert expect[0] == expect[2]
+    assert len(set(expect)) == 4
+
+
+@responses.activate
+def test_match_feed_categorical():
+    url = re.compile("http://router.project-osrm.org/match/v1/car*")
+    json = {"matchings": [{"geometry": "bmrzFqr|i`@vrC|r@"}], "code": "Ok"}
+    responses.add(responses.GET, url, status=200, json=json)
+
+    # Categorical IDs, as read from dictionary-encoded Arrow columns
+    feed = test_feed.copy()
+    for table in ["trips", "stop_times", "stops", "shapes"]:
+        f = getattr(feed, table).copy()
+        for col in ["trip_id", "stop_id", "shape_id"]:
+            if col in f.columns:
+                f[col] = f[col].astype("category")
+        setattr(feed, table, f)
+
+    expect = get_stop_patterns(test_feed)
+    pd.testing.assert_frame_equal(
+        get_stop_patterns(feed)[["stop_pattern_id", "stop_pattern"]],
+        expect[["stop_pattern_id", "stop_pattern"]],
+    )
+
+    tids = test_feed.trips.trip_id.iloc[:20].tolist()
+    mm_feed = match_feed(feed, "osrm", trip_ids=tids)
+    expect = match_feed(test_feed, "osrm", trip_ids=tids)
+    assert isinstance(mm_feed.shapes.shape_id.dtype, pd.CategoricalDtype)
+    cols = ["shape_id", "shape_pt_sequence"]
+    pd.testing.assert_frame_equal(
+        mm_feed.shapes.sort_values(cols).reset_index(drop=True),
+        expect.shapes.sort_values(cols).reset_index(drop=True),
+        check_dtype=False,
+        check_categorical=False,
+    )
+
+    new_shapes = next(iter_match_feed(feed, "osrm", trip_ids=tids))
+    assert isinstance(new_shapes.shape_id.dtype, pd.CategoricalDtype)
+
 
 def test_get_num_match_calls():
     route_types = test_feed.routes.route_type.unique()
@@ -141,3 +680,21 @@ def test_get_num_match_calls():
     tid = test_feed.trips.trip_id.iat[0]
     n = get_num_match_calls(test_feed, trip_ids=[tid])
     assert n == 1
+
+    stop_patterns = get_stop_patterns(test_feed)
+    n = get_num_match_calls(
+        test_feed, route_types=route_types, stop_patterns=stop_patterns
+    )
+    assert n == stop_patterns.stop_pattern.nunique()
+
+    # Deduping counts the unique lists of sample points
+    m = get_num_match_calls(test_feed, route_types=route_types, dedupe=True)
+    assert isinstance(m, int)
+    assert m <= n
+    assert get_num_saved_calls(test_feed, route_types=route_types) == n - m
+    assert (
+        get_num_match_calls(
+            test_feed, route_types=route_types, stop_patterns=stop_patterns, dedupe=True
+        )
+        == m
+    )
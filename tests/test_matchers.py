@@ -1,5 +1,8 @@
 import re
+import time
 import responses
+import numpy as np
+import pytest
 
 from gtfs_map_matcher import *
 
@@ -22,6 +25,77 @@ points_and_ids = [
 ]
 
 
+def to_lists(mpoints_and_ids):
+    return [(mpoints.tolist(), id_) for mpoints, id_ in mpoints_and_ids]
+
+
+def test_split_points():
+    points = [[i, i] for i in range(250)]
+    assert split_points(points, None) == [points]
+    assert split_points(points, 250) == [points]
+
+    chunks = split_points(points, 100, overlap=2)
+    assert [len(c) for c in chunks] == [100, 100, 54]
+    assert chunks[1][:2] == chunks[0][-2:]
+    assert chunks[2][:2] == chunks[1][-2:]
+    assert chunks[-1][-1] == points[-1]
+
+    with pytest.raises(ValueError):
+        split_points(points, 100, overlap=100)
+
+
+def test_stitch_points():
+    points = [[i, 0] for i in range(10)]
+    assert stitch_points([points]).tolist() == points
+    assert stitch_points([points[:6], points[4:]]).tolist() == points
+    assert stitch_points([points[:6], [], [[4.1, 0]] + points[5:]]).tolist() == (
+        points[:4] + [[4.1, 0]] + points[5:]
+    )
+    assert stitch_points([]).shape == (0, 2)
+
+
+def test_decode_polyline():
+    polyline = pytest.importorskip('polyline')
+    points = [[174.8 + i / 997, -41.2 + (-1) ** i * i / 1009] for i in range(50)]
+    for precision in [5, 6]:
+        s = polyline.encode([(lat, lon) for lon, lat in points], precision)
+        expect = [[lon, lat] for lat, lon in polyline.decode(s, precision)]
+        r = decode_polyline(s, precision)
+        assert r.dtype == float
+        assert r.tolist() == expect
+
+    assert decode_polyline('').shape == (0, 2)
+    with pytest.raises(ValueError):
+        decode_polyline('_p~iF')
+
+
+def test_encode_polyline():
+    polyline = pytest.importorskip('polyline')
+    points = [[174.8 + i / 997, -41.2 + (-1) ** i * i / 1009] for i in range(50)]
+    for precision in [5, 6]:
+        s = encode_polyline(points, precision)
+        assert s == polyline.encode([(lat, lon) for lon, lat in points], precision)
+        assert np.allclose(decode_polyline(s, precision), points, atol=10 ** -precision)
+
+    assert encode_polyline([]) == ''
+
+
+def test_encode_points_osrm():
+    points = points_and_ids[0][0]
+    s = encode_points_osrm(points)
+    assert decode_points_osrm(s) == points
+    s = encode_points_osrm(points, precision=3)
+    assert decode_points_osrm(s) == [[174.843, -41.137], [174.828, -41.131]]
+    for encoding, precision in [('polyline', 5), ('polyline6', 6)]:
+        s = encode_points_osrm(points, encoding)
+        assert s.startswith(encoding + '(')
+        assert '|' not in s
+        assert np.allclose(decode_points_osrm(s), points, atol=10 ** -precision)
+
+    with pytest.raises(ValueError):
+        encode_points_osrm(points, 'bingo')
+
+
 @responses.activate
 def test_match_with_osrm():
     # Create mock response
@@ -64,6 +138,167 @@ def test_match_with_osrm():
     assert isinstance(r, list)
     assert len(r) == len(points_and_ids)
 
+    # Polyline encoding makes shorter URLs with the same results
+    s = match_with_osrm(points_and_ids, encoding='polyline6')
+    assert to_lists(s) == to_lists(r)
+    urls = [call.request.url for call in responses.calls]
+    assert all('polyline6(' in url for url in urls[2:])
+    assert len(urls[2]) < len(urls[0])
+
+    with pytest.raises(ValueError):
+        match_with_osrm(points_and_ids, encoding='bingo')
+
+
+@responses.activate
+def test_match_with_osrm_cache(tmp_path):
+    url = 'http://router.project-osrm.org/match/v1/car'
+    url = re.compile(url + '*')
+    json = {
+        'matchings': [{'geometry': 'bmrzFqr|i`@vrC|r@'}],
+        'code': 'Ok'
+    }
+    responses.add(responses.GET, url, status=200, json=json)
+
+    cache = SQLiteCache(tmp_path / 'cache.db')
+    r = match_with_osrm(points_and_ids, cache=cache)
+    assert len(responses.calls) == 2
+    assert len(cache) == 2
+
+    # Cached results need no requests
+    s = match_with_osrm(points_and_ids, cache=cache)
+    assert to_lists(s) == to_lists(r)
+    assert len(responses.calls) == 2
+
+    # Different parameters need new requests
+    match_with_osrm(points_and_ids, cache=cache, overview='simplified')
+    assert len(responses.calls) == 4
+
+
+@responses.activate
+def test_match_with_osrm_chunks():
+    url = 'http://router.project-osrm.org/match/v1/car'
+    url = re.compile(url + '*')
+    json = {
+        'matchings': [{'geometry': 'bmrzFqr|i`@vrC|r@'}],
+        'code': 'Ok'
+    }
+    responses.add(responses.GET, url, status=200, json=json)
+
+    points = [[174.8 + i / 1000, -41.2] for i in range(150)]
+    r = match_with_osrm([(points, 'bingo')])
+    assert len(responses.calls) == 2
+    assert len(r) == 1
+    mpoints, id_ = r[0]
+    assert id_ == 'bingo'
+    assert len(mpoints) > 2
+
+    r = match_with_osrm([(points, 'bingo')], max_points=None)
+    assert len(responses.calls) == 3
+
+
+@responses.activate
+def test_match_with_osrm_retries():
+    url = 'http://router.project-osrm.org/match/v1/car'
+    url = re.compile(url + '*')
+    json = {
+        'matchings': [{'geometry': 'bmrzFqr|i`@vrC|r@'}],
+        'code': 'Ok'
+    }
+    responses.add(responses.GET, url, status=429, json={'code': 'TooMany'})
+    responses.add(responses.GET, url, status=503)
+    responses.add(responses.GET, url, status=200, json=json)
+
+    # Retry until success
+    scheduler = Scheduler(max_retries=2, backoff=0)
+    metrics = Metrics()
+    r = match_with_osrm(points_and_ids[:1], scheduler=scheduler, metrics=metrics)
+    assert len(responses.calls) == 3
+    assert len(r) == 1
+    assert metrics.dropped == {}
+
+    # Report failures after the last retry, per call
+    responses.replace(responses.GET, url, status=500)
+    metrics = Metrics()
+    r = match_with_osrm(points_and_ids, scheduler=scheduler, metrics=metrics)
+    assert len(responses.calls) == 3 + 2 * 3
+    assert r == []
+    assert metrics.dropped == {'bingo': 'HTTP 500', 'bongo': 'HTTP 500'}
+    assert not hasattr(scheduler, 'failures')
+
+
+@responses.activate
+def test_match_with_osrm_job():
+    url = 'http://router.project-osrm.org/match/v1/car'
+    url = re.compile(url + '*')
+    json = {
+        'matchings': [{'geometry': 'bmrzFqr|i`@vrC|r@'}],
+        'code': 'Ok'
+    }
+    responses.add(responses.GET, url, status=200, json=json)
+
+    # Report progress
+    progress = []
+    r = match_with_osrm(points_and_ids, job=Job(callback=progress.append))
+    assert len(r) == 2
+    assert progress[-1]['num_requests'] == 2
+    assert progress[-1]['num_in_flight'] == 0
+    assert progress[-1]['num_completed'] == 2
+    assert progress[-1]['num_matched'] == 2
+    assert max(p['num_in_flight'] for p in progress) >= 1
+
+    # Cancel after sending the first request
+    def cancel(progress):
+        if progress['num_in_flight']:
+            job.cancel()
+
+    job = Job(callback=cancel)
+    assert match_with_osrm(points_and_ids, job=job) == []
+    assert job.reason == 'cancelled'
+    assert job.progress['num_in_flight'] == 0
+
+    # Time out while backing off instead of waiting for the retry
+    responses.replace(responses.GET, url, status=503)
+    job = Job(timeout=0.2)
+    scheduler = Scheduler(max_retries=1, backoff=60)
+    start = time.monotonic()
+    assert match_with_osrm(points_and_ids, scheduler=scheduler, job=job) == []
+    assert time.monotonic() - start < 5
+    assert job.reason == 'timeout'
+
+
+@responses.activate
+def test_iter_match_osrm():
+    url = 'http://router.project-osrm.org/match/v1/car'
+    url = re.compile(url + '*')
+    json = {
+        'matchings': [{'geometry': 'bmrzFqr|i`@vrC|r@'}],
+        'code': 'Ok'
+    }
+    responses.add(responses.GET, url, status=200, json=json)
+
+    it = iter_match_osrm(points_and_ids)
+    assert not isinstance(it, list)
+    r = list(it)
+    assert sorted(id_ for __, id_ in r) == ['bingo', 'bongo']
+    assert sorted(to_lists(r)) == to_lists(match_with_osrm(points_and_ids))
+
+    # Stopping early is fine
+    it = iter_match_osrm(points_and_ids)
+    next(it)
+    it.close()
+
+    # Matches arrive while the scheduler holds back the other requests
+    responses.calls.reset()
+    scheduler = Scheduler(rate=2, burst=1)
+    start = time.monotonic()
+    it = iter_match_osrm(points_and_ids * 2, scheduler=scheduler)
+    next(it)
+    assert time.monotonic() - start < 1
+    assert len(list(it)) == 3
+    assert len(responses.calls) == 4
+    assert time.monotonic() - start >= 1.5
+
+
 @responses.activate
 def test_match_with_mapbox():
     # Create mock response
@@ -106,6 +341,22 @@ def test_match_with_mapbox():
     assert isinstance(r, list)
     assert len(r) == len(points_and_ids)
 
+    # POST the points in the body instead
+    responses.add(responses.POST, url, status=200, json=json)
+    s = match_with_mapbox(points_and_ids, 'api_key', http_method='POST', precision=5)
+    assert to_lists(s) == to_lists(r)
+    requests_ = [call.request for call in responses.calls[2:]]
+    assert all(request.method == 'POST' for request in requests_)
+    assert all('access_token=api_key' in request.url for request in requests_)
+    assert any(
+        'coordinates=174.84323%2C-41.13742%3B174.82815%2C-41.13064' in request.body
+        for request in requests_
+    )
+
+    with pytest.raises(ValueError):
+        match_with_mapbox(points_and_ids, 'api_key', http_method='PUT')
+
+
 @responses.activate
 def test_match_with_google():
     # Create mock response
@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+from gtfs_map_matcher import *
+
+
+def test_metrics():
+    metrics = Metrics()
+    with metrics.time("sampling"):
+        pass
+    metrics.add_time("sampling", 1)
+    assert metrics.stages["sampling"] >= 1
+
+    metrics.record_response(200, 0.02, bytes_sent=10, bytes_received=100)
+    metrics.record_response(429, 0.3)
+    metrics.record_retry()
+    metrics.record_error()
+    metrics.record_cache(3, 1)
+    metrics.record_dropped("a", "HTTP 400")
+    metrics.record_dropped("a", "no match")
+    assert metrics.num_requests == 3
+    assert metrics.num_retries == 1
+    assert metrics.num_errors == 1
+    assert metrics.statuses == {200: 1, 429: 1}
+    assert metrics.bytes_sent == 10
+    assert metrics.bytes_received == 100
+    assert metrics.cache_hits == 3
+    assert metrics.cache_misses == 1
+    assert metrics.dropped == {"a": "HTTP 400"}
+
+    h = metrics.get_latency_histogram()
+    assert list(h) == LATENCY_BINS
+    assert h[0.025] == 1
+    assert h[0.5] == 1
+    assert sum(h.values()) == 2
+    assert metrics.get_latency_histogram([0.1, 1]) == {0.1: 1, 1: 1}
+
+
+def test_metrics_to_json(tmp_path):
+    metrics = Metrics()
+    d = metrics.to_dict()
+    assert d["num_requests"] == 0
+    assert d["latency"] == {}
+    assert sum(d["latency_histogram"].values()) == 0
+
+    metrics.record_response(200, 0.02)
+    metrics.record_dropped(("a", "b"), "no match")
+    path = tmp_path / "metrics.json"
+    metrics.to_json(path)
+    with path.open() as f:
+        d = json.load(f)
+    assert d["statuses"] == {"200": 1}
+    assert d["latency"]["p50"] == pytest.approx(0.02)
+    assert d["latency_histogram"]["0.025"] == 1
+    assert "+Inf" in d["latency_histogram"]
+    assert d["num_dropped"] == 1
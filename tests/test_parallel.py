@@ -0,0 +1,40 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from gtfs_map_matcher.parallel import *
+
+
+def total(spec, name):
+    return float(attach_arrays(spec)[name].sum())
+
+
+def test_shared_arrays():
+    arrays = {'x': np.arange(10.0), 'y': np.ones((3, 2), dtype=int)}
+    with SharedArrays(arrays) as shared:
+        a = attach_arrays(shared.spec)
+        assert np.array_equal(a['x'], arrays['x'])
+        assert np.array_equal(a['y'], arrays['y'])
+        assert not a['x'].flags.writeable
+
+        with ProcessPoolExecutor(2) as executor:
+            r = list(executor.map(total, [shared.spec] * 2, ['x', 'y']))
+        assert r == [45, 6]
+
+
+def test_split_balanced():
+    assert split_balanced([], 3) == []
+    assert split_balanced([1, 1, 1, 1], 2) == [(0, 2), (2, 4)]
+    assert split_balanced([10, 1, 1, 1], 2) == [(0, 1), (1, 4)]
+    assert split_balanced([1, 1], 5) == [(0, 1), (1, 2)]
+
+    shards = split_balanced(np.random.default_rng(1).random(100), 7)
+    assert shards[0][0] == 0 and shards[-1][1] == 100
+    assert all(a[1] == b[0] for a, b in zip(shards[:-1], shards[1:]))
+
+
+def test_get_executor():
+    assert get_executor(None) is None
+    assert get_executor(1) is None
+    with get_executor(2) as executor:
+        assert executor._max_workers == 2
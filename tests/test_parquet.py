@@ -0,0 +1,108 @@
+import importlib.util
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+import responses
+
+from .context import test_feed
+from gtfs_map_matcher import *
+from gtfs_map_matcher.main import _build_shapes
+
+
+HAS_PYARROW = importlib.util.find_spec("pyarrow") is not None
+
+
+@pytest.mark.skipif(HAS_PYARROW, reason="PyArrow is installed")
+def test_import_pyarrow_missing(tmp_path):
+    with pytest.raises(ImportError, match="parquet"):
+        import_pyarrow()
+    with pytest.raises(ImportError):
+        write_shapes(test_feed.shapes, tmp_path / "shapes.parquet")
+
+
+def test_shapes_to_arrow():
+    pa = pytest.importorskip("pyarrow")
+    mpoints_list = [[[0, 0], [1, 0], [1, 1]], [[2, 2], [3, 3]]]
+    shapes = _build_shapes(
+        ["a", "b", "c"], [1, 0, 1], mpoints_list, dist_units="km", categorical=True
+    )
+    table = shapes_to_arrow(shapes)
+    assert table.column_names == list(shapes.columns)
+    assert pa.types.is_dictionary(table.schema.field("shape_id").type)
+    assert table.column("shape_id").to_pylist() == shapes["shape_id"].tolist()
+
+    # The coordinates are not copied
+    lon = table.column("shape_pt_lon").chunk(0)
+    assert lon.buffers()[1].address == shapes["shape_pt_lon"].to_numpy().ctypes.data
+    pd.testing.assert_frame_equal(table.to_pandas(), shapes, check_dtype=False)
+
+
+def test_write_shapes(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = tmp_path / "shapes.parquet"
+    write_shapes(test_feed.shapes, path)
+    shapes = pq.read_table(path).to_pandas()
+    pd.testing.assert_frame_equal(
+        shapes, test_feed.shapes, check_dtype=False, check_categorical=False
+    )
+
+
+def test_shapes_writer(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    mpoints_list = [[[0, 0], [1, 0], [1, 1]], [[2, 2], [3, 3]]]
+    shapes = _build_shapes(["a", "b", "c"], [1, 0, 1], mpoints_list)
+    columns = list(shapes.columns) + ["shape_dist_traveled"]
+    path = tmp_path / "shapes.parquet"
+    with ShapesWriter(path, columns) as writer:
+        # The coordinates are not copied, and missing columns are nulls
+        table = writer.to_arrow(shapes)
+        lon = table.column("shape_pt_lon").chunk(0)
+        address = shapes["shape_pt_lon"].to_numpy().ctypes.data
+        assert lon.buffers()[1].address == address
+        assert table.column("shape_dist_traveled").null_count == len(shapes)
+
+        writer.write(shapes)
+        writer.write(shapes.iloc[:2])
+
+    f = pq.ParquetFile(path)
+    assert f.num_row_groups == 2
+    assert f.schema_arrow.equals(writer.schema)
+    shape_ids = f.read().column("shape_id").to_pylist()
+    assert shape_ids == shapes["shape_id"].tolist() + ["a", "a"]
+
+
+@responses.activate
+def test_stream_match_feed_parquet(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+    url = re.compile("http://router.project-osrm.org/match/v1/car*")
+    json = {"matchings": [{"geometry": "bmrzFqr|i`@vrC|r@"}], "code": "Ok"}
+    responses.add(responses.GET, url, status=200, json=json)
+
+    tids = test_feed.trips.trip_id.iloc[:3].tolist()
+    mm_feed = match_feed(test_feed, "osrm", trip_ids=tids)
+    path = tmp_path / "shapes.parquet"
+    stream_match_feed(test_feed, "osrm", path, trip_ids=tids)
+    f = pq.ParquetFile(path)
+    assert f.num_row_groups > 1
+    shapes = f.read().to_pandas()
+    assert isinstance(shapes["shape_id"].dtype, pd.CategoricalDtype)
+    cols = ["shape_id", "shape_pt_sequence"]
+    pd.testing.assert_frame_equal(
+        shapes.astype({"shape_id": str}).sort_values(cols).reset_index(drop=True),
+        mm_feed.shapes.sort_values(cols).reset_index(drop=True),
+        check_dtype=False,
+    )
+
+    # Stop patterns can be read back from Parquet stop times
+    path = tmp_path / "stop_times.parquet"
+    st = test_feed.stop_times.astype({"trip_id": "category", "stop_id": "category"})
+    pq.write_table(pa.Table.from_pandas(st, preserve_index=False), path)
+    stop_patterns, _ = read_stop_patterns(path, test_feed.trips, chunksize=1000)
+    expect = get_stop_patterns(test_feed)
+    assert np.array_equal(
+        stop_patterns.set_index("trip_id").loc[expect["trip_id"], "stop_pattern_id"],
+        expect["stop_pattern_id"],
+    )
@@ -0,0 +1,46 @@
+import pytest
+
+from gtfs_map_matcher import *
+
+
+def test_token_bucket():
+    bucket = TokenBucket(10, burst=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.1, abs=0.01)
+    assert bucket.reserve() == pytest.approx(0.2, abs=0.01)
+
+    with pytest.raises(ValueError):
+        TokenBucket(0)
+
+
+class Response:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def test_scheduler():
+    s = Scheduler(backoff=1, max_backoff=5)
+    assert s.delay() == 0
+    assert s.is_retryable(Response(429))
+    assert s.is_retryable(Response(503))
+    assert s.is_retryable(error=ConnectionError())
+    assert not s.is_retryable(Response(200))
+    assert not s.is_retryable(Response(400))
+
+    assert [s.get_backoff(i) for i in range(4)] == [1, 2, 4, 5]
+    assert s.get_backoff(0, Response(429, {'Retry-After': '3'})) == 3
+    assert s.get_backoff(0, Response(429, {'Retry-After': 'bingo'})) == 1
+
+    assert s.get_failure_reason(Response(404)) == 'HTTP 404'
+    assert s.get_failure_reason(Response(200)) == 'no match'
+    assert s.get_failure_reason(error=ConnectionError()) == 'ConnectionError()'
+    assert not hasattr(s, 'failures')
+
+
+def test_get_scheduler():
+    s = get_scheduler('mapbox')
+    assert get_scheduler('mapbox') is s
+    assert s.bucket.rate == RATE_LIMITS['mapbox']
+    assert get_scheduler('osrm').bucket is None
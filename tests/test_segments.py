@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+
+from gtfs_map_matcher import *
+from gtfs_map_matcher.segments import _decode_polylines
+
+
+# A path heading east, then north, through three stops about 10 meters
+# off the path
+path = np.array([[174.80, -41.20], [174.81, -41.20], [174.81, -41.19]])
+stops = np.array([[174.80, -41.2001], [174.8101, -41.20], [174.8101, -41.19]])
+
+
+def test_make_segment_keys():
+    keys = make_segment_keys(stops, "osrm", "a")
+    assert len(keys) == 2
+    assert all(isinstance(k, bytes) and len(k) == 16 for k in keys)
+    assert keys[0] != keys[1]
+
+    # Insensitive to rounding noise
+    assert make_segment_keys(stops + 1e-9, "osrm", "a") == keys
+
+    # Sensitive to everything else
+    assert make_segment_keys(stops[::-1], "osrm", "a")[1] != keys[0]
+    assert make_segment_keys(stops, "mapbox", "a") != keys
+    assert make_segment_keys(stops, "osrm", "b") != keys
+    assert make_segment_keys(stops[:1], "osrm", "a") == []
+
+
+def test_split_at_stops():
+    segments = split_at_stops(path, stops)
+    assert len(segments) == 2
+    assert np.allclose(segments[0], [[174.80, -41.20], [174.81, -41.20]])
+    assert np.allclose(segments[1], path[1:])
+    assert np.allclose(join_segments(segments), path)
+
+    # Stops past the corner project onto the path after the previous stops
+    segments = split_at_stops(path, [[174.80, -41.20], [174.81, -41.195]])
+    assert np.allclose(
+        segments[0], [[174.80, -41.20], [174.81, -41.20], [174.81, -41.195]]
+    )
+
+    # Paths passing a stop twice split at the pass that fits the other stops
+    loop = np.array([[174.80, -41.20], [174.82, -41.20], [174.82, -41.19]])
+    loop = np.concatenate([loop, [[174.80, -41.19], [174.80, -41.2005]]])
+    loop_stops = [[174.80, -41.2001], [174.82, -41.195], [174.80, -41.2001]]
+    segments = split_at_stops(loop, loop_stops)
+    assert np.allclose(segments[0][0], [174.80, -41.20])
+    assert np.allclose(segments[1][-1], [174.80, -41.2001])
+
+    # Repeated stops make single points
+    segments = split_at_stops(path, stops[[0, 0, 1]])
+    assert len(segments[0]) == 1
+
+    # Stops far from the path or paths with too few points fail
+    assert split_at_stops(path, [[174.80, -41.21], [174.81, -41.19]]) is None
+    assert split_at_stops(path[:1], stops) is None
+
+
+def test_decode_polylines():
+    rng = np.random.default_rng(1)
+    paths = [path, path[:1], stops + rng.normal(0, 0.01, stops.shape)]
+    blobs = [encode_polyline(p, 6).encode() for p in paths]
+    for got, p in zip(_decode_polylines(blobs, 6), paths):
+        assert np.array_equal(got, decode_polyline(encode_polyline(p, 6), 6))
+    assert _decode_polylines([], 6) == []
+
+
+def test_segment_store(tmp_path):
+    store = SegmentStore(tmp_path / "segments.db")
+    assert len(store) == 0
+    assert store.get_path(stops, "osrm") is None
+
+    assert store.set_path(stops, path, "osrm")
+    assert not store.set_path(stops, path[:1], "osrm")
+    assert len(store) == 2
+    assert np.allclose(store.get_path(stops, "osrm"), path)
+    assert store.get_path(stops, "osrm", "other") is None
+    assert store.get_path(stops[::-1], "osrm") is None
+
+    # Paths through stored segments are joined from them
+    assert np.allclose(store.get_path(stops[1:], "osrm"), path[1:])
+
+    # Persistent
+    store = SegmentStore(tmp_path / "segments.db")
+    assert len(store) == 2
+    assert store.get_num_bytes() > 0
+
+    store.clear()
+    assert len(store) == 0
+
+
+def test_segment_store_evict(tmp_path):
+    def make_stops(i):
+        return [[174.8 + i / 1000, -41.2], [174.8 + (i + 1) / 1000, -41.2]]
+
+    store = SegmentStore(tmp_path / "segments.db", max_size=2)
+    for i in range(3):
+        store.set_path(make_stops(i), make_stops(i), "osrm")
+        assert store.get_path(make_stops(0), "osrm") is not None
+    store.evict()
+
+    # Keeps the most recently used segments
+    assert len(store) == 2
+    assert store.get_path(make_stops(0), "osrm") is not None
+    assert store.get_path(make_stops(1), "osrm") is None
+    assert store.get_path(make_stops(2), "osrm") is not None
+
+    store.max_size = None
+    store.max_bytes = store.get_num_bytes() - 1
+    store.evict()
+    assert len(store) == 1
+    assert store.get_path(make_stops(0), "osrm") is None
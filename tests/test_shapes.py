@@ -0,0 +1,47 @@
+import numpy as np
+import shapely.geometry as sg
+
+from .context import test_feed
+from gtfs_map_matcher import *
+
+
+def test_shape_store():
+    lines = [[[0, 0], [1, 0], [1, 2]], [[5, 5]], [[0, 0], [0, 3]]]
+    store = ShapeStore(
+        np.concatenate(lines), [0, 3, 4, 6], shape_ids=['a', 'b', 'c']
+    )
+    assert len(store) == 3
+    assert np.array_equal(store.get_lengths(), [3, 0, 3])
+    assert np.array_equal(store.get_codes(['c', 'd', 'a']), [2, -1, 0])
+    assert np.array_equal(store.get_coords(2), lines[2])
+
+    codes = [0, 0, 0, 0, 1, 2, 2]
+    dists = [-1, 0.5, 2, 10, 1, 1.5, 3]
+    expect = [[0, 0], [0.5, 0], [1, 1], [1, 2], [5, 5], [0, 1.5], [0, 3]]
+    assert np.allclose(store.interpolate(codes, dists), expect)
+    assert np.allclose(
+        store.interpolate(codes, np.array(dists) / 3, normalized=True),
+        [p if c != 1 else [5, 5] for p, c in zip(expect, codes)],
+    )
+
+
+def test_shape_store_from_feed():
+    shape_ids = test_feed.shapes.shape_id.unique()[:5]
+    store = ShapeStore.from_feed(test_feed, shape_ids)
+    assert store.shape_ids == sorted(shape_ids)
+    geoms = {
+        shape_id: sg.LineString(group[['shape_pt_lon', 'shape_pt_lat']].values)
+        for shape_id, group in test_feed.shapes.sort_values('shape_pt_sequence')
+        .groupby('shape_id')
+        if shape_id in shape_ids
+    }
+
+    codes = np.repeat(np.arange(5), 11)
+    fracs = np.tile(np.linspace(0, 1, 11), 5)
+    points = store.interpolate(codes, fracs, normalized=True)
+    for code, frac, point in zip(codes, fracs, points):
+        geom = geoms[store.shape_ids[code]]
+        assert np.allclose(geom.interpolate(frac, normalized=True).coords[0], point)
+    assert np.allclose(
+        store.get_lengths(), [geoms[s].length for s in store.shape_ids]
+    )
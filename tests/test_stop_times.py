@@ -0,0 +1,79 @@
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+import responses
+
+from .context import test_feed
+from gtfs_map_matcher import *
+
+
+def test_iter_stop_times(tmp_path):
+    path = tmp_path / "stop_times.txt"
+    test_feed.stop_times.to_csv(path, index=False)
+
+    chunks = list(iter_stop_times(path, chunksize=1000))
+    assert len(chunks) > 1
+    st = pd.concat(chunks, ignore_index=True)
+    assert st.shape == test_feed.stop_times.shape
+    assert st["trip_id"].tolist() == test_feed.stop_times["trip_id"].tolist()
+
+    # Each chunk holds whole trips
+    trip_ids = [set(chunk["trip_id"]) for chunk in chunks]
+    assert sum(map(len, trip_ids)) == len(set.union(*trip_ids))
+
+    # Columns can be restricted
+    chunk = next(iter_stop_times(path, columns=["trip_id", "stop_id"]))
+    assert list(chunk.columns) == ["trip_id", "stop_id"]
+
+    # Trips split across the file fail
+    st = test_feed.stop_times
+    pd.concat([st.iloc[10:], st.iloc[:10]]).to_csv(path, index=False)
+    with pytest.raises(ValueError):
+        list(iter_stop_times(path, chunksize=1000))
+
+
+def test_read_stop_patterns(tmp_path):
+    path = tmp_path / "stop_times.txt"
+    st = test_feed.stop_times
+    # Shuffle the stops within each trip
+    st.sample(frac=1, random_state=1).sort_values("trip_id", kind="stable").to_csv(
+        path, index=False
+    )
+
+    stop_patterns, rep_stop_times = read_stop_patterns(
+        path, test_feed.trips, chunksize=1000
+    )
+    expect = get_stop_patterns(test_feed)
+    assert stop_patterns.shape == expect.shape
+    assert stop_patterns.set_index("trip_id").loc[
+        expect["trip_id"], ["stop_pattern_id", "stop_pattern"]
+    ].values.tolist() == expect[["stop_pattern_id", "stop_pattern"]].values.tolist()
+
+    # Only one trip per stop pattern gets stop times
+    assert rep_stop_times["trip_id"].nunique() == expect["stop_pattern_id"].nunique()
+    assert rep_stop_times.shape[0] < st.shape[0]
+    assert set(rep_stop_times.columns) == set(st.columns)
+
+
+@responses.activate
+def test_match_feed_read_stop_patterns(tmp_path):
+    url = re.compile("http://router.project-osrm.org/match/v1/car*")
+    json = {"matchings": [{"geometry": "bmrzFqr|i`@vrC|r@"}], "code": "Ok"}
+    responses.add(responses.GET, url, status=200, json=json)
+
+    path = tmp_path / "stop_times.txt"
+    test_feed.stop_times.to_csv(path, index=False)
+    feed = test_feed.copy()
+    stop_patterns, feed.stop_times = read_stop_patterns(path, feed.trips)
+
+    tids = test_feed.trips.trip_id.iloc[:20].tolist()
+    mm_feed = match_feed(feed, "osrm", trip_ids=tids, stop_patterns=stop_patterns)
+    n = len(responses.calls)
+    expect = match_feed(test_feed, "osrm", trip_ids=tids)
+    assert len(responses.calls) == 2 * n
+    assert np.array_equal(
+        mm_feed.shapes.sort_values(["shape_id", "shape_pt_sequence"]).values,
+        expect.shapes.sort_values(["shape_id", "shape_pt_sequence"]).values,
+    )